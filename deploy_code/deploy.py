@@ -12,6 +12,8 @@ endpoint_name = os.environ['ENDPOINT_NAME']
 image_name = os.environ['IMAGE_NAME']
 role_arn = os.environ['ROLE_ARN']
 instance_type = os.environ['INSTANCE_TYPE']
+# entry point used by the endpoint; serve.py loads the TorchScript export without fastai
+serving_program = os.environ.get('SERVING_PROGRAM', 'serve.py')
 model_name = endpoint_name + "-model" + str(ctime)
 cfg_name = endpoint_name + "-cfg" + str(ctime)
 
@@ -41,7 +43,10 @@ def create_model(modelname, modelimage, modelurl, rolearn):
         ModelName=modelname,
         PrimaryContainer={
             'Image': modelimage,
-            'ModelDataUrl': modelurl
+            'ModelDataUrl': modelurl,
+            'Environment': {
+                'SAGEMAKER_PROGRAM': serving_program
+            }
         },
         ExecutionRoleArn=rolearn
     )
@@ -0,0 +1,150 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+ArchiveFn: stores the wafers published by the edge devices in S3.
+
+Invoked by two IoT rules (cfn/iot.yaml):
+
+    RawImgTopicRule      fabwafer/+/+/img/+, one base64 PNG per JSON message
+    WaferBatchTopicRule  fabwafer/+/+/wafers/+, a binary envelope (see
+                         wafer_payload.py) that the rule base64-encodes as 'data'
+
+Everything is uploaded from memory.  ARCHIVE_MODE selects the layout of
+bit-packed wafer batches:
+
+    shards   (default) one wafer-store shard per batch, partitioned by time:
+             <fab>/<camera>/shards/date=YYYY-MM-DD/hour=HH/<batch id>/
+             wafers.bin, index.npy and meta.json, the layout written by
+             wafer_store.WaferStoreWriter, so a downloaded shard opens with
+             wafer_store.WaferStore.  meta.json is written last and marks a
+             complete shard.  The wafers are unlabelled (label 255).
+    objects  <fab>/<camera>/<batch id>.wfm, the application/x-wafermap body,
+             plus <batch id>.json with the envelope header
+
+PNG payloads are always stored as <fab>/<camera>/<imgid>.png.  The fab/camera
+prefix is what CatalogFn (cfn/persistence.yaml) lists.
+
+Only boto3 and the standard library are needed.  The S3 client is created on
+first use and honours S3_ENDPOINT_URL, so the handler runs against a local
+S3 stand-in (moto, localstack); archive() also takes the client explicitly.
+"""
+import base64
+import json
+import os
+import struct
+import time
+
+import wafer_payload
+
+# Same order as wafer_store.CLASSES.
+CLASSES = ['Center',
+           'Donut',
+           'Edge-Loc',
+           'Edge-Ring',
+           'Loc',
+           'Near-full',
+           'Random',
+           'Scratch',
+           'none']
+
+UNLABELLED = 255
+
+# wafer_store.INDEX_DTYPE, written without numpy
+_INDEX_DESCR = "[('offset', '<u8'), ('rows', '<u2'), ('cols', '<u2'), ('label', '|u1')]"
+_INDEX_RECORD = struct.Struct('<QHHB')
+
+_s3 = None
+
+
+def s3_client():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None)
+    return _s3
+
+
+def packed_size(rows, cols):
+    return (int(rows) * int(cols) + 3) // 4
+
+
+def npy_index(records):
+    """index.npy contents (npy format 1.0) for (offset, rows, cols, label) records."""
+    header = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" % (_INDEX_DESCR, len(records))
+    # magic, version and header length take 10 bytes; the header ends in a newline and
+    # is padded with spaces so the data starts on a 64-byte boundary
+    header += ' ' * ((-(10 + len(header) + 1)) % 64) + '\n'
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1') +
+            b''.join(_INDEX_RECORD.pack(*r) for r in records))
+
+
+def shard_files(header, body):
+    """
+    Wafer-store files for a 'wafermap' envelope.  The application/x-wafermap
+    body already holds each wafer packed and padded to a whole byte, back to
+    back, which is exactly the layout of wafers.bin.
+    """
+    count = struct.unpack('<I', body[4:8])[0]
+    shapes = struct.unpack('<%dH' % (2 * count), body[8:8 + 4 * count])
+    data = body[8 + 4 * count:]
+    records = []
+    offset = 0
+    for i in range(count):
+        rows, cols = shapes[2 * i], shapes[2 * i + 1]
+        records.append((offset, rows, cols, UNLABELLED))
+        offset += packed_size(rows, cols)
+    if offset != len(data):
+        raise ValueError('Wafer data is {0} bytes, expected {1}'.format(len(data), offset))
+    meta = {'classes': CLASSES,
+            'count': count,
+            'fab': header['fab'],
+            'camera': header['camera'],
+            'images': [{'imgid': r['imgid'], 'timestamp': r['timestamp']} for r in header['images']]}
+    return [('wafers.bin', data),
+            ('index.npy', npy_index(records)),
+            ('meta.json', json.dumps(meta).encode('utf-8'))]
+
+
+def shard_prefix(header):
+    first = header['images'][0]
+    hour = time.gmtime(int(first['timestamp']))
+    return '{0}/{1}/shards/date={2}/hour={3}/{4}'.format(
+        header['fab'], header['camera'], time.strftime('%Y-%m-%d', hour), time.strftime('%H', hour), first['imgid'])
+
+
+def put(s3, bucket, key, body):
+    print("Uploading {0} bytes to s3://{1}/{2}".format(len(body), bucket, key))
+    s3.put_object(Bucket=bucket, Key=key, Body=body)
+
+
+def archive(event, s3, bucket, mode='shards'):
+    """Store the wafers of one rule invocation; returns the keys written."""
+    keys = []
+    if 'data' not in event:
+        key = "{0}/{1}/{2}.png".format(event['fab'], event['camera'], event['imgid'])
+        put(s3, bucket, key, base64.b64decode(event['bytes']))
+        return [key]
+
+    header, body = wafer_payload.decode_envelope(base64.b64decode(event['data']))
+    fab, camera = header['fab'], header['camera']
+    print("Received {0} {1} wafers from {2}/{3}".format(len(header['images']), header['encoding'], fab, camera))
+    if header['encoding'] == 'png':
+        for record, png in zip(header['images'], wafer_payload.split_png_body(header, body)):
+            keys.append("{0}/{1}/{2}.png".format(fab, camera, record['imgid']))
+            put(s3, bucket, keys[-1], png)
+    elif mode == 'shards':
+        prefix = shard_prefix(header)
+        for name, content in shard_files(header, body):
+            keys.append(prefix + '/' + name)
+            put(s3, bucket, keys[-1], content)
+    else:
+        batchid = header['images'][0]['imgid']
+        keys.append("{0}/{1}/{2}.wfm".format(fab, camera, batchid))
+        put(s3, bucket, keys[-1], body)
+        keys.append("{0}/{1}/{2}.json".format(fab, camera, batchid))
+        put(s3, bucket, keys[-1], json.dumps(header).encode('utf-8'))
+    return keys
+
+
+def handler(event, context):
+    archive(event, s3_client(), os.environ['ArchiveBucket'], os.environ.get('ARCHIVE_MODE', 'shards'))
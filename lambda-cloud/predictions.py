@@ -0,0 +1,142 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+PredictionBatchFn: stores classification records and keeps hourly rollups.
+
+Invoked by two IoT rules (cfn/iot.yaml):
+
+    ClassificationPersistenceTopicRule  fabwafer/+/+/prediction/+, one prediction per message
+    PredictionBatchTopicRule            fabwafer/+/+/predictions/+, a batch from the edge
+                                        device (see wafer_payload.py)
+
+Records go to the classification table with BatchWriteItem, 25 per request,
+and unprocessed items are retried with backoff.  For every (fab, camera, hour)
+in the invocation one UpdateItem adds the counts to the rollup table:
+
+    fab     hash key
+    bucket  range key, "<YYYY-MM-DDTHH>#<camera>" (UTC), so one Query per fab
+            and time range returns all cameras
+    camera, hour, total, defects and one n_<class> counter per class
+
+A dashboard reads O(buckets) rollup items instead of scanning every wafer.
+The counters are not idempotent: a retried invocation counts its batch twice.
+
+Batches that contain defects above DefectThreshold raise one SNS alarm;
+single messages are left to DefectAlarmTopicRule.
+
+Clients are created on first use and honour DYNAMODB_ENDPOINT_URL, so the
+handler runs against DynamoDB Local or moto; store() also takes them explicitly.
+"""
+import json
+import os
+import time
+from decimal import Decimal
+
+MAX_BATCH_WRITE = 25
+MAX_RETRIES = 8
+
+_clients = {}
+
+
+def client(name):
+    if name not in _clients:
+        import boto3
+        endpoint = os.environ.get('DYNAMODB_ENDPOINT_URL') if name == 'dynamodb' else None
+        _clients[name] = boto3.client(name, endpoint_url=endpoint or None)
+    return _clients[name]
+
+
+def records(event):
+    """Classification records of a single or a batched prediction message."""
+    if 'predictions' not in event:
+        return [event]
+    return [dict(p, fab=event['fab'], camera=event['camera']) for p in event['predictions']]
+
+
+def epoch_seconds(timestamp):
+    # the edge sends seconds, the sample messages in the README milliseconds
+    timestamp = float(timestamp)
+    return timestamp / 1000.0 if timestamp > 1e11 else timestamp
+
+
+def to_item(record):
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    record = json.loads(json.dumps(record), parse_float=Decimal)
+    return dict((k, serializer.serialize(v)) for k, v in record.items())
+
+
+def item_key(item):
+    # (type, value) of each key attribute; a timestamp sent as a string serializes as S, not N
+    return tuple(next(iter(item[name].items())) for name in ('imgid', 'timestamp'))
+
+
+def batch_write(ddb, table, items):
+    # a BatchWriteItem request may not hold the same key twice; keep the last record
+    unique = {}
+    for item in items:
+        unique[item_key(item)] = item
+    items = list(unique.values())
+    for start in range(0, len(items), MAX_BATCH_WRITE):
+        requests = {table: [{'PutRequest': {'Item': item}} for item in items[start:start + MAX_BATCH_WRITE]]}
+        for attempt in range(MAX_RETRIES):
+            response = ddb.batch_write_item(RequestItems=requests)
+            requests = response.get('UnprocessedItems') or {}
+            if not requests:
+                break
+            time.sleep(min(0.05 * 2 ** attempt, 2.0))
+        if requests:
+            raise Exception('{0} items left unprocessed in {1}'.format(len(requests[table]), table))
+    return len(items)
+
+
+def rollups(records, defect_class):
+    """Counts per (fab, camera, hour)."""
+    buckets = {}
+    for r in records:
+        hour = time.strftime('%Y-%m-%dT%H', time.gmtime(epoch_seconds(r['timestamp'])))
+        counts = buckets.setdefault((r['fab'], r['camera'], hour), {})
+        counts[r['prediction']] = counts.get(r['prediction'], 0) + 1
+    return dict((key, (counts, sum(n for cls, n in counts.items() if cls != defect_class)))
+                for key, counts in buckets.items())
+
+
+def update_rollups(ddb, table, buckets):
+    for (fab, camera, hour), (counts, defects) in buckets.items():
+        names = {'#total': 'total', '#defects': 'defects', '#camera': 'camera', '#hour': 'hour'}
+        values = {':total': {'N': str(sum(counts.values()))},
+                  ':defects': {'N': str(defects)},
+                  ':camera': {'S': camera},
+                  ':hour': {'S': hour}}
+        adds = ['#total :total', '#defects :defects']
+        for i, (cls, n) in enumerate(sorted(counts.items())):
+            names['#c%d' % i] = 'n_' + cls
+            values[':c%d' % i] = {'N': str(n)}
+            adds.append('#c%d :c%d' % (i, i))
+        ddb.update_item(TableName=table,
+                        Key={'fab': {'S': fab}, 'bucket': {'S': hour + '#' + camera}},
+                        UpdateExpression='SET #camera = :camera, #hour = :hour ADD ' + ', '.join(adds),
+                        ExpressionAttributeNames=names,
+                        ExpressionAttributeValues=values)
+
+
+def defects(records, threshold, defect_class):
+    return [r for r in records if float(r['probability']) > threshold and r['prediction'] != defect_class]
+
+
+def store(event, ddb, table, rollup_table, defect_class='none'):
+    """Persist the records of one rule invocation; returns them."""
+    rows = records(event)
+    written = batch_write(ddb, table, [to_item(r) for r in rows])
+    update_rollups(ddb, rollup_table, rollups(rows, defect_class))
+    print("Stored {0} predictions".format(written))
+    return rows
+
+
+def handler(event, context):
+    defect_class = os.environ.get('DefectClass', 'none')
+    rows = store(event, client('dynamodb'), os.environ['TblName'], os.environ['RollupTblName'], defect_class)
+    if 'predictions' in event:
+        alarms = defects(rows, float(os.environ['DefectThreshold']), defect_class)
+        if alarms:
+            client('sns').publish(TopicArn=os.environ['AlarmTopic'], Message=json.dumps(alarms))
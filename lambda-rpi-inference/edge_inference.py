@@ -0,0 +1,144 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Model loading and batched prediction for the edge device.
+
+Kept apart from greengrassObjectClassification.py, which starts the capture
+and publish threads when it is imported, so the same predict() can be loaded
+without Greengrass (see serving/benchmark.py).
+
+The network input follows model-input.json, written next to the model by
+notebooks/classify_mxnet.py: 224x224 RGB for resnet18_v2 (also assumed when
+the file is missing), or a single 64x64 channel of die states for wafernet.
+Frames are resized, cropped and normalised a batch at a time by
+wafer_preprocess.Preprocessor, built when the model is loaded.
+
+The FP32 model is loaded unless EDGE_INT8=1 and the artifact holds the
+x86-only INT8 export; an INT8 model this MxNet cannot run falls back to FP32.
+
+Runs on Python 2.7 (the Greengrass runtime) and 3.
+"""
+import json
+import os
+import time
+import warnings
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+
+import prediction_cache
+from wafer_preprocess import Preprocessor
+
+inference_batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', 4))
+# EDGE_INT8=1 loads the INT8 export of the artifact, built for x86 cores with MKL-DNN
+use_int8 = os.environ.get('EDGE_INT8', '0') == '1'
+ctx = [mx.cpu()]
+# optional cache of predictions for repeated wafers, see prediction_cache.py
+cache = prediction_cache.from_env()
+synsets = ['Center',
+ 'Donut',
+ 'Edge-Loc',
+ 'Edge-Ring',
+ 'Loc',
+ 'Near-full',
+ 'Random',
+ 'Scratch',
+ 'none']
+# input of resnet18_v2, used for models exported without model-input.json
+input_spec = {'network': 'resnet18_v2', 'channels': 3, 'size': 224, 'resize': 256,
+              'interpolation': 'bilinear', 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
+preprocess = Preprocessor(input_spec)
+
+def load_input_spec(mpath):
+    """Set the input of the model in mpath, before any frame is preprocessed."""
+    global input_spec, preprocess
+    path = os.path.join(mpath, "model-input.json")
+    if os.path.exists(path):
+        with open(path) as fin:
+            input_spec = json.load(fin)
+        preprocess = Preprocessor(input_spec)
+    print("Model input: {0} channel(s) at {1}x{1}".format(input_spec['channels'], input_spec['size']))
+
+def load_model(mpath):
+    load_input_spec(mpath)
+    model, prefix = None, "model"
+    # the INT8 model written by export_quantized only on request: its MKL-DNN operators are
+    # missing from ARM builds such as the Raspberry Pi's, and may only fail when the graph runs
+    if use_int8 and os.path.exists(os.path.join(mpath, "model-int8-x86-symbol.json")):
+        try:
+            model, prefix = import_model(mpath, "model-int8-x86"), "model-int8-x86"
+            forward(model, blank_batch())
+        except Exception as e:
+            print("INT8 model not usable with this MxNet ({0}), loading the FP32 model".format(e))
+            model, prefix = None, "model"
+    if model is None:
+        model = import_model(mpath, prefix)
+    if cache is not None:
+        cache.set_model_version(prediction_cache.file_digest(
+            [os.path.join(mpath, prefix + "-symbol.json"), os.path.join(mpath, prefix + "-0000.params")]))
+    return model
+
+def import_model(mpath, prefix):
+    print("Loading model " + prefix)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = gluon.nn.SymbolBlock.imports(
+            os.path.join(mpath, prefix + "-symbol.json"),
+            ['data'],
+            os.path.join(mpath, prefix + "-0000.params"),
+            ctx=ctx)
+
+    # batches are padded to inference_batch_size, so the graph always sees one shape
+    # and its memory can be allocated once
+    try:
+        model.hybridize(static_alloc=True, static_shape=True)
+    except Exception as e:
+        print("Static graph not supported by this MxNet ({0}), hybridizing without it".format(e))
+        model.hybridize()
+    return model
+
+def blank_batch():
+    size = input_spec['size']
+    return [np.zeros((size, size, input_spec['channels']), dtype=np.uint8)] * inference_batch_size
+
+def warm_up(net, passes):
+    # the first forward passes build the graph and allocate memory; pay for them before real wafers arrive
+    blank = blank_batch()
+    for i in range(passes):
+        tic = time.time()
+        forward(net, blank)
+        print("Warm-up pass {0} took {1:.3f} seconds".format(i, time.time() - tic))
+
+def to_array(im_frame):
+    """The (H, W, channels) uint8 pixels of a decoded PIL image; predict() resizes them."""
+    if input_spec['channels'] == 1:
+        return np.array(im_frame.convert("L"))[:, :, None]
+    return np.array(im_frame.convert("RGB"))
+
+def predict(net, data):
+    """Class indices for a batch of images made by to_array."""
+    keys = [cache.key(x) for x in data] if cache is not None else None
+    responses = [cache.get(k) for k in keys] if cache is not None else [None] * len(data)
+    misses = [i for i, r in enumerate(responses) if r is None]
+    if cache is not None and len(misses) < len(data):
+        print("Prediction cache hit: " + json.dumps(cache.stats()))
+    if not misses:
+        return responses
+
+    prediction = forward(net, [data[i] for i in misses])
+    for i, response in zip(misses, prediction):
+        responses[i] = response
+        if cache is not None:
+            cache.put(keys[i], response)
+    return responses
+
+def forward(net, data):
+    """Class indices for a list of images, run in batches padded to inference_batch_size."""
+    prediction = []
+    for start in range(0, len(data), inference_batch_size):
+        chunk = data[start:start + inference_batch_size]
+        img = mx.nd.array(preprocess(chunk, pad_to=inference_batch_size), ctx=ctx[0])
+        output = net(img)
+        prediction += mx.nd.argmax(output, axis=1).asnumpy().astype(int).tolist()[:len(chunk)]
+    return prediction
@@ -0,0 +1,88 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+On-device latency metrics.
+
+LatencyWindow keeps the last `window` latencies of each (camera, stage) pair
+and reports their count, mean and p50/p95/p99 in milliseconds.  The edge
+module publishes a snapshot per camera on fabwafer/<fab>/<camera>/metrics
+every METRICS_INTERVAL seconds, so slow cores stand out across the fleet:
+
+    {"fab": ..., "camera": ..., "timestamp": ..., "startup": {...},
+     "stages": {"decode": {"count": ..., "mean_ms": ..., "p50_ms": ..., "p95_ms": ..., "p99_ms": ...}, ...}}
+
+Runs on Python 2.7 (the Greengrass runtime) and 3.
+"""
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+STAGES = ['decode', 'preprocess', 'inference', 'publish']
+
+
+class LatencyWindow(object):
+    def __init__(self, window=1024):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, camera, stage, seconds):
+        with self._lock:
+            samples = self._samples.get((camera, stage))
+            if samples is None:
+                samples = self._samples[(camera, stage)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def cameras(self):
+        with self._lock:
+            return sorted(set(camera for camera, _ in self._samples))
+
+    def snapshot(self, camera):
+        with self._lock:
+            samples = dict((stage, np.array(values)) for (cam, stage), values in self._samples.items()
+                           if cam == camera and values)
+        stages = {}
+        for stage, values in samples.items():
+            p50, p95, p99 = np.percentile(values * 1000, [50, 95, 99])
+            stages[stage] = {'count': int(values.size),
+                             'mean_ms': round(float(values.mean() * 1000), 3),
+                             'p50_ms': round(float(p50), 3),
+                             'p95_ms': round(float(p95), 3),
+                             'p99_ms': round(float(p99), 3)}
+        return stages
+
+
+class StageTimer(object):
+    """Context manager recording the elapsed time of a block for one or more cameras."""
+
+    def __init__(self, latencies, cameras, stage):
+        self.latencies = latencies
+        self.cameras = cameras
+        self.stage = stage
+
+    def __enter__(self):
+        self.tic = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.tic
+        for camera in self.cameras:
+            self.latencies.observe(camera, self.stage, elapsed)
+
+
+def start_reporter(latencies, publish, interval):
+    """Call publish(camera, stages) for every camera with samples, every `interval` seconds."""
+    def run():
+        while True:
+            time.sleep(interval)
+            for camera in latencies.cameras():
+                try:
+                    publish(camera, latencies.snapshot(camera))
+                except Exception as e:
+                    print("Could not publish metrics for {0}: {1}".format(camera, e))
+    thread = threading.Thread(target=run, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return thread
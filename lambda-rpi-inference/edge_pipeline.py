@@ -0,0 +1,120 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Long-lived, multi-threaded processing pipeline for the edge device.
+
+A pipeline is a chain of stages.  Each stage has its own bounded queue and a
+number of worker threads; a worker takes up to `batch_size` items from its
+queue, calls the stage function with the list and puts whatever the function
+returns on the next stage's queue.  When a queue is full, put blocks, so a
+slow stage (normally inference) throttles everything in front of it instead of
+letting frames pile up in memory.
+
+Runs on Python 2.7 (the Greengrass runtime) and 3.
+"""
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_STOP = object()
+
+
+class Stage(object):
+    def __init__(self, name, fn, workers=1, batch_size=1, queue_size=8):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'processed': self.processed,
+                'errors': self.errors,
+                'busy_sec': round(self.busy_time, 3)}
+
+
+class Pipeline(object):
+    def __init__(self):
+        self.stages = []
+
+    def add_stage(self, name, fn, workers=1, batch_size=1, queue_size=8):
+        """
+        Append a stage.
+
+        :param fn: called with a list of up to `batch_size` items; returns the items for the next stage
+        :param workers: worker threads taking from this stage's queue
+        :param queue_size: bound of the stage's input queue
+        """
+        self.stages.append(Stage(name, fn, workers, batch_size, queue_size))
+        return self
+
+    def put(self, item, timeout=None):
+        """Feed the first stage; blocks while its queue is full."""
+        self.stages[0].queue.put(item, timeout=timeout)
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name='{0}-{1}'.format(stage.name, i))
+                thread.daemon = True
+                thread.start()
+                stage.threads.append(thread)
+        return self
+
+    def stop(self):
+        """Drain the pipeline stage by stage and stop the workers."""
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = []
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        stopping = False
+        while not stopping:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            items = [item]
+            # batch whatever is already waiting, without holding up the first item
+            while len(items) < stage.batch_size:
+                try:
+                    item = stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+
+            tic = time.time()
+            try:
+                results = stage.fn(items) or []
+            except Exception as e:
+                with stage._lock:
+                    stage.errors += len(items)
+                print("Stage {0} failed on {1} items: {2}".format(stage.name, len(items), e))
+                continue
+            with stage._lock:
+                stage.processed += len(items)
+                stage.busy_time += time.time() - tic
+            if following is not None:
+                for result in results:
+                    following.queue.put(result)
@@ -1,133 +1,178 @@
 # Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import warnings
 import time
 import greengrasssdk
 import os
-from threading import Timer
+import threading
 import random
 import json
-import base64
 import io
-import mxnet as mx
-from mxnet import gluon
 from PIL import Image
 import numpy as np
+from edge_pipeline import Pipeline
+from wafer_store import PNG_SCALE
+import wafer_payload
+import edge_metrics
+from edge_metrics import StageTimer
+import watch_folder
+from edge_inference import inference_batch_size, synsets, load_model, warm_up, to_array, predict
 
 client = greengrasssdk.client('iot-data')
 model_path = '/greengrass-machine-learning/mxnet/wafers/'
 fabid = os.environ['FABID']
 cameraid = os.environ['CAMERAID']
-interval = int(os.environ['INTERVAL'])
-test_files = [os.path.join(dp, f) for dp, dn, fn in os.walk('/volumes/images') for f in fn]
-ctx = [mx.cpu()]
-synsets = ['Center',
- 'Donut',
- 'Edge-Loc',
- 'Edge-Ring',
- 'Loc',
- 'Near-full',
- 'Random',
- 'Scratch',
- 'none']
+interval = float(os.environ['INTERVAL'])
+# several cameras per core as "camera=folder,camera=folder"; by default one camera reading /volumes/images
+cameras = [tuple(c.split('=', 1)) for c in os.environ.get('CAMERAS', '').split(',') if c] or \
+    [(cameraid, '/volumes/images')]
+decode_workers = int(os.environ.get('DECODE_WORKERS', 2))
+publish_workers = int(os.environ.get('PUBLISH_WORKERS', 2))
+queue_size = int(os.environ.get('QUEUE_SIZE', 8))
+# wire format, see wafer_payload.py: 'wafermap' sends bit-packed die states, 'png' the original files
+payload_encoding = os.environ.get('PAYLOAD_ENCODING', 'wafermap')
+payload_compress = os.environ.get('PAYLOAD_COMPRESS', '1') == '1'
+batch_max_items = int(os.environ.get('BATCH_MAX_ITEMS', 32))
+batch_max_wait = float(os.environ.get('BATCH_MAX_WAIT', 5))
+# forward passes on blank input before the first wafer, and how often stage latencies are published
+warmup_passes = int(os.environ.get('WARMUP_PASSES', 3))
+metrics_interval = float(os.environ.get('METRICS_INTERVAL', 60))
+# 'random' replays images already in the camera folders every INTERVAL seconds;
+# 'watch' classifies each new file once, as it lands (see watch_folder.py)
+ingest_mode = os.environ.get('INGEST_MODE', 'random')
+poll_interval = float(os.environ.get('POLL_INTERVAL', 1))
+processed_action = os.environ.get('PROCESSED_ACTION', 'keep')
+processed_dir = os.environ.get('PROCESSED_DIR', '/volumes/images/processed')
+latencies = edge_metrics.LatencyWindow()
+startup = {}
 
-def load_model(mpath):
-    print("Loading model")
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        model = gluon.nn.SymbolBlock.imports(
-            os.path.join(model_path, "model-symbol.json"), 
-            ['data'], 
-            os.path.join(model_path, "model-0000.params"), 
-            ctx=ctx)
+# Pipeline stages.  Each gets a list of frames (dicts) and returns the frames for the next stage.
+def decode_frames(frames):
+    for frame in frames:
+        with StageTimer(latencies, [frame['camera']], 'decode'):
+            with open(frame['path'], "rb") as imageFile:
+                frame['bytes'] = imageFile.read()
+            im_frame = Image.open(io.BytesIO(frame['bytes']))
+            if payload_encoding == 'wafermap':
+                # the PNGs hold die states scaled by PNG_SCALE
+                gray = np.asarray(im_frame.convert("L"), dtype=np.float32)
+                frame['wafer'] = np.clip(np.rint(gray / PNG_SCALE), 0, 2).astype(np.uint8)
+                del frame['bytes']
+        with StageTimer(latencies, [frame['camera']], 'preprocess'):
+            frame['array'] = to_array(im_frame)
+    return frames
 
-    return model
+def infer_frames(model):
+    def infer(frames):
+        with StageTimer(latencies, set(frame['camera'] for frame in frames), 'inference'):
+            responses = predict(model, [frame.pop('array') for frame in frames])
+        for frame, response in zip(frames, responses):
+            frame['prediction'] = synsets[int(response)]
+        return frames
+    return infer
 
-def predict(net, data):
-    print("Starting predict method")
-    normalize = gluon.data.vision.transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    test_augs = gluon.data.vision.transforms.Compose([
-        # gluon.data.vision.transforms.Resize(256),
-        # gluon.data.vision.transforms.CenterCrop(224),
-        gluon.data.vision.transforms.ToTensor(),
-        normalize])
-    print("Set up augmentations")
-    
-    #nda = mx.img.imdecode(data)
-    print("Data shape: " + str(data.shape))
-    nda = mx.nd.array(data)
-    print("NDA shape: " + str(nda.shape))
-    img = test_augs(nda)
-    print("Image shape: " + str(img.shape))
-    img = img.expand_dims(axis=0)                
-    img = img.astype('float32') # for gpu context
-    print("Image shape: " + str(img.shape))
-    
-    output = net(img)
-    prediction = mx.nd.argmax(output, axis=1)
-    response = prediction.asnumpy().tolist()[0]
-    return response
+def publish_frames(frames):
+    for frame in frames:
+        record = {'imgid': frame['imgid'], 'timestamp': frame['timestamp']}
+        images.add(frame['camera'], (record, frame.get('wafer'), frame.get('bytes')))
+        prediction = dict(record, prediction=frame['prediction'], probability=50.0)
+        predictions.add(frame['camera'], prediction)
+        if ingest_mode == 'watch':
+            watch_folder.finish(frame['path'], processed_action, os.path.join(processed_dir, frame['camera']))
+    return []
 
-# When deployed to a Greengrass core, this code will be executed immediately
-# as a long-lived lambda function.  The code will enter the infinite while loop
-# below.
-def greengrass_object_classification_run(model):
-    print("running inference loop")
-
-    test_file = random.choice(test_files)
-    print("Running inference on {0}".format(test_file))
-    fname = os.path.split(test_file)[1]
-    imgid = os.path.splitext(fname)[0] + '_' + str(int(time.time()))
+def publish_images(camera, batch):
+    records = [record for record, _, _ in batch]
+    if payload_encoding == 'wafermap':
+        payload = wafer_payload.encode_images(fabid, camera, records, wafers=[w for _, w, _ in batch],
+                                              compress=payload_compress)
+    else:
+        payload = wafer_payload.encode_images(fabid, camera, records, pngs=[b for _, _, b in batch],
+                                              compress=payload_compress)
+    topicPath="fabwafer/{0}/{1}/wafers/{2}".format(fabid, camera, records[0]['imgid'])
+    print("Publishing {0} wafers in {1} bytes to {2}".format(len(batch), len(payload), topicPath))
+    with StageTimer(latencies, [camera], 'publish'):
+        client.publish(
+            topic=topicPath,
+            payload=payload
+        )
 
-    imgpayload = {}
-    imgpayload['imgid'] = imgid 
-    imgpayload['timestamp'] = str(int(time.time()))
-    imgpayload['fab'] = fabid
-    imgpayload['camera'] = cameraid
-    print("Payload before image bytes: " + json.dumps(imgpayload))
+def publish_predictions(camera, batch):
+    topicPath="fabwafer/{0}/{1}/predictions/{2}".format(fabid, camera, batch[0]['imgid'])
+    print("Publishing {0} predictions to {1}".format(len(batch), topicPath))
+    with StageTimer(latencies, [camera], 'publish'):
+        client.publish(
+            topic=topicPath,
+            payload=wafer_payload.encode_predictions(fabid, camera, batch)
+        )
 
-    with open(test_file, "rb") as imageFile:
-        imgpayload['bytes'] = base64.b64encode(imageFile.read())
-        print(imgpayload['bytes'])
-
-    topicPath="fabwafer/{0}/{1}/img/{2}".format(fabid, cameraid, imgid)
-    print("Publishing to topic " + topicPath)
+def publish_metrics(camera, stages):
+    topicPath="fabwafer/{0}/{1}/metrics".format(fabid, camera)
     client.publish(
         topic=topicPath,
-        payload=json.dumps(imgpayload)
+        payload=json.dumps({'fab': fabid,
+                            'camera': camera,
+                            'timestamp': int(time.time()),
+                            'startup': startup,
+                            'stages': stages,
+                            'pipeline': pipeline.stats()})
     )
-    print("Published to topic " + topicPath)
 
+# batches per camera, published when full or after batch_max_wait seconds
+images = wafer_payload.Aggregator(publish_images, batch_max_items, batch_max_wait)
+predictions = wafer_payload.Aggregator(publish_predictions, batch_max_items, batch_max_wait)
 
-    print("Calling inference model")
-    im_frame = Image.open(test_file)
-    im_frame = im_frame.resize((224,224), resample=Image.BILINEAR)
-    imrgb = im_frame.convert("RGB")
-    im2arr = np.array(imrgb)
-    print("Data passed to model has shape " + str(im2arr.shape))
-    response = int(predict(model, im2arr))
-    print("Got inference response " + str(response))
-    topicPath="fabwafer/{0}/{1}/prediction/{2}".format(fabid, cameraid, imgid)
-    predpayload = {}
-    predpayload['imgid'] = imgid 
-    predpayload['timestamp'] = int(time.time())
-    predpayload['fab'] = fabid
-    predpayload['camera'] = cameraid
-    predpayload['prediction'] = synsets[response]
-    predpayload['probability'] = 50.0
-    print("Prediction payload: " + json.dumps(predpayload))
-    client.publish(
-        topic=topicPath,
-        payload=json.dumps(predpayload)
-    )
+def build_pipeline(model):
+    # a single inference worker: the model is shared, and batching is what scales it
+    return Pipeline() \
+        .add_stage('decode', decode_frames, workers=decode_workers, queue_size=queue_size) \
+        .add_stage('inference', infer_frames(model), batch_size=inference_batch_size, queue_size=queue_size) \
+        .add_stage('publish', publish_frames, workers=publish_workers, queue_size=queue_size)
+
+def new_frame(camera, path):
+    fname = os.path.split(path)[1]
+    timestamp = int(time.time())
+    return {'camera': camera,
+            'path': path,
+            'timestamp': timestamp,
+            'imgid': os.path.splitext(fname)[0] + '_' + str(timestamp)}
+
+# Simulated camera: picks an image from its folder every `interval` seconds.
+# put blocks while the pipeline is full, so a camera never runs ahead of the model.
+def capture_loop(camera, image_dir, pipeline):
+    test_files = [os.path.join(dp, f) for dp, dn, fn in os.walk(image_dir) for f in fn]
+    print("Camera {0} reading {1} images from {2}".format(camera, len(test_files), image_dir))
+    while True:
+        tic = time.time()
+        pipeline.put(new_frame(camera, random.choice(test_files)))
+        time.sleep(max(0.0, interval - (time.time() - tic)))
 
-    # Asynchronously schedule this function to be run again in 3 seconds
-    Timer(interval, greengrass_object_classification_run, args=[model]).start()
+# When deployed to a Greengrass core, this code will be executed immediately
+# as a long-lived lambda function.  The capture threads and pipeline workers
+# keep running after the import returns.
+def greengrass_object_classification_run(model):
+    print("running inference pipeline")
+    pipeline = build_pipeline(model).start()
+    edge_metrics.start_reporter(latencies, publish_metrics, metrics_interval)
+    for camera, image_dir in cameras:
+        if ingest_mode == 'watch':
+            # put blocks while the pipeline is full; inotify keeps queueing events meanwhile
+            watch_folder.WatchFolder(image_dir, lambda path, camera=camera: pipeline.put(new_frame(camera, path)),
+                                     poll_interval=poll_interval).start()
+            continue
+        thread = threading.Thread(target=capture_loop, args=(camera, image_dir, pipeline),
+                                  name='capture-' + camera)
+        thread.start()
+    return pipeline
 
 # Execute the function above
+tic = time.time()
 model = load_model(model_path)
-greengrass_object_classification_run(model)
+startup['load_sec'] = round(time.time() - tic, 3)
+tic = time.time()
+warm_up(model, warmup_passes)
+startup['warmup_sec'] = round(time.time() - tic, 3)
+pipeline = greengrass_object_classification_run(model)
 
 # This is a dummy handler and will not be invoked
 # Instead the code above will be executed in an infinite loop for our example
@@ -0,0 +1,146 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Compact MQTT payloads from the edge device.
+
+Wafers are published in batches on fabwafer/<fab>/<camera>/wafers/<batch id>,
+in a binary envelope rather than base64 inside JSON:
+
+    magic        b'WFE\\x01'
+    flags        uint8; bit 0 is set when the body is zlib-compressed
+    header size  uint32, little endian
+    header       UTF-8 JSON: fab, camera, encoding and one {imgid, timestamp}
+                 record per wafer under 'images'
+    body         encoding 'wafermap': an application/x-wafermap payload, two
+                 bits per die (see wafer_store.encode_wafermaps)
+                 encoding 'png': the image files back to back; each image
+                 record also carries its 'size'
+
+decode_envelope and split_png_body only use the standard library, so the
+cloud consumers (lambda-cloud/archive.py) can parse them without numpy;
+wafer_store.decode_wafermaps turns a 'wafermap' body back into arrays.
+
+Predictions are small and stay JSON, batched on
+fabwafer/<fab>/<camera>/predictions/<batch id>:
+
+    {"fab": ..., "camera": ..., "predictions": [{"imgid", "timestamp", "prediction", "probability"}, ...]}
+
+Aggregator collects both kinds per camera and publishes a batch when it is
+full or its oldest entry has waited long enough.
+
+Runs on Python 2.7 (the Greengrass runtime) and 3, and is shipped with the
+edge code (lambda-rpi-inference) and the cloud functions (lambda-cloud); keep
+the copies identical.
+"""
+import json
+import struct
+import threading
+import time
+import zlib
+
+ENVELOPE_MAGIC = b'WFE\x01'
+FLAG_ZLIB = 1
+_PREFIX = struct.Struct('<BI')
+
+
+def encode_envelope(header, body, compress=False, level=6):
+    """Wrap a JSON-serialisable header and a binary body; zlib is only kept when it makes the body smaller."""
+    flags = 0
+    if compress:
+        packed = zlib.compress(body, level)
+        if len(packed) < len(body):
+            body, flags = packed, FLAG_ZLIB
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return ENVELOPE_MAGIC + _PREFIX.pack(flags, len(header)) + header + body
+
+
+def decode_envelope(buf):
+    """Inverse of encode_envelope; returns (header, body) with the body decompressed."""
+    if buf[:4] != ENVELOPE_MAGIC:
+        raise ValueError('Not a wafer envelope')
+    flags, size = _PREFIX.unpack(buf[4:4 + _PREFIX.size])
+    start = 4 + _PREFIX.size
+    header = json.loads(buf[start:start + size].decode('utf-8'))
+    body = buf[start + size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return header, body
+
+
+def encode_images(fab, camera, records, wafers=None, pngs=None, compress=True):
+    """
+    Envelope for a batch of wafers.
+
+    :param records: one dict per wafer with at least imgid and timestamp
+    :param wafers: 2-D die-state arrays, sent bit-packed (encoding 'wafermap')
+    :param pngs: encoded image files, sent as they are (encoding 'png'); used when wafers is None
+    """
+    records = [dict(r) for r in records]
+    if wafers is not None:
+        from wafer_store import encode_wafermaps
+        encoding, body = 'wafermap', encode_wafermaps(wafers)
+    else:
+        for record, png in zip(records, pngs):
+            record['size'] = len(png)
+        encoding, body = 'png', b''.join(pngs)
+    header = {'fab': fab, 'camera': camera, 'encoding': encoding, 'images': records}
+    return encode_envelope(header, body, compress)
+
+
+def split_png_body(header, body):
+    """The individual image files of a 'png' envelope."""
+    files = []
+    offset = 0
+    for record in header['images']:
+        files.append(body[offset:offset + record['size']])
+        offset += record['size']
+    return files
+
+
+def encode_predictions(fab, camera, predictions):
+    return json.dumps({'fab': fab, 'camera': camera, 'predictions': predictions}, separators=(',', ':'))
+
+
+class Aggregator(object):
+    """
+    Buffers items per key and calls flush(key, items) when max_items are
+    buffered or the oldest item is max_wait seconds old.  flush runs outside
+    the lock, from the adding thread or from the aggregator's timer thread.
+    """
+
+    def __init__(self, flush, max_items=32, max_wait=5.0):
+        self.flush = flush
+        self.max_items = max(1, max_items)
+        self.max_wait = max_wait
+        self._buffers = {}
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name='aggregator')
+        thread.daemon = True
+        thread.start()
+
+    def add(self, key, item):
+        with self._lock:
+            first, items = self._buffers.setdefault(key, (time.time(), []))
+            items.append(item)
+            batch = self._buffers.pop(key)[1] if len(items) >= self.max_items else None
+        if batch is not None:
+            self._flush(key, batch)
+
+    def flush_all(self, older_than=0.0):
+        now = time.time()
+        with self._lock:
+            keys = [k for k, (first, _) in self._buffers.items() if now - first >= older_than]
+            batches = [(k, self._buffers.pop(k)[1]) for k in keys]
+        for key, batch in batches:
+            self._flush(key, batch)
+
+    def _flush(self, key, batch):
+        try:
+            self.flush(key, batch)
+        except Exception as e:
+            print("Dropped a batch of {0} for {1}: {2}".format(len(batch), key, e))
+
+    def _run(self):
+        while True:
+            time.sleep(min(max(self.max_wait / 4.0, 0.05), 1.0))
+            self.flush_all(self.max_wait)
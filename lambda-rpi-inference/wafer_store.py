@@ -0,0 +1,260 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Packed, memory-mapped wafer-map store.
+
+Wafer maps only hold three die states (0 = no die, 1 = pass, 2 = fail), so each
+die is packed into 2 bits, four dies per byte.  A store is a directory with:
+
+    wafers.bin   all packed maps back to back
+    index.npy    one (offset, rows, cols, label) record per wafer
+    meta.json    class names and wafer count
+
+The data file is opened with numpy.memmap, so reading a sample is a slice of
+the mapped file rather than a PNG decode plus a handful of file system calls.
+
+This module only depends on numpy, runs on Python 2.7 (the Greengrass
+runtime) and 3, and is shipped with each deployment directory (notebooks,
+pytorch_code/classifier, lambda-rpi-inference, test_code); keep the copies
+identical.
+
+Usage:
+    python wafer_store.py raw-data/LSWMD.pkl vdata-packed [--seed 42]
+
+The same packing is used on the wire by the application/x-wafermap content
+type (see encode_wafermaps).
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+DATA_FILE = 'wafers.bin'
+INDEX_FILE = 'index.npy'
+META_FILE = 'meta.json'
+
+# Same order as the class folders written by DataPrep.ipynb and manifest.sh.
+CLASSES = ['Center',
+           'Donut',
+           'Edge-Loc',
+           'Edge-Ring',
+           'Loc',
+           'Near-full',
+           'Random',
+           'Scratch',
+           'none']
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'),
+                        ('rows', '<u2'),
+                        ('cols', '<u2'),
+                        ('label', 'u1')])
+
+# Scale used by writeImgToDisk when exporting PNGs (floor(255 / 2)).
+PNG_SCALE = 127
+
+_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+WAFERMAP_CONTENT_TYPE = 'application/x-wafermap'
+WAFERMAP_MAGIC = b'WFM\x01'
+
+
+def packed_size(rows, cols):
+    return (int(rows) * int(cols) + 3) // 4
+
+
+def pack_wafer(wafer):
+    """Pack a 2-D array of 0/1/2 die states into 2 bits per die."""
+    flat = np.ascontiguousarray(wafer, dtype=np.uint8).ravel()
+    pad = (-flat.size) % 4
+    if pad:
+        flat = np.concatenate([flat, np.zeros(pad, dtype=np.uint8)])
+    quads = flat.reshape(-1, 4)
+    return (quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)).astype(np.uint8)
+
+
+def unpack_wafer(packed, rows, cols, out=None):
+    """Unpack 2-bit die states into a (rows, cols) uint8 array, optionally into `out`."""
+    n = int(rows) * int(cols)
+    quads = (np.asarray(packed, dtype=np.uint8)[:, None] >> _SHIFTS) & 3
+    flat = quads.reshape(-1)[:n]
+    if out is None:
+        return flat.reshape(rows, cols)
+    out.reshape(-1)[:] = flat
+    return out
+
+
+def encode_wafermaps(wafers):
+    """
+    Serialize wafer maps as application/x-wafermap:
+
+        magic   b'WFM\\x01'
+        count   uint32, little endian
+        shapes  count x (rows uint16, cols uint16)
+        data    each wafer packed 2 bits per die, padded to a whole byte
+    """
+    wafers = [np.asarray(w) for w in wafers]
+    header = WAFERMAP_MAGIC + struct.pack('<I', len(wafers))
+    shapes = np.array([w.shape for w in wafers], dtype='<u2').reshape(-1, 2)
+    return b''.join([header, shapes.tobytes()] + [pack_wafer(w).tobytes() for w in wafers])
+
+
+def decode_wafermaps(buf):
+    """Inverse of encode_wafermaps; returns a (N, rows, cols) array when all shapes match, else a list."""
+    buf = memoryview(buf)
+    if buf[:4].tobytes() != WAFERMAP_MAGIC:
+        raise ValueError('Not an application/x-wafermap payload')
+    count = struct.unpack('<I', buf[4:8].tobytes())[0]
+    shapes = np.frombuffer(buf, dtype='<u2', count=2 * count, offset=8).reshape(count, 2)
+    data = np.frombuffer(buf, dtype=np.uint8, offset=8 + 4 * count)
+    if count and (shapes == shapes[0]).all():
+        # one vectorised unpack for the common case of a uniform batch
+        rows, cols = int(shapes[0, 0]), int(shapes[0, 1])
+        size = packed_size(rows, cols)
+        packed = data[:count * size].reshape(count, size)
+        quads = (packed[:, :, None] >> _SHIFTS) & 3
+        return quads.reshape(count, -1)[:, :rows * cols].reshape(count, rows, cols)
+    wafers = []
+    offset = 0
+    for rows, cols in shapes:
+        size = packed_size(rows, cols)
+        wafers.append(unpack_wafer(data[offset:offset + size], rows, cols))
+        offset += size
+    return wafers
+
+
+def label_name(failure_type):
+    """Return the class name from an LSWMD `failureType` cell, or None if unlabelled."""
+    values = np.asarray(failure_type).ravel()
+    if values.size == 0:
+        return None
+    name = str(values[0])
+    return name if name in CLASSES else None
+
+
+def stratified_split(labels, seed=0, test_size=0.2, valid_size=0.2):
+    """
+    Deterministic stratified train/valid/test split, mirroring the two
+    train_test_split calls in DataPrep.ipynb.
+
+    :return: dict of split name to sorted index array
+    """
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    splits = {'train': [], 'valid': [], 'test': []}
+    for cls in np.unique(labels):
+        idx = np.flatnonzero(labels == cls)
+        rng.shuffle(idx)
+        n_test = int(round(len(idx) * test_size))
+        n_valid = int(round((len(idx) - n_test) * valid_size))
+        splits['test'].append(idx[:n_test])
+        splits['valid'].append(idx[n_test:n_test + n_valid])
+        splits['train'].append(idx[n_test + n_valid:])
+    return {name: np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+            for name, parts in splits.items()}
+
+
+class WaferStoreWriter(object):
+    """Append wafer maps to a new store directory."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._data = open(os.path.join(path, DATA_FILE), 'wb')
+        self._index = []
+        self._offset = 0
+
+    def add(self, wafer, label):
+        wafer = np.asarray(wafer)
+        rows, cols = wafer.shape
+        packed = pack_wafer(wafer)
+        self._data.write(packed.tobytes())
+        self._index.append((self._offset, rows, cols, label))
+        self._offset += packed.size
+
+    def close(self):
+        self._data.close()
+        np.save(os.path.join(self.path, INDEX_FILE), np.array(self._index, dtype=INDEX_DTYPE))
+        with open(os.path.join(self.path, META_FILE), 'w') as fout:
+            json.dump({'classes': CLASSES, 'count': len(self._index)}, fout)
+        print("Wrote {0} wafers to {1}".format(len(self._index), self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WaferStore(object):
+    """Read-only view over a store directory written by WaferStoreWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = np.load(os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, META_FILE)) as fin:
+            self.classes = json.load(fin)['classes']
+        data_path = os.path.join(path, DATA_FILE)
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    def shape(self, i):
+        rec = self.index[i]
+        return int(rec['rows']), int(rec['cols'])
+
+    def packed(self, i):
+        """Packed bytes of wafer `i` as a view into the memory map (no copy)."""
+        rec = self.index[i]
+        start = int(rec['offset'])
+        return self.data[start:start + packed_size(rec['rows'], rec['cols'])]
+
+    def wafer(self, i, out=None):
+        rows, cols = self.shape(i)
+        return unpack_wafer(self.packed(i), rows, cols, out=out)
+
+    def __getitem__(self, i):
+        return self.wafer(i), int(self.index[i]['label'])
+
+
+def convert(pkl_path, out_dir, seed=0, test_size=0.2, valid_size=0.2):
+    """Write train/valid/test stores from LSWMD.pkl, using the DataPrep split."""
+    import pandas as pd
+
+    dataset = pd.read_pickle(pkl_path)
+    names = dataset['failureType'].apply(label_name)
+    labelled = dataset[names.notnull()]
+    labels = np.array([CLASSES.index(n) for n in names[names.notnull()]], dtype=np.uint8)
+    wafers = labelled['waferMap'].values
+
+    for split, idx in stratified_split(labels, seed, test_size, valid_size).items():
+        with WaferStoreWriter(os.path.join(out_dir, split)) as writer:
+            for i in idx:
+                writer.add(wafers[i], labels[i])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkl', type=str, help='path to LSWMD.pkl')
+    parser.add_argument('out_dir', type=str, help='output folder; one store per split is written below it')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the stratified split (default: 0)')
+    parser.add_argument('--test-size', type=float, default=0.2, help='fraction held out for test (default: 0.2)')
+    parser.add_argument('--valid-size', type=float, default=0.2,
+                        help='fraction of the remainder held out for validation (default: 0.2)')
+    args = parser.parse_args()
+
+    convert(args.pkl, args.out_dir, args.seed, args.test_size, args.valid_size)
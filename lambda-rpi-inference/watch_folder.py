@@ -0,0 +1,201 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Watch-folder ingestion for the edge device.
+
+WatchFolder calls back once for every file that is completed in a folder
+after the watcher started.  On Linux it uses inotify (through ctypes, no extra
+package): a file is ready when its writer closes it (IN_CLOSE_WRITE) or when
+it is moved in (IN_MOVED_TO), which covers cameras that write to a temporary
+name and rename.  Elsewhere, or when inotify is unavailable in the container,
+it falls back to polling the folder; a file is then ready once it has not been
+modified for `settle` seconds.
+
+Files already in the folder are ignored, so starting the watcher does not
+depend on the folder size.  Hidden and temporary files (a leading dot or
+tilde, or a suffix such as .tmp or .part) are never reported: a camera that
+writes to such a name and renames it is picked up under the final name.
+
+Every version of a file is reported once: a file is remembered by name
+together with its inode, modification time and size, so repeated close events
+are ignored but a camera rewriting the same file name is reported again.
+When polling, only the files still in the folder are remembered, so the
+memory follows the folder rather than the number of files ever seen.  After
+processing, finish() optionally moves or deletes the file.
+
+Only the folder itself is watched, not its subfolders.  Runs on Python 2.7
+(the Greengrass runtime) and 3.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import shutil
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct('iIII')
+# names written by cameras and copy tools before the final rename
+TEMP_SUFFIXES = ('.tmp', '.temp', '.part', '.partial', '.filepart', '.crdownload', '.swp', '~')
+
+
+def is_temporary(name):
+    return name.startswith(('.', '~')) or name.lower().endswith(TEMP_SUFFIXES)
+
+
+def _inotify():
+    """libc with inotify, or None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class WatchFolder(object):
+    def __init__(self, path, callback, poll_interval=1.0, settle=1.0, use_inotify=True, remember=100000):
+        """
+        :param callback: called with the full path of each completed file, from the watcher thread
+        :param poll_interval: seconds between folder scans when polling
+        :param settle: seconds without modification after which a polled file counts as complete
+        :param remember: with inotify, number of file versions kept to deduplicate
+        """
+        self.path = path
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.use_inotify = use_inotify
+        self.remember = remember
+        self.started = time.time()
+        self.mode = None
+        self._seen = OrderedDict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        libc = _inotify() if self.use_inotify else None
+        fd = -1
+        if libc is not None:
+            fd = libc.inotify_init()
+            path = self.path if isinstance(self.path, bytes) else self.path.encode('utf-8')
+            if fd >= 0 and libc.inotify_add_watch(fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                fd = -1
+        if fd >= 0:
+            self.mode = 'inotify'
+            target, args = self._run_inotify, (fd,)
+        else:
+            self.mode = 'poll'
+            target, args = self._run_poll, ()
+        print("Watching {0} with {1}".format(self.path, self.mode))
+        self._thread = threading.Thread(target=target, args=args, name='watch-' + os.path.basename(self.path))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _emit(self, path, st=None):
+        name = os.path.basename(path)
+        if is_temporary(name if isinstance(name, str) else name.decode('utf-8', 'replace')):
+            return
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                # processed and removed already, or renamed again
+                return
+        version = (st.st_ino, st.st_mtime, st.st_size)
+        if self._seen.get(name) == version:
+            return
+        self._seen.pop(name, None)
+        self._seen[name] = version
+        if self.mode == 'inotify' and len(self._seen) > self.remember:
+            self._seen.popitem(last=False)
+        try:
+            self.callback(path)
+        except Exception as e:
+            print("Could not ingest {0}: {1}".format(path, e))
+
+    def _scan(self, settled_only=True):
+        """Report the files modified since the watcher started."""
+        now = time.time()
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            print("Could not list {0}: {1}".format(self.path, e))
+            return
+        # forget the files that are gone; the ones still here must not be reported again
+        present = set(names)
+        for name in [n for n in self._seen if n not in present]:
+            del self._seen[name]
+        for name in sorted(names):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path) or st.st_mtime < self.started:
+                continue
+            if settled_only and now - st.st_mtime < self.settle:
+                continue
+            self._emit(path, st)
+
+    def _run_poll(self):
+        while not self._stop.is_set():
+            self._scan()
+            self._stop.wait(self.poll_interval)
+
+    def _run_inotify(self, fd):
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], 1.0)
+                if not ready:
+                    continue
+                try:
+                    buf = os.read(fd, 64 << 10)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                offset = 0
+                while offset + _EVENT.size <= len(buf):
+                    _, mask, _, size = _EVENT.unpack_from(buf, offset)
+                    name = buf[offset + _EVENT.size:offset + _EVENT.size + size].rstrip(b'\0')
+                    offset += _EVENT.size + size
+                    if mask & IN_Q_OVERFLOW:
+                        # events were dropped by the kernel; find the missed files by listing the folder
+                        print("inotify queue overflow on {0}, rescanning".format(self.path))
+                        self._scan(settled_only=False)
+                    elif name and not mask & IN_ISDIR:
+                        if not isinstance(self.path, bytes):
+                            name = name.decode('utf-8', 'replace')
+                        self._emit(os.path.join(self.path, name))
+        finally:
+            os.close(fd)
+
+
+def finish(path, action='keep', done_dir=None):
+    """After processing: 'keep' the file, 'move' it into done_dir, or 'delete' it."""
+    try:
+        if action == 'delete':
+            os.remove(path)
+        elif action == 'move':
+            if not os.path.isdir(done_dir):
+                os.makedirs(done_dir)
+            shutil.move(path, os.path.join(done_dir, os.path.basename(path)))
+    except (IOError, OSError) as e:
+        print("Could not {0} {1}: {2}".format(action, path, e))
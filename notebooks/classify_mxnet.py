@@ -6,14 +6,52 @@ import logging
 import mxnet as mx
 from mxnet import gluon, autograd, init, nd
 from mxnet.gluon import nn, model_zoo
+from mxnet.gluon.model_zoo.vision.resnet import BasicBlockV2
 import numpy as np
 import json
 import time
 import os
+import glob
+import hashlib
+import io
+import email
+import tarfile
+
+from wafer_store import WaferStore, PNG_SCALE, WAFERMAP_CONTENT_TYPE, decode_wafermaps
+from train_profiler import EpochProfiler
+from class_sampler import ClassBalancedSampler
+from wafer_preprocess import Preprocessor
+import prediction_cache
 
 JSON_CONTENT_TYPE = 'application/json'
 JPEG_CONTENT_TYPE = 'image/jpeg'
 PNG_CONTENT_TYPE = 'image/png'
+NPY_CONTENT_TYPE = 'application/x-npy'
+MULTIPART_CONTENT_TYPE = 'multipart/'
+
+# Network input per architecture, exported next to the model as model-input.json
+# so the serving paths (transform_fn, the edge device) preprocess to match.
+#   resnet18_v2  ImageNet ResNet: RGB, resized to 256 and center-cropped to 224
+#   wafernet     WaferNet: the die states in one channel at 64x64, resized with
+#                nearest neighbour so each pixel stays one of the three states
+#   wafernet_small  WaferNet at half the width, the default distillation student
+INPUT_SPEC_FILE = 'model-input.json'
+INPUT_SPECS = {
+    'resnet18_v2': {'network': 'resnet18_v2', 'channels': 3, 'size': 224, 'resize': 256,
+                    'interpolation': 'bilinear', 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]},
+    'wafernet': {'network': 'wafernet', 'channels': 1, 'size': 64, 'resize': 64,
+                 'interpolation': 'nearest', 'mean': [0.5], 'std': [0.5]},
+    'wafernet_small': {'network': 'wafernet_small', 'channels': 1, 'size': 64, 'resize': 64,
+                       'interpolation': 'nearest', 'mean': [0.5], 'std': [0.5]},
+}
+# models exported without model-input.json
+DEFAULT_NETWORK = 'resnet18_v2'
+
+# largest batch passed to a single forward pass when serving
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 64))
+
+# optional cache of predictions for repeated inputs, see prediction_cache.py
+cache = prediction_cache.from_env()
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -22,7 +60,7 @@ logging.basicConfig(level=logging.DEBUG)
 # ------------------------------------------------------------ #
 
 
-def train(current_host, channel_input_dirs, hyperparameters, hosts, num_gpus):
+def train(current_host, channel_input_dirs, hyperparameters, hosts, num_gpus, output_data_dir=None):
     # SageMaker passes num_cpus, num_gpus and other args we can use to tailor training to
     # the current container environment, but here we just use simple cpu context.
     ctx = [mx.gpu()] if num_gpus > 0 else [mx.cpu()]
@@ -34,21 +72,68 @@ def train(current_host, channel_input_dirs, hyperparameters, hosts, num_gpus):
     momentum = hyperparameters.get('momentum', 0.9)
     wd = hyperparameters.get('wd', 0.001)
     log_interval = hyperparameters.get('log_interval', 100)
+    linear_probe = hyperparameters.get('linear_probe', False)
+    feature_cache_dir = hyperparameters.get('feature_cache_dir', '/tmp/feature_cache')
+    # train a small student against the soft predictions of the model in the teacher channel
+    distill = hyperparameters.get('distill', False)
+    temperature = float(hyperparameters.get('temperature', 4.0))
+    distill_alpha = float(hyperparameters.get('distill_alpha', 0.9))
+    network = hyperparameters.get('network', 'wafernet_small' if distill else DEFAULT_NETWORK)
+    spec = INPUT_SPECS[network]
+    # class-aware epochs, see class_sampler.py; the defaults keep uniform shuffling
+    sampling = hyperparameters.get('sampling', 'uniform')
+    epoch_fraction = float(hyperparameters.get('epoch_fraction', 1.0))
+    majority_fraction = float(hyperparameters.get('majority_fraction', 1.0))
+    target_accuracy = hyperparameters.get('target_accuracy')
+    # wait for the engine after every stage so each is timed on its own; costs throughput
+    profile_sync = hyperparameters.get('profile_sync', False)
+    # also export an INT8 copy for x86 cores with MKL-DNN, loaded at the edge with EDGE_INT8=1
+    int8_export = hyperparameters.get('int8_export', False)
 
     # load training and validation data
     # we use the gluon.data.vision.MNIST class because of its built in mnist pre-processing logic,
     # but point it at the location where SageMaker placed the data files, so it doesn't download them again.
     training_dir = channel_input_dirs['training']
     valid_dir = channel_input_dirs['validation']
-    train_data = get_train_data(training_dir, batch_size)
-    val_data = get_val_data(valid_dir, batch_size)
+
+    if linear_probe:
+        if network != DEFAULT_NETWORK:
+            raise ValueError('linear_probe needs the pretrained %s, not %s' % (DEFAULT_NETWORK, network))
+        net = train_linear_probe(ctx, training_dir, valid_dir, feature_cache_dir,
+                                 batch_size, epochs, learning_rate, wd)
+        net.int8_export = int8_export
+        return net
+
+    output_data_dir = output_data_dir or os.environ.get('SM_OUTPUT_DATA_DIR', '/opt/ml/output/data')
+    if distill:
+        if network == DEFAULT_NETWORK:
+            raise ValueError('distill trains a wafernet student, not %s' % network)
+        net = train_distilled(ctx, training_dir, valid_dir, teacher_model_dir(channel_input_dirs['teacher']),
+                              feature_cache_dir, network, batch_size, epochs, learning_rate, wd,
+                              temperature, distill_alpha, output_data_dir, profile_sync)
+        net.int8_export = int8_export
+        return net
+
+    # shard the training data in case we are doing distributed training. Each host samples only
+    # its own part of the record indices, reshuffled every epoch from a seed shared by all hosts.
+    train_data = get_train_data(training_dir, batch_size,
+                                num_parts=len(hosts), part_index=hosts.index(current_host), spec=spec,
+                                sampling=sampling, epoch_fraction=epoch_fraction,
+                                majority_fraction=majority_fraction)
+    val_data = get_val_data(valid_dir, batch_size, spec=spec)
 
     # define the network
-    net = define_network()
+    net = define_network(network)
+    net.input_spec = spec
+    net.int8_export = int8_export
 
     # Collect all parameters from net and its children, then initialize them.
-    net.output.initialize(init.Xavier(), ctx=ctx)
-    net.output.collect_params().setattr('lr_mult', 10)
+    if network == DEFAULT_NETWORK:
+        # only the new head; the features are pretrained
+        net.output.initialize(init.Xavier(), ctx=ctx)
+        net.output.collect_params().setattr('lr_mult', 10)
+    else:
+        net.initialize(init.Xavier(), ctx=ctx)
     net.collect_params().reset_ctx(ctx)
     
     # Trainer is for updating parameters with gradient.
@@ -63,111 +148,609 @@ def train(current_host, channel_input_dirs, hyperparameters, hosts, num_gpus):
     metric = mx.metric.Accuracy()
     loss = gluon.loss.SoftmaxCrossEntropyLoss()
 
-    # shard the training data in case we are doing distributed training. Alternatively to splitting in memory,
-    # the data could be pre-split in S3 and use ShardedByS3Key to do distributed training.
-    if len(hosts) > 1:
-        train_data = [x for x in train_data]
-        shard_size = len(train_data) // len(hosts)
-        for i, host in enumerate(hosts):
-            if host == current_host:
-                start = shard_size * i
-                end = start + shard_size
-                break
-
-        train_data = train_data[start:end]
-    
     net.hybridize()
-    
+
+    # per-stage timings; with profile_sync, waitall makes the asynchronous engine finish each stage
+    # before it is timed, otherwise queued work is charged to whichever stage next blocks on it
+    profiler = EpochProfiler(os.path.join(output_data_dir, 'train_profile.jsonl'),
+                             sync=mx.nd.waitall if profile_sync else None,
+                             target_accuracy=float(target_accuracy) if target_accuracy is not None else None)
+
     for epoch in range(epochs):
         # reset data iterator and metric at begining of epoch.
         metric.reset()
+        profiler.start_epoch(epoch)
         btic = time.time()
-        for i, (data, label) in enumerate(train_data):
+        for i, (data, label) in enumerate(profiler.iter_data(train_data)):
             # Copy data to ctx if necessary
             data = data.as_in_context(ctx[0])
             label = label.as_in_context(ctx[0])
             # Start recording computation graph with record() section.
             # Recorded graphs can then be differentiated with backward.
-            with autograd.record():
-                output = net(data)
-                L = loss(output, label)
-                L.backward()
+            with profiler.stage('forward_backward'):
+                with autograd.record():
+                    output = net(data)
+                    L = loss(output, label)
+                    L.backward()
             # take a gradient step with batch_size equal to data.shape[0]
-            trainer.step(data.shape[0])
+            with profiler.stage('optimizer'):
+                trainer.step(data.shape[0])
+            profiler.add_samples(data.shape[0])
             # update metric at last.
             metric.update([label], [output])
 
             if i % log_interval == 0 and i > 0:
                 name, acc = metric.get()
                 print('[Epoch %d Batch %d] Training: %s=%f, %f samples/s' %
-                      (epoch, i, name, acc, batch_size / (time.time() - btic)))
+                      (epoch, i, name, acc, log_interval * batch_size / (time.time() - btic)))
+                btic = time.time()
 
-            btic = time.time()
+        name, acc = metric.get()
+        print('[Epoch %d] Training: %s=%f' % (epoch, name, acc))
+
+        with profiler.stage('validation'):
+            name, val_acc, val_recall = test(ctx, net, val_data)
+        print('[Epoch %d] Validation: %s=%f' % (epoch, name, val_acc))
+        profiler.end_epoch(train_accuracy=acc, valid_accuracy=val_acc, valid_recall=val_recall,
+                           valid_min_recall=min([r for r in val_recall if r is not None] or [None]))
+
+    if target_accuracy is not None and not profiler.target_reached:
+        print('Target accuracy %s not reached in %d epochs' % (target_accuracy, epochs))
+    return net
+
+
+def train_linear_probe(ctx, training_dir, valid_dir, cache_dir, batch_size, epochs, learning_rate, wd):
+    """
+    Train only net.output on frozen pretrained features.
+
+    The backbone runs once over the (unaugmented) train and valid sets and the
+    embeddings are cached on disk, keyed by the backbone weights and the data
+    files, so later runs on the same data skip straight to the head.
+    """
+    net = define_network()
+    net.output.initialize(init.Xavier(), ctx=ctx)
+    net.collect_params().reset_ctx(ctx)
+    net.features.hybridize()
+    net.input_spec = INPUT_SPECS[DEFAULT_NETWORK]
+
+    key = feature_cache_key(net, [training_dir, valid_dir])
+    train_x, train_y = cached_features(net, ctx, get_val_data(training_dir, batch_size, 'train_rec.rec'),
+                                       os.path.join(cache_dir, key, 'train'))
+    valid_x, valid_y = cached_features(net, ctx, get_val_data(valid_dir, batch_size),
+                                       os.path.join(cache_dir, key, 'valid'))
+
+    train_data = gluon.data.DataLoader(gluon.data.ArrayDataset(train_x, train_y), batch_size, shuffle=True)
+    val_data = gluon.data.DataLoader(gluon.data.ArrayDataset(valid_x, valid_y), batch_size)
+
+    trainer = gluon.Trainer(net.output.collect_params(), 'adam', {'learning_rate': learning_rate, 'wd': wd})
+    metric = mx.metric.Accuracy()
+    loss = gluon.loss.SoftmaxCrossEntropyLoss()
+    net.output.hybridize()
+
+    for epoch in range(epochs):
+        metric.reset()
+        for data, label in train_data:
+            data = data.as_in_context(ctx[0])
+            label = label.as_in_context(ctx[0])
+            with autograd.record():
+                output = net.output(data)
+                L = loss(output, label)
+                L.backward()
+            trainer.step(data.shape[0])
+            metric.update([label], [output])
 
         name, acc = metric.get()
         print('[Epoch %d] Training: %s=%f' % (epoch, name, acc))
 
-        name, val_acc = test(ctx, net, val_data)
+        name, val_acc, _ = test(ctx, net.output, val_data)
         print('[Epoch %d] Validation: %s=%f' % (epoch, name, val_acc))
 
+    # only the children have run so far; export needs the whole net hybridized and run once
+    spec = net.input_spec
+    net.hybridize()
+    net(nd.zeros((1, spec['channels'], spec['size'], spec['size']), ctx=ctx[0]))
     return net
 
 
+def feature_cache_key(net, data_dirs):
+    # the backbone weights plus the names and sizes of the data files
+    h = hashlib.sha1()
+    for param in net.features.collect_params().values():
+        h.update(param.data().asnumpy().tobytes())
+    hash_data_files(h, data_dirs)
+    return h.hexdigest()[:16]
+
+
+def hash_data_files(h, data_dirs):
+    for data_dir in data_dirs:
+        for fname in sorted(os.listdir(data_dir)):
+            h.update(('%s:%d' % (fname, os.path.getsize(os.path.join(data_dir, fname)))).encode())
+
+
+def cached_features(net, ctx, data, prefix):
+    """Return (features, labels) for `data`, computing them with net.features on a cache miss."""
+    x_path, y_path = prefix + '_x.npy', prefix + '_y.npy'
+    if not os.path.exists(y_path):
+        print('Extracting features to %s' % prefix)
+        if not os.path.isdir(os.path.dirname(prefix)):
+            os.makedirs(os.path.dirname(prefix))
+        xs, ys = [], []
+        for batch, label in data:
+            xs.append(net.features(batch.as_in_context(ctx[0])).asnumpy())
+            ys.append(label.asnumpy())
+        np.save(x_path + '.tmp.npy', np.concatenate(xs).astype(np.float32))
+        os.rename(x_path + '.tmp.npy', x_path)
+        # the label file is written last and marks a complete cache entry
+        np.save(y_path + '.tmp.npy', np.concatenate(ys).astype(np.float32))
+        os.rename(y_path + '.tmp.npy', y_path)
+    return np.load(x_path, mmap_mode='r'), np.load(y_path)
+
+
+def train_distilled(ctx, training_dir, valid_dir, teacher_dir, cache_dir, network, batch_size, epochs,
+                    learning_rate, wd, temperature, alpha, output_data_dir, profile_sync=False):
+    """
+    Train the small `network` against the soft predictions of an exported teacher.
+
+    The teacher runs once over the unaugmented training set.  Its logits are
+    cached on disk, keyed by the teacher files and the data files like the
+    linear probe features, so later epochs and runs only read them.  The loss is
+    alpha * T^2 * KL(teacher || student, both at temperature T) plus
+    (1 - alpha) times the cross-entropy with the labels.  save() adds a report
+    comparing the student with the teacher.
+    """
+    teacher = gluon.SymbolBlock.imports('%s/model-symbol.json' % teacher_dir, ['data'],
+                                        '%s/model-0000.params' % teacher_dir, ctx=ctx)
+    teacher_spec = load_input_spec(teacher_dir)
+    h = hashlib.sha1(prediction_cache.file_digest(
+        ['%s/model-symbol.json' % teacher_dir, '%s/model-0000.params' % teacher_dir]).encode())
+    hash_data_files(h, [training_dir])
+    logits = cached_teacher_logits(teacher, ctx,
+                                   get_val_data(training_dir, batch_size, 'train_rec.rec', spec=teacher_spec),
+                                   os.path.join(cache_dir, h.hexdigest()[:16], 'teacher_logits.npy'))
+
+    spec = INPUT_SPECS[network]
+    train_imgs = get_image_dataset(training_dir, 'train_rec.rec').transform_first(get_train_transforms(spec))
+    train_data = gluon.data.DataLoader(TeacherLogitsDataset(train_imgs, logits), batch_size,
+                                       shuffle=True, last_batch='rollover')
+    val_data = get_val_data(valid_dir, batch_size, spec=spec)
+
+    net = define_network(network)
+    net.input_spec = spec
+    net.teacher_dir = teacher_dir
+    net.initialize(init.Xavier(), ctx=ctx)
+    trainer = gluon.Trainer(net.collect_params(), 'adam', {'learning_rate': learning_rate, 'wd': wd})
+    metric = mx.metric.Accuracy()
+    net.hybridize()
+    profiler = EpochProfiler(os.path.join(output_data_dir, 'train_profile.jsonl'),
+                             sync=mx.nd.waitall if profile_sync else None)
+
+    for epoch in range(epochs):
+        metric.reset()
+        profiler.start_epoch(epoch)
+        for data, label, teacher_logits in profiler.iter_data(train_data):
+            data = data.as_in_context(ctx[0])
+            label = label.as_in_context(ctx[0])
+            teacher_logits = teacher_logits.as_in_context(ctx[0])
+            with profiler.stage('forward_backward'):
+                with autograd.record():
+                    output = net(data)
+                    L = distillation_loss(output, label, teacher_logits, temperature, alpha)
+                    L.backward()
+            with profiler.stage('optimizer'):
+                trainer.step(data.shape[0])
+            profiler.add_samples(data.shape[0])
+            metric.update([label], [output])
+
+        name, acc = metric.get()
+        print('[Epoch %d] Training: %s=%f' % (epoch, name, acc))
+        with profiler.stage('validation'):
+            name, val_acc, val_recall = test(ctx, net, val_data)
+        print('[Epoch %d] Validation: %s=%f' % (epoch, name, val_acc))
+        profiler.end_epoch(train_accuracy=acc, valid_accuracy=val_acc, valid_recall=val_recall,
+                           valid_min_recall=min([r for r in val_recall if r is not None] or [None]))
+
+    return net
+
+
+def distillation_loss(output, label, teacher_logits, temperature, alpha):
+    soft = nd.softmax(teacher_logits / temperature)
+    kl = nd.sum(soft * (nd.log(soft + 1e-12) - nd.log_softmax(output / temperature)), axis=1)
+    ce = -nd.pick(nd.log_softmax(output), label)
+    return alpha * temperature ** 2 * kl + (1 - alpha) * ce
+
+
+def teacher_model_dir(channel_dir):
+    """The teacher channel holds the exported files, or the model.tar.gz of a training job."""
+    archive = os.path.join(channel_dir, 'model.tar.gz')
+    if not os.path.exists(archive):
+        return channel_dir
+    model_dir = '/tmp/teacher'
+    with tarfile.open(archive) as tar:
+        tar.extractall(model_dir)
+    return model_dir
+
+
+def cached_teacher_logits(teacher, ctx, data, path):
+    """The teacher's logits for every item of the unshuffled `data`, computed on a cache miss."""
+    if not os.path.exists(path):
+        print('Computing teacher logits to %s' % path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        logits = [teacher(batch.as_in_context(ctx[0])).asnumpy() for batch, _ in data]
+        np.save(path + '.tmp.npy', np.concatenate(logits).astype(np.float32))
+        os.rename(path + '.tmp.npy', path)
+    return np.load(path)
+
+
+class TeacherLogitsDataset(gluon.data.Dataset):
+    """Items of `dataset` with the teacher's logits for them: (image, label, logits)."""
+    def __init__(self, dataset, logits):
+        self._dataset = dataset
+        self._logits = logits
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, idx):
+        img, label = self._dataset[idx]
+        return img, label, self._logits[idx]
+
+
 def save(net, model_dir):
-    # save the model
+    # save the model, and the input it expects
     net.export('%s/model'% model_dir)
+    spec = getattr(net, 'input_spec', INPUT_SPECS[DEFAULT_NETWORK])
+    with open(os.path.join(model_dir, INPUT_SPEC_FILE), 'w') as fout:
+        json.dump(spec, fout)
+
+    valid_dir = os.environ.get('SM_CHANNEL_VALIDATION', '/opt/ml/input/data/validation')
+    teacher_dir = getattr(net, 'teacher_dir', None)
+    if teacher_dir is not None and os.path.isdir(valid_dir):
+        try:
+            export_distillation_report(model_dir, teacher_dir, valid_dir)
+        except Exception as e:
+            logging.warning('Skipping the distillation report: %s', e)
+    # add an INT8 copy for x86 CPU inference when asked for and the validation channel is available
+    if getattr(net, 'int8_export', False) and os.path.isdir(valid_dir):
+        try:
+            export_quantized(model_dir, valid_dir, spec)
+        except Exception as e:
+            # the FP32 model is already saved; not every MXNet build has INT8 CPU kernels
+            logging.warning('Skipping INT8 export: %s', e)
+
+
+def export_quantized(model_dir, valid_dir, spec=None, num_calib_examples=500, num_eval_examples=500, seed=0):
+    """
+    Quantize the exported FP32 model to INT8 and write a comparison report.
+
+    The INT8 graph uses MKL-DNN operators, so it only runs on x86 builds of
+    MXNet with MKL-DNN, not on the ARM builds of edge devices; it is written
+    as model-int8-x86-symbol.json and model-int8-x86-0000.params next to the
+    FP32 files, with quantization_report.json.  Calibration uses a random
+    sample of the validation data; accuracy and single-image latency are
+    measured on a separate sample.
+    """
+    from mxnet.contrib import quantization
+
+    if not mkldnn_enabled():
+        raise RuntimeError('this MXNet build has no MKL-DNN INT8 kernels')
+    ctx = mx.cpu()
+    sym, arg_params, aux_params = mx.model.load_checkpoint('%s/model' % model_dir, 0)
+
+    dataset = get_image_dataset(valid_dir, 'valid_rec.rec').transform_first(get_val_transforms(spec))
+    idx = np.random.RandomState(seed).permutation(len(dataset))[:num_calib_examples + num_eval_examples]
+    images = nd.stack(*[dataset[int(i)][0] for i in idx]).asnumpy()
+    labels = np.array([dataset[int(i)][1] for i in idx])
+    calib_x = images[:num_calib_examples]
+    eval_x, eval_y = images[num_calib_examples:], labels[num_calib_examples:]
+
+    calib_iter = mx.io.NDArrayIter(data=calib_x, batch_size=50)
+    # fuse conv/bn/relu before and after quantization
+    qsym = sym.get_backend_symbol('MKLDNN_QUANTIZE')
+    qsym, qarg_params, qaux_params = quantization.quantize_model(
+        sym=qsym, arg_params=arg_params, aux_params=aux_params, data_names=('data',), label_names=None,
+        ctx=ctx, excluded_sym_names=[], calib_mode='naive', calib_data=calib_iter,
+        num_calib_examples=len(calib_x), quantized_dtype='int8')
+    qsym = qsym.get_backend_symbol('MKLDNN_QUANTIZE')
+    mx.model.save_checkpoint('%s/model-int8-x86' % model_dir, 0, qsym, qarg_params, qaux_params)
+
+    report = {}
+    for name, prefix, (s, a, x) in [('fp32', 'model', (sym, arg_params, aux_params)),
+                                    ('int8', 'model-int8-x86', (qsym, qarg_params, qaux_params))]:
+        report[name] = evaluate_symbol(s, a, x, eval_x, eval_y, ctx)
+        report[name]['size_bytes'] = os.path.getsize('%s/%s-0000.params' % (model_dir, prefix))
+    print('Quantization report: ' + json.dumps(report))
+    with open(os.path.join(model_dir, 'quantization_report.json'), 'w') as fout:
+        json.dump(report, fout, indent=2)
+    return report
+
+
+def mkldnn_enabled():
+    """Whether this MXNet build has the MKL-DNN backend; older builds have no feature list."""
+    try:
+        from mxnet.runtime import Features
+        return Features().is_enabled('MKLDNN')
+    except Exception:
+        return False
+
+
+def export_distillation_report(model_dir, teacher_dir, valid_dir, num_eval_examples=500, seed=0):
+    """
+    Accuracy, CPU latency and size of the exported student and its teacher on
+    the same random sample of the validation data, each preprocessed for its own
+    input.  Writes distillation_report.json next to the model.
+    """
+    report = {}
+    for name, path in [('teacher', teacher_dir), ('student', model_dir)]:
+        spec = load_input_spec(path)
+        dataset = get_image_dataset(valid_dir, 'valid_rec.rec').transform_first(get_val_transforms(spec))
+        idx = np.random.RandomState(seed).permutation(len(dataset))[:num_eval_examples]
+        images = nd.stack(*[dataset[int(i)][0] for i in idx]).asnumpy()
+        labels = np.array([dataset[int(i)][1] for i in idx])
+        sym, arg_params, aux_params = mx.model.load_checkpoint('%s/model' % path, 0)
+        report[name] = evaluate_symbol(sym, arg_params, aux_params, images, labels, mx.cpu())
+        report[name].update(network=spec.get('network'),
+                            size_bytes=os.path.getsize('%s/model-0000.params' % path))
+    report['latency_speedup'] = report['teacher']['latency_ms_p50'] / report['student']['latency_ms_p50']
+    print('Distillation report: ' + json.dumps(report))
+    with open(os.path.join(model_dir, 'distillation_report.json'), 'w') as fout:
+        json.dump(report, fout, indent=2)
+    return report
+
+
+def evaluate_symbol(sym, arg_params, aux_params, images, labels, ctx):
+    """Accuracy and batch-of-one latency of a symbolic model on preprocessed images."""
+    mod = mx.mod.Module(symbol=sym, data_names=['data'], label_names=None, context=ctx)
+    mod.bind(for_training=False, data_shapes=[('data', (1,) + images.shape[1:])])
+    mod.set_params(arg_params, aux_params)
+
+    correct = 0
+    latencies = []
+    for img, label in zip(images, labels):
+        batch = mx.io.DataBatch([nd.array(img[None])])
+        tic = time.time()
+        mod.forward(batch, is_train=False)
+        output = mod.get_outputs()[0].asnumpy()
+        latencies.append(time.time() - tic)
+        correct += int(output.argmax() == label)
+    return {'accuracy': correct / float(max(len(labels), 1)),
+            'latency_ms_mean': 1000 * float(np.mean(latencies)),
+            'latency_ms_p50': 1000 * float(np.percentile(latencies, 50)),
+            'latency_ms_p99': 1000 * float(np.percentile(latencies, 99))}
+
+
+def define_network(network=DEFAULT_NETWORK):
+    if network == 'wafernet':
+        return WaferNet(classes=9)
+    if network == 'wafernet_small':
+        return WaferNet(classes=9, channels=(16, 32, 64, 128))
 
-
-def define_network():
-    
     pretrained_net = model_zoo.vision.resnet18_v2(pretrained=True)
     net = model_zoo.vision.resnet18_v2(classes=9)
     net.features = pretrained_net.features
     
     return net
 
-def get_train_data(data_dir, batch_size):
-    train_imgs = gluon.data.vision.ImageRecordDataset(os.path.join(data_dir, 'train_rec.rec'))
-                                                     
-    normalize = gluon.data.vision.transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
-    train_augs = gluon.data.vision.transforms.Compose([
-        gluon.data.vision.transforms.RandomResizedCrop(224),
+class WaferNet(gluon.HybridBlock):
+    """
+    ResNet for single-channel wafer maps at their native resolution.
+
+    The ImageNet stem (7x7 stride-2 convolution and max pooling) would throw
+    away three quarters of a 64x64 map in its first two layers, so the stem is
+    one 3x3 convolution at full resolution.  Four stages of two pre-activation
+    basic blocks follow, each halving the resolution: 64x64 in, 4x4 before the
+    global pooling, about a tenth of the multiply-adds of resnet18_v2 at 224.
+    """
+    def __init__(self, classes=9, channels=(32, 64, 128, 256), **kwargs):
+        super(WaferNet, self).__init__(**kwargs)
+        with self.name_scope():
+            self.features = nn.HybridSequential(prefix='')
+            self.features.add(nn.Conv2D(channels[0], 3, 1, 1, use_bias=False))
+            in_channels = channels[0]
+            for c in channels:
+                self.features.add(BasicBlockV2(c, 2, downsample=True, in_channels=in_channels, prefix=''))
+                self.features.add(BasicBlockV2(c, 1, in_channels=c, prefix=''))
+                in_channels = c
+            self.features.add(nn.BatchNorm())
+            self.features.add(nn.Activation('relu'))
+            self.features.add(nn.GlobalAvgPool2D())
+            self.features.add(nn.Flatten())
+            self.output = nn.Dense(classes, in_units=in_channels)
+
+    def hybrid_forward(self, F, x):
+        return self.output(self.features(x))
+
+
+class WaferStoreDataset(gluon.data.Dataset):
+    """
+    Serves a packed wafer store (see wafer_store.py) in the same layout as
+    ImageRecordDataset: a (H, W, 3) uint8 image scaled like the exported PNGs,
+    and the class index.
+    """
+    def __init__(self, path):
+        self._store = WaferStore(path)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, idx):
+        wafer, label = self._store[idx]
+        return wafer_to_image(wafer), label
+
+    @property
+    def labels(self):
+        return self._store.labels
+
+
+def wafer_to_image(wafer):
+    # die states 0/1/2 to the (H, W, 3) uint8 image the PNG export would decode to;
+    # a (N, H, W) stack converts in one pass to (N, H, W, 3)
+    img = np.repeat((np.asarray(wafer, dtype=np.uint8) * PNG_SCALE)[..., None], 3, axis=-1)
+    return mx.nd.array(img, dtype='uint8')
+
+
+def wafer_maps(wafers):
+    # a (N, H, W) stack or list of die-state maps, as the uint8 maps Preprocessor reads
+    return [np.asarray(w, dtype=np.uint8) for w in wafers]
+
+
+class ConcatDataset(gluon.data.Dataset):
+    """Presents several datasets, e.g. RecordIO shards, as one."""
+    def __init__(self, datasets):
+        self._datasets = datasets
+        self._offsets = np.cumsum([0] + [len(d) for d in datasets])
+
+    @property
+    def labels(self):
+        return np.concatenate([dataset_labels(d) for d in self._datasets])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, idx):
+        shard = int(np.searchsorted(self._offsets, idx, side='right')) - 1
+        return self._datasets[shard][idx - int(self._offsets[shard])]
+
+
+def get_image_dataset(data_dir, rec_name):
+    # prefer a packed wafer store when the channel holds one
+    if WaferStore.exists(data_dir):
+        return WaferStoreDataset(data_dir)
+    rec_path = os.path.join(data_dir, rec_name)
+    if os.path.exists(rec_path):
+        return gluon.data.vision.ImageRecordDataset(rec_path)
+    # sharded output of convert_dataset.py, e.g. train_rec-00000.rec
+    shards = sorted(glob.glob(os.path.join(data_dir, os.path.splitext(rec_name)[0] + '-*.rec')))
+    if not shards:
+        raise IOError('No wafer store, %s or %s-*.rec shards in %s' % (
+            rec_name, os.path.splitext(rec_name)[0], data_dir))
+    return ConcatDataset([gluon.data.vision.ImageRecordDataset(s) for s in shards])
+
+
+def dataset_labels(dataset):
+    """The class index of every item of a dataset from get_image_dataset, without decoding any image."""
+    if hasattr(dataset, 'labels'):
+        return np.asarray(dataset.labels, dtype=np.int64)
+    # ImageRecordDataset: read only the record headers
+    return np.array([int(mx.recordio.unpack(gluon.data.RecordFileDataset.__getitem__(dataset, i))[0].label)
+                     for i in range(len(dataset))], dtype=np.int64)
+
+
+class ShardedRandomSampler(gluon.data.sampler.Sampler):
+    """
+    Samples part `part_index` of `num_parts` equal parts of range(length).
+
+    The permutation is drawn from `seed` plus the epoch number, so every host
+    agrees on the parts without exchanging anything, and every epoch both the
+    order and the split change.
+    """
+    def __init__(self, length, num_parts=1, part_index=0, seed=0):
+        self._length = length
+        self._num_parts = num_parts
+        self._part_index = part_index
+        self._seed = seed
+        self._epoch = 0
+
+    def __iter__(self):
+        perm = np.random.RandomState(self._seed + self._epoch).permutation(self._length)
+        self._epoch += 1
+        return iter(perm[self._part_index::self._num_parts][:len(self)].tolist())
+
+    def __len__(self):
+        # equal parts keep the hosts in step for dist_sync
+        return self._length // self._num_parts
+
+
+def get_train_data(data_dir, batch_size, num_parts=1, part_index=0, spec=None,
+                   sampling='uniform', epoch_fraction=1.0, majority_fraction=1.0):
+    train_imgs = get_image_dataset(data_dir, 'train_rec.rec')
+    train_augs = get_train_transforms(spec)
+
+    if sampling == 'uniform' and epoch_fraction == 1.0 and majority_fraction == 1.0:
+        sampler = ShardedRandomSampler(len(train_imgs), num_parts, part_index)
+    else:
+        sampler = ClassBalancedSampler(dataset_labels(train_imgs), sampling, epoch_fraction, majority_fraction,
+                                       num_parts, part_index)
+    train_iter = gluon.data.DataLoader(
+        train_imgs.transform_first(train_augs), batch_size, sampler=sampler, last_batch='rollover')
+    
+    return train_iter
+
+
+def get_train_transforms(spec=None):
+    spec = spec or INPUT_SPECS[DEFAULT_NETWORK]
+    if spec['channels'] == 1:
+        # flips keep the die states; crops would cut off the wafer edge
+        return gluon.data.vision.transforms.Compose([
+            gluon.data.vision.transforms.RandomFlipLeftRight(),
+            gluon.data.vision.transforms.RandomFlipTopBottom(),
+            WaferInput(spec)])
+
+    normalize = gluon.data.vision.transforms.Normalize(spec['mean'], spec['std'])
+
+    return gluon.data.vision.transforms.Compose([
+        gluon.data.vision.transforms.RandomResizedCrop(spec['size']),
         gluon.data.vision.transforms.RandomFlipLeftRight(),
         gluon.data.vision.transforms.RandomFlipTopBottom(),
         gluon.data.vision.transforms.ToTensor(),
         normalize])
-    
-    train_iter = gluon.data.DataLoader(
-        train_imgs.transform_first(train_augs), batch_size, shuffle=True, last_batch='rollover')
-    
-    return train_iter
 
 
-def get_val_data(data_dir, batch_size):
-    valid_imgs = gluon.data.vision.ImageRecordDataset(os.path.join(data_dir, 'valid_rec.rec'))
-    
-    normalize = gluon.data.vision.transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    
-    valid_augs = gluon.data.vision.transforms.Compose([
-        gluon.data.vision.transforms.Resize(256),
-        gluon.data.vision.transforms.CenterCrop(224),
+def get_val_transforms(spec=None):
+    spec = spec or INPUT_SPECS[DEFAULT_NETWORK]
+    if spec['channels'] == 1:
+        return WaferInput(spec)
+
+    normalize = gluon.data.vision.transforms.Normalize(spec['mean'], spec['std'])
+
+    return gluon.data.vision.transforms.Compose([
+        gluon.data.vision.transforms.Resize(spec['resize']),
+        gluon.data.vision.transforms.CenterCrop(spec['size']),
         gluon.data.vision.transforms.ToTensor(),
         normalize])
+
+
+class WaferInput(gluon.Block):
+    """
+    (H, W, C) uint8 wafer image, as decoded from a PNG or made by wafer_to_image,
+    to the normalised (1, size, size) input of a single-channel network.
+    """
+    def __init__(self, spec):
+        super(WaferInput, self).__init__()
+        self._size = spec['size']
+        self._interp = 0 if spec['interpolation'] == 'nearest' else 1
+        self._mean = spec['mean'][0]
+        self._std = spec['std'][0]
+
+    def forward(self, img):
+        img = mx.image.imresize(img, self._size, self._size, interp=self._interp)
+        x = nd.slice_axis(img, axis=2, begin=0, end=1).transpose((2, 0, 1)).astype('float32') / 255
+        return (x - self._mean) / self._std
+
+
+def get_val_data(data_dir, batch_size, rec_name='valid_rec.rec', spec=None):
+    valid_imgs = get_image_dataset(data_dir, rec_name)
     
-    valid_iter = gluon.data.DataLoader(valid_imgs.transform_first(valid_augs), batch_size)
+    valid_iter = gluon.data.DataLoader(valid_imgs.transform_first(get_val_transforms(spec)), batch_size)
     
     return valid_iter
 
 
-def test(ctx, net, val_data):
+def test(ctx, net, val_data, num_classes=9):
+    """Accuracy on `val_data` and the recall of each class (None for classes it does not hold)."""
     metric = mx.metric.Accuracy()
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
     for data, label in val_data:
         data = data.as_in_context(ctx[0])
         label = label.as_in_context(ctx[0])
         output = net(data)
         metric.update([label], [output])
-    return metric.get()
+        np.add.at(confusion, (label.asnumpy().astype(int), mx.nd.argmax(output, axis=1).asnumpy().astype(int)), 1)
+    name, acc = metric.get()
+    support = confusion.sum(axis=1)
+    recall = [float(confusion[c, c]) / support[c] if support[c] else None for c in range(num_classes)]
+    return name, acc, recall
 
 
 # ------------------------------------------------------------ #
@@ -186,9 +769,23 @@ def model_fn(model_dir):
         ['data'],
         '%s/model-0000.params' % model_dir,        
     )
+    net.input_spec = load_input_spec(model_dir)
+    # wafer maps at the intensities of the exported PNGs, as in training
+    net.preprocess = Preprocessor(net.input_spec, wafer_scale=PNG_SCALE / 255.)
+    if cache is not None:
+        cache.set_model_version(prediction_cache.file_digest(
+            ['%s/model-symbol.json' % model_dir, '%s/model-0000.params' % model_dir]))
     return net
 
 
+def load_input_spec(model_dir):
+    path = os.path.join(model_dir, INPUT_SPEC_FILE)
+    if not os.path.exists(path):
+        return INPUT_SPECS[DEFAULT_NETWORK]
+    with open(path) as fin:
+        return json.load(fin)
+
+
 def transform_fn(net, data, input_content_type, output_content_type):
     """
     Transform a request using the Gluon model. Called once per request.
@@ -199,25 +796,70 @@ def transform_fn(net, data, input_content_type, output_content_type):
     :param output_content_type: The (desired) response content type.
     :return: response payload and content type.
     """
-    normalize = gluon.data.vision.transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    test_augs = gluon.data.vision.transforms.Compose([
-        gluon.data.vision.transforms.Resize(256),
-        gluon.data.vision.transforms.CenterCrop(224),
-        gluon.data.vision.transforms.ToTensor(),
-        normalize])
-    
-    if input_content_type == JPEG_CONTENT_TYPE: 
-        nda = mx.img.imdecode(data)
-    if input_content_type == PNG_CONTENT_TYPE: 
-        nda = mx.img.imdecode(data)
+    imgs, is_batch = decode_request(data, input_content_type)
+    predictions = predict_batch(net, imgs, cache=cache)
+    response_body = json.dumps(predictions if is_batch else predictions[0])
+    return response_body, output_content_type
+
+
+def decode_request(data, input_content_type):
+    """
+    Decode a request body into a list of uint8 numpy arrays: (H, W) wafer maps
+    of die states or (H, W, C) images, the inputs of wafer_preprocess.Preprocessor.
+
+    Single images are JPEG, PNG, or a JSON nested list: a 2-D wafer map or
+    (H, W, C) pixels.  Batches are:
+      - JSON {"instances": [...]}, each instance a 2-D wafer map of die states
+        or a (H, W, C) list of pixels
+      - application/x-npy holding a (N, H, W) stack of wafer maps or a
+        (N, H, W, C) stack of images; a 2-D array is a single wafer map
+      - a multipart body whose parts are JPEG or PNG images
+      - application/x-wafermap bit-packed wafer maps (see wafer_store.py);
+        the response is always a list
+
+    :return: (images, is_batch)
+    """
+    if input_content_type in (JPEG_CONTENT_TYPE, PNG_CONTENT_TYPE):
+        return [mx.img.imdecode(data).asnumpy()], False
     if input_content_type == JSON_CONTENT_TYPE:
         parsed = json.loads(data)
-        nda = mx.nd.array(parsed)
-       
-    img = test_augs(nda)
-    img = img.expand_dims(axis=0)                
-    
-    output = net(img)
-    prediction = mx.nd.argmax(output, axis=1)
-    response_body = json.dumps(prediction.asnumpy().tolist()[0])
-    return response_body, output_content_type
+        if isinstance(parsed, dict):
+            return [np.asarray(x, dtype=np.uint8) for x in parsed['instances']], True
+        return [np.asarray(parsed, dtype=np.uint8)], False
+    if input_content_type == WAFERMAP_CONTENT_TYPE:
+        return wafer_maps(decode_wafermaps(data)), True
+    if input_content_type == NPY_CONTENT_TYPE:
+        arr = np.load(io.BytesIO(data), allow_pickle=False).astype(np.uint8, copy=False)
+        if arr.ndim == 2:
+            return [arr], False
+        return list(arr), True
+    if input_content_type.startswith(MULTIPART_CONTENT_TYPE):
+        header = ('Content-Type: %s\r\n\r\n' % input_content_type).encode()
+        msg = email.message_from_bytes(header + data)
+        return [mx.img.imdecode(part.get_payload(decode=True)).asnumpy() for part in msg.get_payload()], True
+    raise Exception('Requested unsupported ContentType in content_type: {}'.format(input_content_type))
+
+
+def predict_batch(net, imgs, max_batch_size=MAX_BATCH_SIZE, cache=None):
+    """
+    Classify `imgs`, as returned by decode_request, with one forward pass per
+    `max_batch_size` images, in order; net.preprocess (set by model_fn) makes
+    each batch.  With a PredictionCache, only images not seen before reach the model.
+    """
+    predictions = [None] * len(imgs)
+    keys = [cache.key(img) for img in imgs] if cache is not None else None
+    misses = []
+    for i in range(len(imgs)):
+        predictions[i] = cache.get(keys[i]) if cache is not None else None
+        if predictions[i] is None:
+            misses.append(i)
+
+    for start in range(0, len(misses), max_batch_size):
+        chunk = misses[start:start + max_batch_size]
+        batch = nd.array(net.preprocess([imgs[i] for i in chunk]))
+        output = net(batch)
+        for i, p in zip(chunk, mx.nd.argmax(output, axis=1).asnumpy()):
+            predictions[i] = int(p)
+            if cache is not None:
+                cache.put(keys[i], predictions[i])
+    return predictions
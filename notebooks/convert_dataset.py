@@ -0,0 +1,181 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Convert LSWMD.pkl into sharded RecordIO files for classify_mxnet.py.
+
+This replaces the writeImgToDisk loop in DataPrep.ipynb followed by
+manifest.sh and im2rec.  Rows are split into stratified train/valid/test sets
+from a fixed seed, spread over N shards per split, and each shard is encoded by
+a worker process.  The output layout matches the SageMaker channels:
+
+    <out>/train_rec/train_rec-00000.rec, .idx, ...
+    <out>/valid_rec/valid_rec-00000.rec, .idx, ...
+    <out>/test_rec/test_rec-00000.rec, .idx, ...
+    <out>/test/          the test split as a wafer store, for test_code/evaluate.py
+    <out>/manifest.json
+
+The manifest is written first and records the seed, shard count and split
+sizes.  A shard is only renamed to its final name once fully written, so
+rerunning the command after an interruption skips the shards that are already
+complete.  A rerun with different settings would mix two layouts, so it is
+refused unless it writes to a new folder.
+
+The pickle has to be loaded whole, but only the wafer maps and labels are
+kept.  Workers inherit them when the pool starts and are only sent row
+indices, so the wafers are not copied through the task queue.
+
+Usage:
+    python convert_dataset.py raw-data/LSWMD.pkl data --shards 8 --workers 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from wafer_store import CLASSES, PNG_SCALE, WaferStore, WaferStoreWriter, label_name, stratified_split
+
+MANIFEST_FILE = 'manifest.json'
+SETTINGS = ['seed', 'num_shards', 'test_size', 'valid_size', 'classes']
+
+# (wafers, labels, row_ids) of the dataset being converted, set in each worker by init_worker
+_source = None
+
+
+def init_worker(wafers, labels, row_ids):
+    global _source
+    _source = (wafers, labels, row_ids)
+
+
+def shard_paths(out_dir, split, shard):
+    base = os.path.join(out_dir, '{0}_rec'.format(split), '{0}_rec-{1:05d}'.format(split, shard))
+    return base + '.rec', base + '.idx'
+
+
+def shard_complete(out_dir, split, shard):
+    rec_path, idx_path = shard_paths(out_dir, split, shard)
+    return os.path.exists(rec_path) and os.path.exists(idx_path)
+
+
+def write_shard(task):
+    """Encode one shard as PNG records. Runs in a worker process."""
+    import mxnet as mx
+
+    out_dir, split, shard, rows = task
+    wafers, labels, row_ids = _source
+    rec_path, idx_path = shard_paths(out_dir, split, shard)
+    record = mx.recordio.MXIndexedRecordIO(idx_path + '.tmp', rec_path + '.tmp', 'w')
+    for i, row in enumerate(rows):
+        header = mx.recordio.IRHeader(0, float(labels[row]), int(row_ids[row]), 0)
+        img = np.asarray(wafers[row], dtype=np.uint8) * PNG_SCALE
+        record.write_idx(i, mx.recordio.pack_img(header, img, img_fmt='.png'))
+    record.close()
+    # the .idx file appears last, so its presence marks a complete shard
+    os.rename(rec_path + '.tmp', rec_path)
+    os.rename(idx_path + '.tmp', idx_path)
+    return split, shard, len(rows)
+
+
+def shard_tasks(out_dir, splits, num_shards):
+    """Yield one task per incomplete shard; shards take strided rows so each keeps the class mix."""
+    for split, idx in splits.items():
+        split_dir = os.path.join(out_dir, '{0}_rec'.format(split))
+        if not os.path.isdir(split_dir):
+            os.makedirs(split_dir)
+        for shard in range(num_shards):
+            if shard_complete(out_dir, split, shard):
+                print("Skipping complete shard {0} {1}".format(split, shard))
+                continue
+            yield out_dir, split, shard, idx[shard::num_shards]
+
+
+def check_resume(out_dir, settings):
+    """Refuse to add to an output folder written with other settings, or by an unknown run."""
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path) as fin:
+            manifest = json.load(fin)
+        changed = [k for k in SETTINGS if manifest.get(k) != settings[k]]
+        if changed:
+            raise ValueError("{0} was written with {1}, not {2}; use a new output folder".format(
+                out_dir, ', '.join('{0}={1}'.format(k, manifest.get(k)) for k in changed),
+                ', '.join('{0}={1}'.format(k, settings[k]) for k in changed)))
+        return
+    for name in ['train_rec', 'valid_rec', 'test_rec', 'test']:
+        if os.path.isdir(os.path.join(out_dir, name)) and os.listdir(os.path.join(out_dir, name)):
+            raise ValueError("{0} has no {1} but {2} is not empty; use a new output folder".format(
+                out_dir, MANIFEST_FILE, name))
+
+
+def write_manifest(out_dir, labels, splits, settings):
+    num_shards = settings['num_shards']
+    manifest = dict(settings, splits={})
+    for split, idx in splits.items():
+        shards = []
+        for shard in range(num_shards):
+            shard_idx = idx[shard::num_shards]
+            rec_path, idx_path = shard_paths(out_dir, split, shard)
+            shards.append({'rec': os.path.relpath(rec_path, out_dir),
+                           'idx': os.path.relpath(idx_path, out_dir),
+                           'count': len(shard_idx),
+                           'class_counts': np.bincount(labels[shard_idx], minlength=len(CLASSES)).tolist()})
+        manifest['splits'][split] = shards
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as fout:
+        json.dump(manifest, fout, indent=2)
+
+
+def convert(pkl_path, out_dir, num_shards=8, workers=None, seed=0, test_size=0.2, valid_size=0.2):
+    import pandas as pd
+
+    settings = {'seed': seed, 'num_shards': num_shards, 'test_size': test_size, 'valid_size': valid_size,
+                'classes': CLASSES}
+    check_resume(out_dir, settings)
+
+    print("Loading " + pkl_path)
+    dataset = pd.read_pickle(pkl_path)
+    names = dataset['failureType'].apply(label_name)
+    labelled = dataset[names.notnull()]
+    labels = np.array([CLASSES.index(n) for n in names[names.notnull()]], dtype=np.uint8)
+    wafers = labelled['waferMap'].values
+    row_ids = labelled.index.values
+    # the other columns are not needed, don't keep them alive in the parent or the workers
+    del dataset, names, labelled
+    splits = stratified_split(labels, seed, test_size, valid_size)
+
+    write_manifest(out_dir, labels, splits, settings)
+    print("Wrote manifest to " + os.path.join(out_dir, MANIFEST_FILE))
+
+    tasks = shard_tasks(out_dir, splits, num_shards)
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(),
+                                initializer=init_worker, initargs=(wafers, labels, row_ids))
+    try:
+        for split, shard, count in pool.imap_unordered(write_shard, tasks):
+            print("Wrote shard {0} {1} with {2} images".format(split, shard, count))
+    finally:
+        pool.close()
+        pool.join()
+
+    # the pipeline's test stage reads the held-out split as a wafer store
+    test_dir = os.path.join(out_dir, 'test')
+    if not WaferStore.exists(test_dir):
+        with WaferStoreWriter(test_dir) as writer:
+            for i in splits['test']:
+                writer.add(wafers[i], labels[i])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkl', type=str, help='path to LSWMD.pkl')
+    parser.add_argument('out_dir', type=str, help='output folder')
+    parser.add_argument('--shards', type=int, default=8, help='shards per split (default: 8)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: cpu count)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the stratified split (default: 0)')
+    parser.add_argument('--test-size', type=float, default=0.2, help='fraction held out for test (default: 0.2)')
+    parser.add_argument('--valid-size', type=float, default=0.2,
+                        help='fraction of the remainder held out for validation (default: 0.2)')
+    args = parser.parse_args()
+
+    convert(args.pkl, args.out_dir, args.shards, args.workers, args.seed, args.test_size, args.valid_size)
@@ -0,0 +1,95 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Class-aware epoch sampling shared by the MxNet and fastai trainers.
+
+WM-811K is dominated by the `none` class, so a uniformly shuffled epoch
+spends most of its steps on easy wafers.  ClassBalancedSampler fixes how
+many items of each class an epoch holds (its quota) and draws them from a
+label index built once from the labels of the training set:
+
+    weighting           share of the epoch per class: 'uniform' (the class
+                        frequencies), 'sqrt' (square root of the counts),
+                        'balanced' (equal), or one weight per class that
+                        multiplies its frequency
+    epoch_fraction      items per epoch as a fraction of the training set
+    majority_fraction   at most this fraction of the largest class per epoch
+
+Each class is read as a stream of fresh permutations of its items, and every
+epoch takes the next `quota` items of each stream.  An undersampled class is
+therefore covered across epochs rather than resampled at random, and a class
+whose quota exceeds its size is repeated (with new augmentations).  Like
+ShardedRandomSampler in classify_mxnet.py, the draws depend only on the seed
+and the epoch, so distributed hosts agree on their parts without
+communicating.
+
+The sampler is a plain iterable of dataset indices with a length, accepted as
+`sampler` by both gluon and torch data loaders.
+
+This module only depends on numpy and is shipped with each training
+directory (notebooks, pytorch_code/classifier); keep the copies identical.
+"""
+from __future__ import division
+
+import numpy as np
+
+WEIGHTINGS = ['uniform', 'sqrt', 'balanced']
+
+
+def class_quotas(counts, weighting='uniform', epoch_fraction=1.0, majority_fraction=1.0):
+    """Items of each class in one epoch, for the item count of every class."""
+    counts = np.asarray(counts, dtype=np.float64)
+    if weighting == 'uniform':
+        share = counts
+    elif weighting == 'sqrt':
+        share = np.sqrt(counts)
+    elif weighting == 'balanced':
+        share = (counts > 0).astype(np.float64)
+    else:
+        share = counts * np.asarray(weighting, dtype=np.float64)
+    quotas = np.round(epoch_fraction * counts.sum() * share / share.sum()).astype(np.int64)
+    majority = int(np.argmax(counts))
+    quotas[majority] = min(quotas[majority], int(round(majority_fraction * counts[majority])))
+    # every class with items and a weight keeps at least one per epoch
+    return np.where((share > 0) & (quotas < 1), 1, quotas)
+
+
+class ClassBalancedSampler(object):
+    """
+    :param labels: class index of every item of the dataset.
+    :param num_parts, part_index: the part of each epoch this host samples.
+    Other parameters as in the module docstring.
+    """
+
+    def __init__(self, labels, weighting='uniform', epoch_fraction=1.0, majority_fraction=1.0,
+                 num_parts=1, part_index=0, seed=0):
+        labels = np.asarray(labels, dtype=np.int64)
+        # label index: the items of each class
+        self._items = [np.flatnonzero(labels == c) for c in range(int(labels.max()) + 1)]
+        self.quotas = class_quotas([len(i) for i in self._items], weighting, epoch_fraction, majority_fraction)
+        self._num_parts = num_parts
+        self._part_index = part_index
+        self._seed = seed
+        self._epoch = 0
+        print('Class-balanced sampling: {0} of {1} items per epoch, per class {2}'.format(
+            int(self.quotas.sum()), len(labels), self.quotas.tolist()))
+
+    def _stream(self, cls, start, stop):
+        """Items start..stop of the stream of permutations of class `cls`."""
+        items = self._items[cls]
+        n = len(items)
+        cycles = [np.random.RandomState([self._seed, cls, cycle]).permutation(items)
+                  for cycle in range(start // n, (stop - 1) // n + 1)]
+        first = (start // n) * n
+        return np.concatenate(cycles)[start - first:stop - first]
+
+    def __iter__(self):
+        epoch = self._epoch
+        self._epoch += 1
+        picked = [self._stream(c, epoch * q, (epoch + 1) * q) for c, q in enumerate(self.quotas) if q > 0]
+        perm = np.random.RandomState([self._seed, epoch]).permutation(np.concatenate(picked))
+        return iter(perm[self._part_index::self._num_parts][:len(self)].tolist())
+
+    def __len__(self):
+        # equal parts keep the hosts in step for dist_sync
+        return int(self.quotas.sum()) // self._num_parts
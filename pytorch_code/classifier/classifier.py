@@ -2,17 +2,101 @@
 # SPDX-License-Identifier: MIT-0
 import ast
 import argparse
-import requests, io, time
+import io, time
 import os
 from shutil import copyfile
 
 from fastai.vision import *
 from fastai import *
 from fastai.callbacks import *
+import PIL.Image
+
+from wafer_store import WaferStore, WAFERMAP_CONTENT_TYPE, decode_wafermaps
+from wafer_data import wafer_store_databunch
+from wafer_net import WaferNet, WAFER_SIZE
+from wafer_preprocess import Preprocessor
+from train_profiler import EpochProfiler
+from class_sampler import ClassBalancedSampler, WEIGHTINGS
+import prediction_cache
+import url_fetch
 
 JSON_CONTENT_TYPE = 'application/json'
 JPEG_CONTENT_TYPE = 'image/jpeg'
 PNG_CONTENT_TYPE = 'image/png'
+NPY_CONTENT_TYPE = 'application/x-npy'
+IMAGE_SIZE = 224
+
+# Network input per --network, saved in model.json for serve.py and test_code/evaluate.py.
+#   resnet18  ImageNet resnet18: RGB, the shorter side scaled to 224 and center-cropped
+#   wafernet  WaferNet (wafer_net.py): the die states in one channel, squished to 64x64
+#             with nearest neighbour so each pixel stays one of the three states
+INPUT_SPECS = dict(
+    resnet18 = dict(network = 'resnet18', channels = 3, size = IMAGE_SIZE, resize = 'crop', interpolation = 'bilinear'),
+    wafernet = dict(network = 'wafernet', channels = 1, size = WAFER_SIZE, resize = 'squish', interpolation = 'nearest'))
+
+# optional cache of predictions for repeated inputs, see prediction_cache.py
+cache = prediction_cache.from_env()
+# pooled, cached fetching for URL requests, see url_fetch.py
+fetcher = url_fetch.from_env()
+# batched preprocessing of the loaded model's input, see wafer_preprocess.py
+preprocess = None
+
+
+class ProfilerCallback(LearnerCallback):
+    "Feeds the per-stage timings and per-class validation recall of each fit epoch into an `EpochProfiler`."
+
+    def __init__(self, learn, profiler):
+        super().__init__(learn)
+        self.profiler = profiler
+        self.sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+
+    def _mark(self, stage=None):
+        self.sync()
+        now = time.time()
+        if stage is not None:
+            self.profiler.add(stage, now - self.tic)
+        self.tic = now
+
+    def on_epoch_begin(self, epoch, **kwargs):
+        self.profiler.start_epoch(epoch)
+        self.valid_tic = None
+        self.confusion = torch.zeros(self.learn.data.c, self.learn.data.c, dtype=torch.long)
+        self._mark()
+        self.epoch_tic = self.tic
+
+    def on_batch_begin(self, last_input, train, **kwargs):
+        if train:
+            self._mark('data_wait')
+            self.profiler.add_samples(last_input.size(0))
+        elif self.valid_tic is None:
+            self.valid_tic = time.time()
+            self.profiler.train_time = self.valid_tic - self.epoch_tic
+
+    def on_backward_end(self, **kwargs):
+        self._mark('forward_backward')
+
+    def on_step_end(self, **kwargs):
+        self._mark('optimizer')
+
+    def on_batch_end(self, last_output, last_target, train, **kwargs):
+        if train:
+            self._mark()
+        else:
+            pairs = last_target.cpu() * self.learn.data.c + last_output.argmax(dim=1).cpu()
+            self.confusion += torch.bincount(pairs, minlength=self.learn.data.c ** 2).view_as(self.confusion)
+
+    def on_epoch_end(self, last_metrics, **kwargs):
+        if self.valid_tic is not None:
+            self.profiler.add('validation', time.time() - self.valid_tic)
+        extra = {}
+        if last_metrics is not None and len(last_metrics) > 1:
+            extra['valid_accuracy'] = float(last_metrics[1])
+        support = self.confusion.sum(dim=1)
+        if support.sum() > 0:
+            recall = [float(self.confusion[c, c]) / float(support[c]) if support[c] else None
+                      for c in range(len(support))]
+            extra.update(valid_recall = recall, valid_min_recall = min((r for r in recall if r is not None), default = None))
+        self.profiler.end_epoch(**extra)
 
 
 def _train(args):
@@ -28,32 +112,78 @@ def _train(args):
 
     print("Loading dataset")
     DATA = Path(args.data_dir)
-    tfms = get_transforms(flip_vert=True, max_lighting = None, max_warp = None)
-    data = ImageDataBunch.from_folder(DATA, ds_tfms=tfms, size=224, num_workers=args.workers, bs=args.batch_size)
+    spec = INPUT_SPECS[args.network]
+    if args.network == 'wafernet':
+        # flips and right-angle rotations only: zooms and lighting would blend the die states
+        tfms = get_transforms(flip_vert=True, max_rotate=0., max_zoom=1., max_lighting=None, max_warp=None)
+        tfm_kwargs = dict(resize_method=ResizeMethod.SQUISH, mode='nearest')
+    else:
+        tfms = get_transforms(flip_vert=True, max_lighting = None, max_warp = None)
+        tfm_kwargs = {}
+    if WaferStore.exists(DATA/'train'):
+        data = wafer_store_databunch(DATA, ds_tfms=tfms, size=spec['size'], channels=spec['channels'],
+                                     tfm_kwargs=tfm_kwargs, num_workers=args.workers, bs=args.batch_size)
+    elif args.network == 'wafernet':
+        data = (ImageList.from_folder(DATA, convert_mode='L').split_by_folder().label_from_folder()
+                .transform(tfms, size=spec['size'], **tfm_kwargs)
+                .databunch(num_workers=args.workers, bs=args.batch_size))
+    else:
+        data = ImageDataBunch.from_folder(DATA, ds_tfms=tfms, size=IMAGE_SIZE, num_workers=args.workers, bs=args.batch_size)
     print("Model loaded: {0}".format(str(data)))
-    learn = create_cnn(data, models.resnet18, metrics=accuracy)
+    if args.sampling != 'uniform' or args.epoch_fraction != 1.0 or args.majority_fraction != 1.0:
+        # class-aware epochs drawn from the training labels, see class_sampler.py
+        sampler = ClassBalancedSampler(data.train_ds.y.items, args.sampling, args.epoch_fraction,
+                                       args.majority_fraction)
+        data.train_dl = data.train_dl.new(shuffle = False, sampler = sampler)
+    if args.network == 'wafernet':
+        data.normalize((torch.tensor([0.5]), torch.tensor([0.5])))
+        learn = Learner(data, WaferNet(classes=data.c), metrics=accuracy)
+    else:
+        learn = create_cnn(data, models.resnet18, metrics=accuracy)
 
     if torch.cuda.device_count() > 1:
         print("Gpu count: {}".format(torch.cuda.device_count()))
 
     cb_val_loss = TrackerCallback(learn, monitor='val_loss')
     cb_accuracy = TrackerCallback(learn, monitor='accuracy')
-    learn.fit_one_cycle(args.epochs, max_lr=args.lr, callbacks=[cb_val_loss, cb_accuracy])
+    profiler = EpochProfiler(os.path.join(args.output_data_dir, 'train_profile.jsonl'),
+                             target_accuracy = args.target_accuracy)
+    cb_profiler = ProfilerCallback(learn, profiler)
+    learn.fit_one_cycle(args.epochs, max_lr=args.lr, callbacks=[cb_val_loss, cb_accuracy, cb_profiler])
     accuracy_val = cb_accuracy.get_monitor_value().item()
     loss_val = cb_val_loss.get_monitor_value()
 
     print('Finished Training')
+    if args.target_accuracy is not None and not profiler.target_reached:
+        print("Target accuracy {0} not reached in {1} epochs".format(args.target_accuracy, args.epochs))
     print("METRIC_ACCURACY={0}".format(str(accuracy_val)))
     print("METRIC_VAL_LOSS={0}".format(str(loss_val)))
-    return _save_model(learn, args.model_dir)
+    return _save_model(learn, args.model_dir, args.network)
 
 
-def _save_model(learner, model_dir):
+def _save_model(learner, model_dir, network='resnet18'):
     print("Saving the model.")
     path = Path(os.path.join(model_dir, 'model.pth'))
     epath = Path(os.path.join(model_dir, 'model.pkl'))
     learner.save(path)
     learner.export(epath)
+    _save_torchscript(learner, model_dir, network)
+
+
+def _save_torchscript(learner, model_dir, network='resnet18'):
+    # a traced module plus its input spec, loaded by serve.py without importing fastai
+    print("Saving the TorchScript model.")
+    spec = dict(INPUT_SPECS[network])
+    model = learner.model.cpu().eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros(1, spec['channels'], spec['size'], spec['size']))
+    traced.save(os.path.join(model_dir, 'model.pt'))
+    stats = getattr(learner.data, 'stats', None)
+    spec.update(classes = [str(c) for c in learner.data.classes],
+                mean = [float(v) for v in stats[0]] if stats is not None else None,
+                std = [float(v) for v in stats[1]] if stats is not None else None)
+    with open(os.path.join(model_dir, 'model.json'), 'w') as fout:
+        json.dump(spec, fout)
 
 
 def model_fn(model_dir):
@@ -64,31 +194,73 @@ def model_fn(model_dir):
 
     copyfile(os.path.join(model_dir, 'model.pkl'), '/tmp/export.pkl')
     learn = load_learner(path='/tmp')
+    global preprocess
+    if os.path.exists(os.path.join(model_dir, 'model.json')):
+        with open(os.path.join(model_dir, 'model.json')) as fin:
+            spec = dict(INPUT_SPECS['resnet18'], **json.load(fin))
+    else:
+        # exported before model.json: the resnet18 input, normalised like the data bunch
+        stats = getattr(learn.data, 'stats', None)
+        spec = dict(INPUT_SPECS['resnet18'],
+                    mean = [float(v) for v in stats[0]] if stats is not None else None,
+                    std = [float(v) for v in stats[1]] if stats is not None else None)
+    # the same transforms as the validation set, applied a batch at a time; die states
+    # have the intensities of wafer_data.wafer_to_image
+    preprocess = Preprocessor(spec, wafer_scale = 0.5)
+    if cache is not None:
+        cache.set_model_version(prediction_cache.file_digest([os.path.join(model_dir, 'model.pkl')]))
 
     return learn
 
+def _open_image(fn):
+    "(H, W, 3) uint8 pixels of an encoded image; the model input is made by `preprocess`."
+    return np.asarray(PIL.Image.open(fn).convert('RGB'))
+
 # Deserialize the Invoke request body into an object we can perform prediction on
 def input_fn(request_body, content_type=JPEG_CONTENT_TYPE):
     print('Deserializing the input data.')
     # process an image uploaded to the endpoint
-    if content_type == JPEG_CONTENT_TYPE: return open_image(io.BytesIO(request_body))
-    if content_type == PNG_CONTENT_TYPE: return open_image(io.BytesIO(request_body))
-    # process a URL submitted to the endpoint
+    if content_type == JPEG_CONTENT_TYPE: return _open_image(io.BytesIO(request_body))
+    if content_type == PNG_CONTENT_TYPE: return _open_image(io.BytesIO(request_body))
+    # process a URL, or a list of URLs fetched in parallel, submitted to the endpoint
     if content_type == JSON_CONTENT_TYPE:
-        img_request = requests.get(request_body['url'], stream=True)
-        return open_image(io.BytesIO(img_request.content))
+        bodies = fetcher.fetch_request(request_body)
+        if isinstance(bodies, list): return [_open_image(io.BytesIO(body)) for body in bodies]
+        return _open_image(io.BytesIO(bodies))
+    # process bit-packed wafer maps, or a 2-D map / (N, H, W) stack of die states;
+    # several maps deserialize to a list and are predicted as one batch
+    if content_type == WAFERMAP_CONTENT_TYPE:
+        return [np.asarray(w, dtype=np.uint8) for w in decode_wafermaps(request_body)]
+    if content_type == NPY_CONTENT_TYPE:
+        arr = np.load(io.BytesIO(request_body), allow_pickle=False).astype(np.uint8, copy=False)
+        return arr if arr.ndim == 2 else list(arr)
     raise Exception('Requested unsupported ContentType in content_type: {}'.format(content_type))
 
 # Perform prediction on the deserialized object, with the loaded model
 def predict_fn(input_object, model):
-    print("Calling model")
+    if isinstance(input_object, list): return predict_batch_fn(input_object, model)
+    prediction = predict_batch_fn([input_object], model)[0]
+    print(f'Predicted class is {prediction["cls"]}')
+    print(f'Predict confidence score is {prediction["confidence"]}')
+    return prediction
+
+# Perform prediction on several deserialized objects with a single forward pass
+def predict_batch_fn(input_objects, model):
+    keys = [cache.key(x) for x in input_objects] if cache is not None else None
+    predictions = [cache.get(k) for k in keys] if cache is not None else [None] * len(input_objects)
+    misses = [i for i, p in enumerate(predictions) if p is None]
+    if not misses: return predictions
+    print("Calling model on a batch of {0}".format(len(misses)))
     start_time = time.time()
-    predict_class,predict_idx,predict_values = model.predict(input_object)
+    xb = torch.from_numpy(preprocess([input_objects[i] for i in misses])).to(model.data.device)
+    with torch.no_grad():
+        probs = torch.softmax(model.model.eval()(xb), dim=1)
+    confidence, idx = probs.max(dim=1)
     print("--- Inference time: %s seconds ---" % (time.time() - start_time))
-    print(f'Predicted class is {str(predict_class)}')
-    print(f'Predict confidence score is {predict_values[predict_idx.item()].item()}')
-    return dict(cls = str(predict_class),
-        confidence = predict_values[predict_idx.item()].item())
+    for i, c, conf in zip(misses, idx.tolist(), confidence.tolist()):
+        predictions[i] = dict(cls = str(model.data.classes[c]), confidence = conf)
+        if cache is not None: cache.put(keys[i], predictions[i])
+    return predictions
 
 # Serialize the prediction result into the desired response content type
 def output_fn(prediction, accept=JSON_CONTENT_TYPE):        
@@ -110,6 +282,16 @@ if __name__ == '__main__':
                         help='initial learning rate (default: 0.001)')
     parser.add_argument('--momentum', type=float, default=0.9, metavar='M', help='momentum (default: 0.9)')
     parser.add_argument('--dist-backend', type=str, default='gloo', help='distributed backend (default: gloo)')
+    parser.add_argument('--network', type=str, default='resnet18', choices=sorted(INPUT_SPECS),
+                        help='resnet18 on 224x224 RGB, or wafernet on 64x64 single-channel maps (default: resnet18)')
+    parser.add_argument('--sampling', type=str, default='uniform', choices=WEIGHTINGS,
+                        help='share of each class in an epoch, see class_sampler.py (default: uniform)')
+    parser.add_argument('--epoch-fraction', type=float, default=1.0,
+                        help='images per epoch as a fraction of the training set (default: 1.0)')
+    parser.add_argument('--majority-fraction', type=float, default=1.0,
+                        help='at most this fraction of the largest class per epoch (default: 1.0)')
+    parser.add_argument('--target-accuracy', type=float, default=None,
+                        help='log the time until the validation accuracy first reaches this value')
 
     # The parameters below retrieve their default values from SageMaker environment variables, which are
     # instantiated by the SageMaker containers framework.
@@ -118,6 +300,8 @@ if __name__ == '__main__':
     parser.add_argument('--current-host', type=str, default=os.environ['SM_CURRENT_HOST'])
     parser.add_argument('--model-dir', type=str, default=os.environ['SM_MODEL_DIR'])
     parser.add_argument('--data-dir', type=str, default=os.environ['SM_CHANNEL_TRAINING'])
+    parser.add_argument('--output-data-dir', type=str,
+                        default=os.environ.get('SM_OUTPUT_DATA_DIR', '/opt/ml/output/data'))
     parser.add_argument('--num-gpus', type=int, default=os.environ['SM_NUM_GPUS'])
 
     _train(parser.parse_args())
@@ -0,0 +1,164 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Prediction cache keyed by the content of the decoded input and the model version.
+
+Many wafer maps are identical at the pixel level, so the serving paths look a
+prediction up by a SHA-1 hash of the decoded array before running the model.
+Entries live in a bounded in-process LRU and, optionally, in a SQLite file
+that survives restarts.  The model version is a hash of the model files; when
+a different model is loaded, set_model_version drops every entry made with
+the previous one.
+
+Configured from the environment by from_env():
+
+    PREDICTION_CACHE_SIZE   entries kept in memory; 0 disables the cache (default: 0)
+    PREDICTION_CACHE_DIR    folder for the on-disk tier (default: none)
+    PREDICTION_CACHE_DISK_ENTRIES
+                            rows kept in the on-disk tier (default: 100000)
+    PREDICTION_CACHE_COMMIT_EVERY
+                            new entries per SQLite commit (default: 64)
+    PREDICTION_CACHE_COMMIT_SEC
+                            longest wait before new entries are committed (default: 5)
+
+The SQLite file is opened in WAL mode with synchronous=NORMAL and puts are
+committed in batches, so a cache miss doesn't pay for an fsync on the edge
+device's SD card.  A crash loses at most the last uncommitted batch, which
+only costs those predictions being made again.  Each commit also drops the
+oldest rows beyond the disk bound, so the file stops growing.
+
+This module only depends on numpy, runs on Python 2.7 (the Greengrass
+runtime) and 3, and is shipped with each serving directory (notebooks,
+pytorch_code/classifier, lambda-rpi-inference); keep the copies identical.
+"""
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def file_digest(paths, chunk_size=1 << 20):
+    """Hash of the contents of the model files, used as the model version."""
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class PredictionCache(object):
+    def __init__(self, max_entries=10000, disk_dir=None, commit_every=64, commit_sec=5.0,
+                 max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.commit_every = commit_every
+        self.commit_sec = commit_sec
+        self.model_version = ''
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._pending = 0
+        self._last_commit = time.time()
+        if disk_dir:
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            self._db = sqlite3.connect(os.path.join(disk_dir, 'predictions.sqlite'), check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                             '(key TEXT PRIMARY KEY, version TEXT, value TEXT)')
+            self._db.commit()
+            atexit.register(self.flush)
+
+    def set_model_version(self, version):
+        """Invalidate every entry made with another model."""
+        with self._lock:
+            if version == self.model_version:
+                return
+            self.model_version = version
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM predictions WHERE version != ?', (version,))
+                self._commit()
+
+    def key(self, array):
+        array = np.ascontiguousarray(array)
+        h = hashlib.sha1(('%s%s%s' % (self.model_version, array.dtype.str, array.shape)).encode())
+        h.update(array.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                 (key, self.model_version, json.dumps(value)))
+                self._pending += 1
+                if self._pending >= self.commit_every or time.time() - self._last_commit >= self.commit_sec:
+                    self._commit()
+
+    def flush(self):
+        """Commit the entries not yet written to the on-disk tier."""
+        with self._lock:
+            if self._db is not None and self._pending:
+                self._commit()
+
+    def _commit(self):
+        # INSERT OR REPLACE gives a row the next rowid, so the lowest rowids are the oldest rows
+        self._db.execute('DELETE FROM predictions WHERE rowid <= (SELECT MAX(rowid) FROM predictions) - ?',
+                         (self.max_disk_entries,))
+        self._db.commit()
+        self._pending = 0
+        self._last_commit = time.time()
+
+    def _remember(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'model_version': self.model_version}
+
+
+def from_env():
+    """PredictionCache configured from the environment, or None when disabled."""
+    size = int(os.environ.get('PREDICTION_CACHE_SIZE', 0))
+    if size <= 0:
+        return None
+    return PredictionCache(size, os.environ.get('PREDICTION_CACHE_DIR'),
+                           int(os.environ.get('PREDICTION_CACHE_COMMIT_EVERY', 64)),
+                           float(os.environ.get('PREDICTION_CACHE_COMMIT_SEC', 5)),
+                           int(os.environ.get('PREDICTION_CACHE_DISK_ENTRIES', 100000)))
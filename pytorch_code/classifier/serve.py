@@ -0,0 +1,146 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Lean hosting entry point for the PyTorch endpoint.
+
+classifier.py imports all of fastai before it can load model.pkl, which
+dominates the cold start of a new endpoint instance.  Training also writes
+model.pt (the network traced with TorchScript) and model.json (class names,
+input size and normalisation stats); this module serves those with torch,
+numpy and PIL only.  The preprocessing (wafer_preprocess.py, built from
+model.json) mirrors the fastai validation transforms: scale the shorter side
+to `size`, center crop, scale to [0, 1] and normalise when the data bunch was
+normalised.  A wafernet model (model.json "channels": 1) instead gets the
+first channel squished to `size` with nearest neighbour, so each pixel stays
+one of the three die states.
+
+Models trained before the TorchScript export have no model.pt; for those every
+handler is delegated to classifier.py.
+
+deploy_code/deploy.py selects this module with SAGEMAKER_PROGRAM=serve.py;
+training keeps using classifier.py.  Measure the difference with
+pytorch_code/cold_start.py.
+"""
+import importlib
+import io
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from wafer_store import WAFERMAP_CONTENT_TYPE, decode_wafermaps
+from wafer_preprocess import Preprocessor
+import prediction_cache
+import url_fetch
+
+JSON_CONTENT_TYPE = 'application/json'
+JPEG_CONTENT_TYPE = 'image/jpeg'
+PNG_CONTENT_TYPE = 'image/png'
+NPY_CONTENT_TYPE = 'application/x-npy'
+
+SCRIPT_FILE = 'model.pt'
+SPEC_FILE = 'model.json'
+
+# optional cache of predictions for repeated inputs, see prediction_cache.py
+cache = prediction_cache.from_env()
+# pooled, cached fetching for URL requests, see url_fetch.py
+fetcher = url_fetch.from_env()
+
+# classifier.py, when the model has no TorchScript export
+_fallback = None
+
+
+class ScriptedModel(object):
+    def __init__(self, model_dir, device):
+        self.device = device
+        self.module = torch.jit.load(os.path.join(model_dir, SCRIPT_FILE), map_location=device).eval()
+        with open(os.path.join(model_dir, SPEC_FILE)) as fin:
+            spec = json.load(fin)
+        self.classes = spec['classes']
+        self.preprocess = preprocessor(spec)
+
+
+def preprocessor(spec):
+    "The `Preprocessor` for a model.json spec; the die states have the intensities of wafer_data.wafer_to_image."
+    # model.json files written before wafernet describe the resnet18 input
+    spec = dict(dict(channels = 3, resize = 'crop', interpolation = 'bilinear'), **spec)
+    return Preprocessor(spec, wafer_scale = 0.5)
+
+
+def open_image(body):
+    "Encoded JPEG/PNG bytes as (H, W, 3) uint8 pixels."
+    return np.asarray(Image.open(io.BytesIO(body)).convert('RGB'))
+
+
+def wafer_map(wafer):
+    "Die states 0/1/2 as the uint8 map the preprocessor reads."
+    return np.asarray(wafer, dtype=np.uint8)
+
+
+def model_fn(model_dir):
+    global _fallback
+    print('model_fn')
+    if not os.path.exists(os.path.join(model_dir, SCRIPT_FILE)):
+        print('No TorchScript model, falling back to classifier.py')
+        _fallback = importlib.import_module('classifier')
+        return _fallback.model_fn(model_dir)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    start_time = time.time()
+    model = ScriptedModel(model_dir, device)
+    print("--- Model load time: %s seconds ---" % (time.time() - start_time))
+    if cache is not None:
+        cache.set_model_version(prediction_cache.file_digest([os.path.join(model_dir, SCRIPT_FILE)]))
+    return model
+
+# Deserialize the Invoke request body into an object we can perform prediction on
+def input_fn(request_body, content_type=JPEG_CONTENT_TYPE):
+    if _fallback is not None: return _fallback.input_fn(request_body, content_type)
+    print('Deserializing the input data.')
+    if content_type in (JPEG_CONTENT_TYPE, PNG_CONTENT_TYPE): return open_image(request_body)
+    # a URL, or a list of URLs fetched in parallel
+    if content_type == JSON_CONTENT_TYPE:
+        bodies = fetcher.fetch_request(request_body)
+        if isinstance(bodies, list): return [open_image(body) for body in bodies]
+        return open_image(bodies)
+    # bit-packed wafer maps, or a 2-D map / (N, H, W) stack of die states
+    if content_type == WAFERMAP_CONTENT_TYPE:
+        return [wafer_map(w) for w in decode_wafermaps(request_body)]
+    if content_type == NPY_CONTENT_TYPE:
+        arr = np.load(io.BytesIO(request_body), allow_pickle=False)
+        return wafer_map(arr) if arr.ndim == 2 else [wafer_map(w) for w in arr]
+    raise Exception('Requested unsupported ContentType in content_type: {}'.format(content_type))
+
+# Perform prediction on the deserialized object, with the loaded model
+def predict_fn(input_object, model):
+    if _fallback is not None: return _fallback.predict_fn(input_object, model)
+    if isinstance(input_object, list): return predict_batch_fn(input_object, model)
+    return predict_batch_fn([input_object], model)[0]
+
+# Perform prediction on several deserialized objects with a single forward pass
+def predict_batch_fn(input_objects, model):
+    if _fallback is not None: return _fallback.predict_batch_fn(input_objects, model)
+    keys = [cache.key(x) for x in input_objects] if cache is not None else None
+    predictions = [cache.get(k) for k in keys] if cache is not None else [None] * len(input_objects)
+    misses = [i for i, p in enumerate(predictions) if p is None]
+    if not misses: return predictions
+    print("Calling model on a batch of {0}".format(len(misses)))
+    start_time = time.time()
+    xb = torch.from_numpy(model.preprocess([input_objects[i] for i in misses])).to(model.device)
+    with torch.no_grad():
+        probs = torch.softmax(model.module(xb), dim=1)
+    confidence, idx = probs.max(dim=1)
+    print("--- Inference time: %s seconds ---" % (time.time() - start_time))
+    for i, c, conf in zip(misses, idx.tolist(), confidence.tolist()):
+        predictions[i] = dict(cls = model.classes[c], confidence = conf)
+        if cache is not None: cache.put(keys[i], predictions[i])
+    return predictions
+
+# Serialize the prediction result into the desired response content type
+def output_fn(prediction, accept=JSON_CONTENT_TYPE):
+    print('Serializing the generated output.')
+    if accept == JSON_CONTENT_TYPE: return json.dumps(prediction), accept
+    raise Exception('Requested unsupported ContentType in Accept: {}'.format(accept))
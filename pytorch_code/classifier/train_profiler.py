@@ -0,0 +1,121 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Per-stage training throughput instrumentation shared by the MxNet and fastai
+trainers.
+
+For every epoch the profiler records the time spent waiting on the data
+loader, in forward/backward, in the optimizer step and in validation, plus
+images/s and peak RSS.  Each epoch is appended to a JSON-lines file and printed
+as METRIC_<NAME>=<value> lines, which the metric_definitions in
+trainer_code/trainer.py pick up.
+
+The wall time and images seen since the profiler was created are counted too.
+With a target accuracy, the epoch whose valid_accuracy first reaches it also
+records time_to_target_sec, images_to_target and epochs_to_target, so that
+changes such as class-balanced sampling (class_sampler.py) can be compared by
+time to accuracy instead of time per epoch.
+
+This module has no framework dependency and is shipped with each deployment
+directory (notebooks, pytorch_code/classifier); keep the copies identical.
+"""
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+STAGES = ['data_wait', 'forward_backward', 'optimizer', 'validation']
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class EpochProfiler(object):
+    """
+    :param log_path: JSON-lines file to append epoch records to, or None.
+    :param sync: optional callable that blocks until queued device work is
+                 done (e.g. mx.nd.waitall), so asynchronous engines are timed
+                 in the stage that issued the work.
+    :param target_accuracy: optional valid_accuracy to report the time to.
+    """
+
+    def __init__(self, log_path=None, sync=None, target_accuracy=None):
+        self.log_path = log_path
+        self.sync = sync
+        self.target_accuracy = target_accuracy
+        self.target_reached = False
+        self.images_seen = 0
+        self._start = time.time()
+        if log_path and os.path.dirname(log_path) and not os.path.isdir(os.path.dirname(log_path)):
+            os.makedirs(os.path.dirname(log_path))
+        self.start_epoch(0)
+
+    def start_epoch(self, epoch):
+        self.epoch = epoch
+        self.times = dict((stage, 0.0) for stage in STAGES)
+        self.samples = 0
+        self.train_time = 0.0
+        self._epoch_start = time.time()
+
+    def add(self, stage, seconds):
+        self.times[stage] += seconds
+
+    def add_samples(self, n):
+        self.samples += int(n)
+
+    @contextmanager
+    def stage(self, name):
+        tic = time.time()
+        yield
+        if self.sync is not None:
+            self.sync()
+        self.add(name, time.time() - tic)
+
+    def iter_data(self, loader):
+        """Iterate over `loader`, charging the time spent in next() to data_wait."""
+        tic = time.time()
+        it = iter(loader)
+        while True:
+            wait_tic = time.time()
+            try:
+                batch = next(it)
+            except StopIteration:
+                break
+            self.add('data_wait', time.time() - wait_tic)
+            yield batch
+        self.train_time += time.time() - tic
+
+    def end_epoch(self, **extra):
+        """Write the record for the current epoch and return it."""
+        train_time = self.train_time or (time.time() - self._epoch_start - self.times['validation'])
+        record = {'epoch': self.epoch,
+                  'data_wait_sec': self.times['data_wait'],
+                  'forward_backward_sec': self.times['forward_backward'],
+                  'optimizer_sec': self.times['optimizer'],
+                  'validation_sec': self.times['validation'],
+                  'train_sec': train_time,
+                  'images_per_sec': self.samples / train_time if train_time > 0 else 0.0,
+                  'peak_rss_mb': peak_rss_mb()}
+        record.update(extra)
+        self.images_seen += self.samples
+        record.update(elapsed_sec=time.time() - self._start, images_seen=self.images_seen)
+        valid_accuracy = record.get('valid_accuracy')
+        if (self.target_accuracy is not None and not self.target_reached and valid_accuracy is not None
+                and valid_accuracy >= self.target_accuracy):
+            self.target_reached = True
+            record.update(time_to_target_sec=record['elapsed_sec'], images_to_target=self.images_seen,
+                          epochs_to_target=self.epoch + 1)
+
+        for key, value in sorted(record.items()):
+            # lists, e.g. per-class recall, only go to the log file; None has no metric value
+            if key != 'epoch' and value is not None and not isinstance(value, (list, dict)):
+                print("METRIC_{0}={1}".format(key.upper(), value))
+        if self.log_path:
+            with open(self.log_path, 'a') as fout:
+                fout.write(json.dumps(record) + '\n')
+        return record
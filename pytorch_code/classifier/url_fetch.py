@@ -0,0 +1,184 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Image fetching for URL requests to the PyTorch endpoint.
+
+One pooled requests.Session is shared by all requests, every call has connect
+and read timeouts, several URLs are fetched in parallel, and bodies are kept
+in a size-bounded local cache.  A cached body is served without touching the
+network for FETCH_CACHE_MAX_AGE seconds; after that it is revalidated with its
+ETag and a 304 keeps the cached copy.
+
+Configured from the environment by from_env():
+
+    FETCH_CONNECT_TIMEOUT   seconds (default: 3)
+    FETCH_READ_TIMEOUT      seconds (default: 10)
+    FETCH_MAX_WORKERS       parallel fetches for batch requests (default: 8)
+    FETCH_CACHE_DIR         cache folder; unset disables the cache (default: /tmp/url_cache)
+    FETCH_CACHE_MAX_BYTES   approximate cache size bound (default: 256 MB)
+    FETCH_CACHE_MAX_AGE     seconds a cached body is used without revalidation (default: 3600)
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class UrlFetcher(object):
+    def __init__(self, session=None, connect_timeout=3.0, read_timeout=10.0, max_workers=8,
+                 cache_dir=None, cache_max_bytes=256 << 20, cache_max_age=3600.0, max_body_bytes=64 << 20):
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.timeout = (connect_timeout, read_timeout)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_max_age = cache_max_age
+        self.max_body_bytes = max_body_bytes
+        self._stored_since_evict = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def fetch(self, url):
+        """Return the body of `url` as bytes."""
+        body_path, meta_path = self._cache_paths(url)
+        meta = self._read_meta(meta_path) if self.cache_dir else None
+        if meta is not None and time.time() - meta['fetched'] < self.cache_max_age:
+            body = self._read_body(body_path)
+            if body is not None:
+                return body
+        headers = {'If-None-Match': meta['etag']} if meta is not None and meta.get('etag') else {}
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                body = self._read_body(body_path)
+                if body is not None:
+                    meta['fetched'] = time.time()
+                    self._write_meta(meta_path, meta)
+                    return body
+                # evicted in the meantime by another worker
+                return self._fetch_uncached(url)
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 << 10):
+                size += len(chunk)
+                if size > self.max_body_bytes:
+                    raise ValueError('Body of {0} is larger than {1} bytes'.format(url, self.max_body_bytes))
+                chunks.append(chunk)
+            body = b''.join(chunks)
+            etag = response.headers.get('ETag')
+
+        if self.cache_dir:
+            self._store(body_path, meta_path, body, {'url': url, 'etag': etag, 'fetched': time.time()})
+        return body
+
+    def _fetch_uncached(self, url):
+        meta_path = self._cache_paths(url)[1]
+        try:
+            os.remove(meta_path)
+        except OSError:
+            pass
+        return self.fetch(url)
+
+    def fetch_many(self, urls):
+        """Fetch `urls` in parallel; bodies are returned in the same order."""
+        return list(self.executor.map(self.fetch, urls))
+
+    def fetch_request(self, request_body):
+        """
+        Bodies for a JSON request, {"url": ...} for one body or {"urls": [...]}
+        for a list.  SageMaker hands input_fn the raw bytes; an already parsed
+        dict is accepted too.
+        """
+        if isinstance(request_body, (bytes, bytearray)):
+            request_body = request_body.decode('utf-8')
+        if isinstance(request_body, str):
+            request_body = json.loads(request_body)
+        if 'urls' in request_body:
+            return self.fetch_many(request_body['urls'])
+        return self.fetch(request_body['url'])
+
+    def _cache_paths(self, url):
+        if not self.cache_dir:
+            return None, None
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.body'), os.path.join(self.cache_dir, key + '.json')
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as fin:
+                return json.load(fin)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        tmp = meta_path + '.tmp%d' % os.getpid()
+        with open(tmp, 'w') as fout:
+            json.dump(meta, fout)
+        os.replace(tmp, meta_path)
+
+    def _read_body(self, body_path):
+        """Cached body, or None if it was evicted."""
+        try:
+            with open(body_path, 'rb') as fin:
+                body = fin.read()
+            # modification time doubles as last access time for eviction
+            os.utime(body_path, None)
+        except (IOError, OSError):
+            return None
+        return body
+
+    def _store(self, body_path, meta_path, body, meta):
+        if len(body) > self.cache_max_bytes:
+            return
+        tmp = body_path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as fout:
+            fout.write(body)
+        os.replace(tmp, body_path)
+        self._write_meta(meta_path, meta)
+        # scanning the folder is O(entries), so only do it after a tenth of the bound was written;
+        # the cache can overshoot its bound by that much
+        self._stored_since_evict += len(body)
+        if self._stored_since_evict >= self.cache_max_bytes // 10:
+            self._stored_since_evict = 0
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used bodies until the cache fits in cache_max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.body'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_max_bytes:
+                break
+            for victim in (path, path[:-len('.body')] + '.json'):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
+
+
+def from_env():
+    return UrlFetcher(connect_timeout=float(os.environ.get('FETCH_CONNECT_TIMEOUT', 3)),
+                      read_timeout=float(os.environ.get('FETCH_READ_TIMEOUT', 10)),
+                      max_workers=int(os.environ.get('FETCH_MAX_WORKERS', 8)),
+                      cache_dir=os.environ.get('FETCH_CACHE_DIR', '/tmp/url_cache') or None,
+                      cache_max_bytes=int(os.environ.get('FETCH_CACHE_MAX_BYTES', 256 << 20)),
+                      cache_max_age=float(os.environ.get('FETCH_CACHE_MAX_AGE', 3600)))
@@ -0,0 +1,50 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+fastai data adapters for the packed wafer store (see wafer_store.py).
+
+These live outside classifier.py so that a Learner exported with them can be
+unpickled by the hosting process, which imports classifier.py as a module.
+"""
+from fastai.vision import *
+
+from wafer_store import WaferStore
+
+
+def wafer_to_image(wafer, channels=3):
+    "fastai `Image` of a map of 0/1/2 die states, at the same 0, .5, 1 intensities as the exported PNGs."
+    px = torch.from_numpy(np.ascontiguousarray(wafer, dtype=np.uint8)).float().div_(2.)
+    return Image(px.unsqueeze(0).repeat(channels, 1, 1))
+
+
+class WaferStoreImageList(ImageList):
+    "`ImageList` whose items are indices into a packed wafer store."
+
+    def __init__(self, items, store=None, channels=3, **kwargs):
+        super().__init__(items, **kwargs)
+        self.store = store
+        self.channels = channels
+        self.copy_new += ['store', 'channels']
+
+    @classmethod
+    def from_store(cls, path, **kwargs):
+        store = WaferStore(str(path))
+        return cls(np.arange(len(store)), store=store, path=path, **kwargs)
+
+    def open(self, i):
+        return wafer_to_image(self.store.wafer(int(i)), self.channels)
+
+
+def wafer_store_databunch(path, ds_tfms=None, size=224, channels=3, tfm_kwargs=None, **kwargs):
+    """
+    Equivalent of `ImageDataBunch.from_folder` for `path`/train and `path`/valid wafer stores.
+    `tfm_kwargs` go to `transform`, e.g. `resize_method` and `mode`.
+    """
+    path = Path(path)
+    train = WaferStoreImageList.from_store(path/'train', channels=channels)
+    valid = WaferStoreImageList.from_store(path/'valid', channels=channels)
+    classes = train.store.classes
+    lls = ItemLists(path, train, valid).label_from_lists([classes[l] for l in train.store.labels],
+                                                        [classes[l] for l in valid.store.labels],
+                                                        classes=classes)
+    return lls.transform(ds_tfms, size=size, **(tfm_kwargs or {})).databunch(**kwargs)
@@ -0,0 +1,40 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+WaferNet: a ResNet for single-channel wafer maps at their native resolution.
+
+Wafer maps hold one of three die states per pixel and are a few dozen dies
+across, so the 224x224 RGB input of an ImageNet resnet18 is mostly
+interpolated copies.  WaferNet takes the die states in one channel at 64x64
+(resized with nearest neighbour) and replaces the 7x7 stride-2 stem and max
+pooling, which would throw away three quarters of such a map, with one 3x3
+convolution at full resolution.  Four stages of two basic blocks follow, each
+halving the resolution.  The same architecture is WaferNet in
+notebooks/classify_mxnet.py.
+
+Kept outside classifier.py, like wafer_data.py, so that an exported Learner
+can be unpickled by the hosting process.
+"""
+import torch.nn as nn
+from torchvision.models.resnet import BasicBlock
+
+WAFER_SIZE = 64
+
+
+class WaferNet(nn.Module):
+    def __init__(self, classes=9, channels=(32, 64, 128, 256), in_channels=1):
+        super().__init__()
+        layers = [nn.Conv2d(in_channels, channels[0], 3, 1, 1, bias=False),
+                  nn.BatchNorm2d(channels[0]),
+                  nn.ReLU(inplace=True)]
+        inplanes = channels[0]
+        for planes in channels:
+            downsample = nn.Sequential(nn.Conv2d(inplanes, planes, 1, 2, bias=False), nn.BatchNorm2d(planes))
+            layers += [BasicBlock(inplanes, planes, 2, downsample), BasicBlock(planes, planes)]
+            inplanes = planes
+        layers += [nn.AdaptiveAvgPool2d(1)]
+        self.features = nn.Sequential(*layers)
+        self.output = nn.Linear(inplanes, classes)
+
+    def forward(self, x):
+        return self.output(self.features(x).view(x.size(0), -1))
@@ -0,0 +1,82 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Cold-start comparison of the fastai handler (classifier.py) and the
+TorchScript handler (serve.py).
+
+Each run starts a fresh interpreter, as a new endpoint instance does, and
+times the handler import, model_fn and the first prediction on a sample
+image.  Run it inside the training image against an unpacked model.tar.gz:
+
+    python cold_start.py /path/to/model sample.png --runs 5 --output cold_start_results.json
+
+and commit the results (medians and every run, with the host and torch
+version) with the change that affects start-up time.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classifier')
+
+# runs in the child interpreter
+PROBE = r'''
+import json, sys, time
+t0 = time.time()
+sys.path.insert(0, sys.argv[1])
+handler = __import__(sys.argv[2])
+t1 = time.time()
+model = handler.model_fn(sys.argv[3])
+t2 = time.time()
+with open(sys.argv[4], 'rb') as fin:
+    body = fin.read()
+handler.predict_fn(handler.input_fn(body, sys.argv[5]), model)
+t3 = time.time()
+print('COLD_START=' + json.dumps({'import': t1 - t0, 'model_fn': t2 - t1, 'first_predict': t3 - t2}))
+'''
+
+
+def probe(handler, model_dir, sample, content_type):
+    env = dict(os.environ, PREDICTION_CACHE_SIZE='0')
+    out = subprocess.check_output([sys.executable, '-c', PROBE, HANDLER_DIR, handler, model_dir,
+                                   sample, content_type], env=env).decode('utf-8')
+    line = [l for l in out.splitlines() if l.startswith('COLD_START=')][-1]
+    return json.loads(line[len('COLD_START='):])
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_dir', type=str, help='folder holding model.pkl, model.pt and model.json')
+    parser.add_argument('sample', type=str, help='image used for the first prediction')
+    parser.add_argument('--content-type', type=str, default='image/png', help='content type of the sample')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per handler (default: 5)')
+    parser.add_argument('--output', type=str, default=None, help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {'host': platform.node(), 'python': platform.python_version(), 'runs': args.runs, 'handlers': {}}
+    try:
+        import torch
+        results['torch'] = torch.__version__
+    except ImportError:
+        pass
+
+    print('{0:<12}{1:>10}{2:>10}{3:>15}{4:>10}'.format('handler', 'import', 'model_fn', 'first_predict', 'total'))
+    for handler in ('classifier', 'serve'):
+        runs = [probe(handler, args.model_dir, args.sample, args.content_type) for _ in range(args.runs)]
+        times = {k: median([r[k] for r in runs]) for k in ('import', 'model_fn', 'first_predict')}
+        print('{0:<12}{1:>10.2f}{2:>10.2f}{3:>15.2f}{4:>10.2f}'.format(
+            handler, times['import'], times['model_fn'], times['first_predict'], sum(times.values())))
+        results['handlers'][handler] = dict(times, total=sum(times.values()), all_runs=runs)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+        print('Wrote ' + args.output)
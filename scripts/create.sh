@@ -45,10 +45,19 @@ fi
 
 aws s3 sync $SCRIPTDIR/../cfn s3://$templatebucket/$templateprefix
 
+# Cloud Lambda functions in lambda-cloud.  The key is derived from the sources, so a
+# stack update deploys changed code.
+LAMBDA_HASH=`cat $SCRIPTDIR/../lambda-cloud/*.py | openssl md5 | awk '{print $NF}' | cut -c1-12`
+LAMBDA_KEY=$templateprefix/lambda-cloud-$LAMBDA_HASH.zip
+LAMBDA_ZIP=`mktemp -d`/lambda-cloud.zip
+(cd $SCRIPTDIR/../lambda-cloud && zip -q $LAMBDA_ZIP *.py)
+aws s3 cp $LAMBDA_ZIP s3://$templatebucket/$LAMBDA_KEY
+
 aws cloudformation $CFN_CMD --stack-name $stackname \
     --template-url $TEMPLATE_URL \
     --parameters \
     ParameterKey=TemplateBucketName,ParameterValue=$templatebucket \
     ParameterKey=TemplateBucketPrefix,ParameterValue=$templateprefix \
+    ParameterKey=LambdaCodeKey,ParameterValue=$LAMBDA_KEY \
     --tags Key=Project,Value=ChipWaferAnalysis \
     --capabilities CAPABILITY_IAM CAPABILITY_NAMED_IAM
@@ -0,0 +1,376 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Cross-engine inference benchmark on synthetic wafer maps.
+
+Runs each inference path of the repo in-process, through its own handlers:
+
+    mxnet        notebooks/classify_mxnet.py, model_fn and transform_fn on an
+                 application/x-wafermap request
+    fastai       pytorch_code/classifier/classifier.py, model_fn, input_fn,
+                 predict_fn and output_fn on the same request
+    torchscript  pytorch_code/classifier/serve.py, the same handlers on the
+                 TorchScript export
+    edge         lambda-rpi-inference/edge_inference.py, load_model and
+                 predict(), including the resize of the decode stage
+
+No trained artifacts are needed.  For every engine a randomly initialised
+network of each --arch is written in that engine's format first:
+model-symbol.json/model-0000.params for mxnet and edge, model.pkl, model.pt
+and model.json for fastai and torchscript.  resnet18 is the served 224x224 RGB
+network; wafernet the single-channel 64x64 network, with its model-input.json
+or model.json input spec.  The wafers are
+random maps at WM-811K sizes: dies inside the wafer outline, scattered and
+clustered failures around them.
+
+Each (engine, arch, threads, batch size) runs in a fresh interpreter with
+OMP_NUM_THREADS and MKL_NUM_THREADS set to the thread count and the
+prediction cache disabled, and reports:
+
+    cold_start_s     handler import, model_fn and the first one-wafer request
+    p50/p90/p99_ms   warm latency of a request with `batch size` wafers
+    images_per_sec   wafers classified per second over the warm requests
+    rss_mb           resident memory at the end; peak_rss_mb its maximum
+
+The table is printed and, with --output, written as JSON together with the
+commit and host, so runs can be compared; --compare prints the change in
+throughput and p50 against an earlier JSON.  Engines whose framework is not
+installed are reported as skipped.
+
+Usage:
+    python serving/benchmark.py --batch-sizes 1,8,32 --threads 1,4 --output bench.json
+    python serving/benchmark.py --arch resnet18,wafernet --threads 1
+    python serving/benchmark.py --engines mxnet,edge --compare bench.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# engine: (handler directory, handler module, model format)
+ENGINES = {'mxnet': ('notebooks', 'classify_mxnet', 'mxnet'),
+           'fastai': ('pytorch_code/classifier', 'classifier', 'fastai'),
+           'torchscript': ('pytorch_code/classifier', 'serve', 'fastai'),
+           'edge': ('lambda-rpi-inference', 'edge_inference', 'mxnet')}
+ENGINE_ORDER = ['mxnet', 'fastai', 'torchscript', 'edge']
+# where the code that writes each model format lives
+FORMAT_DIRS = {'mxnet': 'notebooks', 'fastai': 'pytorch_code/classifier'}
+ARCHS = ['resnet18', 'resnet34', 'wafernet']
+
+# Same order as wafer_store.CLASSES.
+CLASSES = ['Center', 'Donut', 'Edge-Loc', 'Edge-Ring', 'Loc', 'Near-full', 'Random', 'Scratch', 'none']
+
+# common WM-811K map sizes (rows, cols) and a rough share of each; the set is
+# dominated by small maps and has a long tail of large ones
+WAFER_SHAPES = [((26, 26), 0.20), ((25, 27), 0.18), ((27, 25), 0.08), ((30, 34), 0.08), ((33, 33), 0.08),
+                ((32, 29), 0.06), ((39, 37), 0.08), ((45, 48), 0.07), ((52, 59), 0.06), ((64, 71), 0.05),
+                ((101, 98), 0.03), ((212, 204), 0.03)]
+
+WAFERMAP_CONTENT_TYPE = 'application/x-wafermap'
+JSON_CONTENT_TYPE = 'application/json'
+# Scale used by writeImgToDisk when exporting PNGs (wafer_store.PNG_SCALE).
+PNG_SCALE = 127
+
+RESULT_PREFIX = 'BENCHMARK='
+
+
+def synthetic_wafers(count, seed=0):
+    """Maps of 0/1/2 die states at WM-811K sizes."""
+    rs = np.random.RandomState(seed)
+    shapes, weights = zip(*WAFER_SHAPES)
+    wafers = []
+    for i in rs.choice(len(shapes), count, p=np.array(weights) / sum(weights)):
+        rows, cols = shapes[i]
+        y, x = np.ogrid[:rows, :cols]
+        inside = ((y - (rows - 1) / 2.0) / (rows / 2.0)) ** 2 + ((x - (cols - 1) / 2.0) / (cols / 2.0)) ** 2 <= 1
+        failed = rs.rand(rows, cols) < rs.uniform(0.01, 0.2)
+        cy, cx, radius = rs.uniform(0, rows), rs.uniform(0, cols), rs.uniform(1, min(rows, cols) / 4.0)
+        failed |= (y - cy) ** 2 + (x - cx) ** 2 <= radius ** 2
+        wafer = inside.astype(np.uint8)
+        wafer[inside & failed] = 2
+        wafers.append(wafer)
+    return wafers
+
+
+# ------------------------------------------------------------ #
+# Random models, written in a child interpreter                #
+# ------------------------------------------------------------ #
+
+def write_mxnet_model(model_dir, arch):
+    import mxnet as mx
+    from mxnet.gluon import model_zoo
+    import classify_mxnet
+    if arch == 'wafernet':
+        spec = classify_mxnet.INPUT_SPECS['wafernet']
+        net = classify_mxnet.define_network('wafernet')
+        with open(os.path.join(model_dir, classify_mxnet.INPUT_SPEC_FILE), 'w') as fout:
+            json.dump(spec, fout)
+    else:
+        # the v2 ResNets are the ones classify_mxnet.define_network uses
+        spec = classify_mxnet.INPUT_SPECS[classify_mxnet.DEFAULT_NETWORK]
+        net = model_zoo.vision.get_model(arch + '_v2', classes=len(CLASSES))
+    net.initialize(mx.init.Xavier())
+    net.hybridize()
+    net(mx.nd.zeros((1, spec['channels'], spec['size'], spec['size'])))
+    net.export(os.path.join(model_dir, 'model'))
+
+
+def write_fastai_model(model_dir, arch):
+    from pathlib import Path
+    import torch
+    import classifier
+    from fastai.vision import ImageDataBunch, Learner, ResizeMethod, create_cnn, imagenet_stats, models
+    if arch == 'wafernet':
+        data = ImageDataBunch.single_from_classes(model_dir, CLASSES, size=classifier.WAFER_SIZE,
+                                                  resize_method=ResizeMethod.SQUISH, mode='nearest')
+        data.normalize((torch.tensor([0.5]), torch.tensor([0.5])))
+        learn = Learner(data, classifier.WaferNet(classes=len(CLASSES)))
+    else:
+        data = ImageDataBunch.single_from_classes(model_dir, CLASSES, size=classifier.IMAGE_SIZE).normalize(imagenet_stats)
+        learn = create_cnn(data, getattr(models, arch), pretrained=False)
+    learn.export(Path(os.path.join(model_dir, 'model.pkl')))
+    classifier._save_torchscript(learn, model_dir, 'wafernet' if arch == 'wafernet' else 'resnet18')
+
+
+# ------------------------------------------------------------ #
+# Measurements, in a child interpreter                         #
+# ------------------------------------------------------------ #
+
+def requests_for(engine, batches):
+    """The request each call takes: a wafermap body, or the decoded images the edge pipeline passes on."""
+    if engine == 'edge':
+        from PIL import Image
+        return [[Image.fromarray(w * PNG_SCALE) for w in batch] for batch in batches]
+    from wafer_store import encode_wafermaps
+    return [encode_wafermaps(batch) for batch in batches]
+
+
+def caller(engine, handler, model):
+    if engine == 'mxnet':
+        return lambda body: handler.transform_fn(model, body, WAFERMAP_CONTENT_TYPE, JSON_CONTENT_TYPE)
+    if engine == 'edge':
+        return lambda frames: handler.predict(model, [handler.to_array(im) for im in frames])
+    return lambda body: handler.output_fn(handler.predict_fn(handler.input_fn(body, WAFERMAP_CONTENT_TYPE), model))
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * resource.getpagesize() / float(1 << 20)
+    except IOError:
+        return None
+
+
+def measure(engine, model_dir, batch_size, warmup, iterations, seed):
+    module = ENGINES[engine][1]
+    batches = [synthetic_wafers(batch_size, seed + i) for i in range(min(iterations, 16))]
+    single = batches[0][:1]
+
+    tic = time.time()
+    handler = importlib.import_module(module)
+    imported = time.time()
+    model = handler.load_model(model_dir) if engine == 'edge' else handler.model_fn(model_dir)
+    loaded = time.time()
+    call = caller(engine, handler, model)
+    call(requests_for(engine, [single])[0])
+    first = time.time()
+
+    requests = requests_for(engine, batches)
+    for i in range(warmup):
+        call(requests[i % len(requests)])
+    latencies = []
+    start = time.time()
+    for i in range(iterations):
+        request = requests[i % len(requests)]
+        t = time.time()
+        call(request)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+    return {'import_s': imported - tic,
+            'model_fn_s': loaded - imported,
+            'first_predict_s': first - loaded,
+            'cold_start_s': first - tic,
+            'p50_ms': float(p50),
+            'p90_ms': float(p90),
+            'p99_ms': float(p99),
+            'images_per_sec': batch_size * iterations / elapsed,
+            'rss_mb': rss_mb(),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def child_main(args):
+    fmt = ENGINES[args.engine][2]
+    handler_dir = FORMAT_DIRS[fmt] if args.child == 'prepare' else ENGINES[args.engine][0]
+    sys.path.insert(0, os.path.join(ROOT, handler_dir))
+    if args.child == 'prepare':
+        (write_mxnet_model if fmt == 'mxnet' else write_fastai_model)(args.model_dir, args.arch)
+        result = {}
+    else:
+        result = measure(args.engine, args.model_dir, args.batch_size, args.warmup, args.iterations, args.seed)
+    # handlers print as they go; the result is the last line
+    sys.stdout.write('\n' + RESULT_PREFIX + json.dumps(result) + '\n')
+
+
+# ------------------------------------------------------------ #
+# Driver                                                       #
+# ------------------------------------------------------------ #
+
+def run_child(step, engine, arch, model_dir, args, threads=1, batch_size=1):
+    env = dict(os.environ,
+               OMP_NUM_THREADS=str(threads),
+               MKL_NUM_THREADS=str(threads),
+               PREDICTION_CACHE_SIZE='0',
+               # one forward pass per request in every engine
+               MAX_BATCH_SIZE=str(max(batch_size, 1)),
+               INFERENCE_BATCH_SIZE=str(max(batch_size, 1)))
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', step, '--engine', engine,
+           '--model-dir', model_dir, '--arch', arch, '--batch-size', str(batch_size),
+           '--warmup', str(args.warmup), '--iterations', str(args.iterations), '--seed', str(args.seed)]
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    lines = [l for l in out.decode('utf-8', 'replace').splitlines() if l.startswith(RESULT_PREFIX)]
+    if proc.returncode != 0 or not lines:
+        err = err.decode('utf-8', 'replace').strip().splitlines()
+        message = err[-1] if err else 'exit code {0}'.format(proc.returncode)
+        status = 'skipped' if 'No module named' in message else 'failed'
+        return {'status': status, 'error': message}
+    return dict(json.loads(lines[-1][len(RESULT_PREFIX):]), status='ok')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def row_key(row):
+    return row['engine'], row['arch'], row['threads'], row['batch_size']
+
+
+def format_table(results, previous=None):
+    previous = dict((row_key(r), r) for r in previous or [] if r.get('status') == 'ok')
+    header = '{0:<12}{1:<10}{2:>8}{3:>7}{4:>10}{5:>9}{6:>9}{7:>9}{8:>10}{9:>9}{10:>10}'.format(
+        'engine', 'arch', 'threads', 'batch', 'cold_s', 'p50_ms', 'p90_ms', 'p99_ms', 'img/s', 'rss_mb', 'peak_mb')
+    if previous:
+        header += '{0:>10}{1:>10}'.format('d_img/s', 'd_p50')
+    lines = [header]
+    for row in results:
+        prefix = '{0:<12}{1:<10}{2:>8}{3:>7}'.format(row['engine'], row['arch'], row['threads'], row['batch_size'])
+        if row['status'] != 'ok':
+            lines.append(prefix + '  {0}: {1}'.format(row['status'], row['error']))
+            continue
+        line = prefix + '{0:>10.2f}{1:>9.2f}{2:>9.2f}{3:>9.2f}{4:>10.1f}{5:>9.0f}{6:>10.0f}'.format(
+            row['cold_start_s'], row['p50_ms'], row['p90_ms'], row['p99_ms'], row['images_per_sec'],
+            row['rss_mb'] or 0, row['peak_rss_mb'])
+        old = previous.get(row_key(row))
+        if old is not None:
+            line += '{0:>+9.1f}%{1:>+9.1f}%'.format(100.0 * (row['images_per_sec'] / old['images_per_sec'] - 1),
+                                                     100.0 * (row['p50_ms'] / old['p50_ms'] - 1))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(args):
+    engines = [e for e in args.engines.split(',') if e]
+    unknown = [e for e in engines if e not in ENGINES]
+    if unknown:
+        raise SystemExit('Unknown engines: {0}; choose from {1}'.format(', '.join(unknown), ', '.join(ENGINE_ORDER)))
+    archs = [a for a in args.arch.split(',') if a]
+    unknown = [a for a in archs if a not in ARCHS]
+    if unknown:
+        raise SystemExit('Unknown architectures: {0}; choose from {1}'.format(', '.join(unknown), ', '.join(ARCHS)))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='wafer-benchmark-')
+    results = []
+    try:
+        prepared = {}
+        for engine in engines:
+            for arch in archs:
+                fmt = ENGINES[engine][2]
+                if (fmt, arch) not in prepared:
+                    model_dir = os.path.join(work_dir, fmt + '-' + arch)
+                    if not os.path.isdir(model_dir):
+                        os.makedirs(model_dir)
+                    print("Writing a random {0} model for {1}".format(arch, fmt))
+                    prepared[(fmt, arch)] = (model_dir, run_child('prepare', engine, arch, model_dir, args))
+                model_dir, status = prepared[(fmt, arch)]
+                for threads in int_list(args.threads):
+                    for batch_size in int_list(args.batch_sizes):
+                        row = {'engine': engine, 'arch': arch, 'threads': threads, 'batch_size': batch_size}
+                        if status['status'] != 'ok':
+                            row.update(status)
+                        else:
+                            print("Running {0} {1} with {2} threads, batches of {3}".format(
+                                engine, arch, threads, batch_size))
+                            row.update(run_child('run', engine, arch, model_dir, args, threads, batch_size))
+                        results.append(row)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fin:
+            previous = json.load(fin)['results']
+    print(format_table(results, previous))
+
+    if args.output:
+        report = {'commit': git_commit(),
+                  'host': {'platform': platform.platform(),
+                           'python': platform.python_version(),
+                           'cpu_count': os.cpu_count()},
+                  'config': {'archs': archs,
+                             'warmup': args.warmup,
+                             'iterations': args.iterations,
+                             'seed': args.seed},
+                  'results': results}
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+        print("Wrote " + args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', default=','.join(ENGINE_ORDER),
+                        help='comma-separated engines (default: {0})'.format(','.join(ENGINE_ORDER)))
+    parser.add_argument('--batch-sizes', default='1,8,32', help='wafers per request (default: 1,8,32)')
+    parser.add_argument('--threads', default='1,{0}'.format(os.cpu_count()),
+                        help='thread counts (default: 1 and the number of cores)')
+    parser.add_argument('--arch', default='resnet18',
+                        help='comma-separated architectures of the random models, from {0} (default: resnet18)'.format(
+                            ', '.join(ARCHS)))
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per run (default: 5)')
+    parser.add_argument('--iterations', type=int, default=50, help='timed requests per run (default: 50)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON report path')
+    parser.add_argument('--compare', help='earlier JSON report to compare throughput and p50 with')
+    parser.add_argument('--work-dir', help='keep the random models here instead of a temporary folder')
+    # used by the driver to start the measurements in fresh interpreters
+    parser.add_argument('--child', choices=['prepare', 'run'], help=argparse.SUPPRESS)
+    parser.add_argument('--engine', help=argparse.SUPPRESS)
+    parser.add_argument('--model-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--batch-size', type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child_main(args)
+    else:
+        main(args)
@@ -0,0 +1,324 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Local inference server with dynamic micro-batching.
+
+Wraps the hosting handlers of either notebooks/classify_mxnet.py
+(model_fn, decode_request, predict_batch) or pytorch_code/classifier/classifier.py
+(model_fn, input_fn, predict_batch_fn, output_fn).  Concurrent requests are put
+on an asyncio queue; a scheduler merges them into one batch of up to
+--max-batch-size images, waiting at most --max-wait-ms after the first request,
+runs a single forward pass and hands each caller its own results.  A request
+that would overflow the batch waits for the next one, and a request with more
+images than --max-batch-size is split into several batches.
+
+Each request is decoded and checked on its own before it is queued, so a
+malformed body fails only that request.  Should a merged batch still fail,
+its requests are run again one at a time and only the failing ones get the
+error.
+
+Endpoints follow the SageMaker hosting contract:
+
+    POST /invocations   request body and Content-Type as for the endpoint
+    GET  /ping          health check
+    GET  /metrics       queue depth, batch size and latency histograms as JSON
+
+Usage:
+    python microbatch_server.py notebooks/classify_mxnet.py /path/to/model --port 8080
+"""
+import argparse
+import asyncio
+import bisect
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+JSON_CONTENT_TYPE = 'application/json'
+
+
+class Histogram(object):
+    """Fixed-bucket histogram; bucket i counts values <= bounds[i], the last bucket the rest."""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        labels = ['le_%g' % b for b in self.bounds] + ['inf']
+        return {'buckets': dict(zip(labels, self.counts)),
+                'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0}
+
+
+class Metrics(object):
+    def __init__(self, max_batch_size):
+        self.queue_depth = Histogram([0, 1, 2, 4, 8, 16, 32, 64, 128])
+        self.batch_size = Histogram(sorted(set([1, 2, 4, 8, 16, 32, 64, max_batch_size])))
+        self.latency_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+        self.requests = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'queue_depth': self.queue_depth.to_dict(),
+                'batch_size': self.batch_size.to_dict(),
+                'latency_ms': self.latency_ms.to_dict()}
+
+
+class MxnetHandlers(object):
+    """Adapter for classify_mxnet.py: one request may already hold several images."""
+
+    def __init__(self, module, model_dir, max_batch_size):
+        self.module = module
+        self.model = module.model_fn(model_dir)
+        self.max_batch_size = max_batch_size
+
+    def decode(self, body, content_type):
+        return self.module.decode_request(body, content_type)
+
+    def predict(self, items):
+        return self.module.predict_batch(self.model, items, max_batch_size=self.max_batch_size,
+                                         cache=getattr(self.module, 'cache', None))
+
+    def encode(self, results, is_batch, accept):
+        return json.dumps(results if is_batch else results[0]), accept
+
+
+class PytorchHandlers(object):
+    """Adapter for classifier.py: input_fn returns one image, or a list for batch payloads."""
+
+    def __init__(self, module, model_dir, max_batch_size):
+        self.module = module
+        self.model = module.model_fn(model_dir)
+
+    def decode(self, body, content_type):
+        obj = self.module.input_fn(body, content_type)
+        return (obj, True) if isinstance(obj, list) else ([obj], False)
+
+    def predict(self, items):
+        return self.module.predict_batch_fn(items, self.model)
+
+    def encode(self, results, is_batch, accept):
+        return self.module.output_fn(results if is_batch else results[0], accept)
+
+
+def check_items(items):
+    """Raise ValueError unless `items` are uint8 wafer maps (H, W) or images (H, W, C)."""
+    if not items:
+        raise ValueError('the request holds no images')
+    for i, item in enumerate(items):
+        shape = np.shape(item)
+        image = len(shape) == 2 or (len(shape) == 3 and shape[2] in (1, 3, 4))
+        if getattr(item, 'dtype', None) != np.uint8 or not image or 0 in shape:
+            raise ValueError('item {0} is {1} {2}, not uint8 die states (H, W) or an image (H, W, C)'.format(
+                i, getattr(item, 'dtype', type(item).__name__), shape))
+
+
+def load_handlers(handler_path, model_dir, max_batch_size):
+    # handler modules import their sibling modules, so put their folder on the path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(handler_path)))
+    name = os.path.splitext(os.path.basename(handler_path))[0]
+    spec = importlib.util.spec_from_file_location(name, handler_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if hasattr(module, 'predict_batch'):
+        return MxnetHandlers(module, model_dir, max_batch_size)
+    if hasattr(module, 'predict_batch_fn'):
+        return PytorchHandlers(module, model_dir, max_batch_size)
+    raise Exception('No batch prediction handler in {}'.format(handler_path))
+
+
+class MicroBatcher(object):
+    """Merges queued requests into batches bounded by size and by the wait for the first request."""
+
+    def __init__(self, predict, max_batch_size, max_wait_ms, metrics):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        # a single inference thread; batches run one after the other
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, items):
+        loop = asyncio.get_event_loop()
+        # a request larger than a batch is queued as several parts
+        futures = []
+        for start in range(0, len(items), self.max_batch_size):
+            future = loop.create_future()
+            await self.queue.put((items[start:start + self.max_batch_size], future))
+            futures.append(future)
+        results = []
+        for part in await asyncio.gather(*futures):
+            results += part
+        return results
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        held = None
+        while True:
+            batch = [held or await self.queue.get()]
+            held = None
+            self.metrics.queue_depth.observe(self.queue.qsize())
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    # starts the next batch instead of overflowing this one
+                    held = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            items = [item for request_items, _ in batch for item in request_items]
+            self.metrics.batch_size.observe(len(items))
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, items)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # one bad request must not fail the others: run each on its own
+                for request_items, future in batch:
+                    try:
+                        future.set_result(await loop.run_in_executor(self.executor, self.predict, request_items))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for request_items, future in batch:
+                future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+
+class Server(object):
+    def __init__(self, handlers, batcher, metrics):
+        self.handlers = handlers
+        self.batcher = batcher
+        self.metrics = metrics
+        self.decode_executor = ThreadPoolExecutor()
+
+    async def invoke(self, body, headers):
+        content_type = headers.get('content-type', JSON_CONTENT_TYPE)
+        accept = headers.get('accept', JSON_CONTENT_TYPE)
+        loop = asyncio.get_event_loop()
+        items, is_batch = await loop.run_in_executor(self.decode_executor, self.handlers.decode,
+                                                     body, content_type)
+        check_items(items)
+        results = await self.batcher.submit(items)
+        return self.handlers.encode(results, is_batch, accept)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                    headers = {}
+                    while True:
+                        line = (await reader.readline()).decode('latin-1').strip()
+                        if not line:
+                            break
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError as e:
+                    # the rest of the stream can't be framed, so answer and close
+                    self.metrics.errors += 1
+                    await self.respond(writer, '400 Bad Request', json.dumps({'error': 'malformed request: %s' % e}),
+                                       JSON_CONTENT_TYPE)
+                    break
+                body = await reader.readexactly(length)
+
+                status, payload, content_type = await self.route(method, path, body, headers)
+                await self.respond(writer, status, payload, content_type)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, content_type):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        writer.write(('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                      % (status, content_type, len(payload))).encode('latin-1') + payload)
+        await writer.drain()
+
+    async def route(self, method, path, body, headers):
+        if method == 'GET' and path == '/ping':
+            return '200 OK', '', JSON_CONTENT_TYPE
+        if method == 'GET' and path == '/metrics':
+            return '200 OK', json.dumps(self.metrics.to_dict()), JSON_CONTENT_TYPE
+        if method == 'POST' and path == '/invocations':
+            tic = time.time()
+            self.metrics.requests += 1
+            try:
+                payload, content_type = await self.invoke(body, headers)
+            except Exception as e:
+                self.metrics.errors += 1
+                print('Request failed: {0}'.format(e))
+                return '400 Bad Request', json.dumps({'error': str(e)}), JSON_CONTENT_TYPE
+            self.metrics.latency_ms.observe(1000 * (time.time() - tic))
+            return '200 OK', payload, content_type
+        return '404 Not Found', '', JSON_CONTENT_TYPE
+
+
+def serve(handler_path, model_dir, host='0.0.0.0', port=8080, max_batch_size=32, max_wait_ms=5.0):
+    handlers = load_handlers(handler_path, model_dir, max_batch_size)
+    # the queue binds to the current loop on older Pythons, so set the loop up first
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics = Metrics(max_batch_size)
+    batcher = MicroBatcher(handlers.predict, max_batch_size, max_wait_ms, metrics)
+    server = Server(handlers, batcher, metrics)
+
+    loop.create_task(batcher.run())
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, host, port))
+    print("Serving {0} on {1}:{2} (max batch {3}, max wait {4} ms)".format(
+        handler_path, host, port, max_batch_size, max_wait_ms))
+    try:
+        loop.run_forever()
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('handler', type=str, help='classify_mxnet.py or classifier.py')
+    parser.add_argument('model_dir', type=str, help='folder holding the model artifacts')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='listen address (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=8080, help='listen port (default: 8080)')
+    parser.add_argument('--max-batch-size', type=int, default=32,
+                        help='most images merged into one forward pass (default: 32)')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='longest wait after the first queued request before running a batch (default: 5)')
+    args = parser.parse_args()
+
+    serve(args.handler, args.model_dir, args.host, args.port, args.max_batch_size, args.max_wait_ms)
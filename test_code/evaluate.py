@@ -0,0 +1,375 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Offline evaluation of a trained model for the pipeline's test stage.
+
+test.py only checks the accuracy SageMaker reported for the training job.
+This script downloads the job's model artifact, streams the held-out test
+split (a wafer store, see wafer_store.py) through it on the CPU and writes a
+JSON report:
+
+    confusion_matrix   rows are true classes, columns predictions, both in
+                       wafer_store.CLASSES order; per_class adds support,
+                       precision and recall
+    accuracy
+    images_per_sec     batched inference over the whole split, `--workers`
+                       processes with `--threads` threads each
+    latency_ms_p50/99  single-image requests (batch of one) in one process
+                       with `--threads` threads, after a warm-up
+    peak_rss_mb        peak resident memory of the largest inference process
+
+The artifact is either the TorchScript export of the PyTorch trainer (model.pt
+and model.json) or the MXNet export (model-symbol.json and model-0000.params);
+only the matching framework needs to be installed.
+
+The report is compared with a stored baseline (--baseline or EVAL_BASELINE, a
+local path or s3:// URI of a JSON file with the same keys under the backend of
+the model, torchscript or mxnet) and the script exits with 1 when a metric is
+worse than its budget:
+
+    accuracy         more than ACCURACY_TOLERANCE below the baseline (absolute, default 0.01)
+    images_per_sec   more than THROUGHPUT_TOLERANCE below (relative, default 0.25)
+    latency_ms_p50,
+    latency_ms_p99   more than LATENCY_TOLERANCE above (relative, default 0.25)
+    peak_rss_mb      more than MEMORY_TOLERANCE above (relative, default 0.15)
+
+Metrics missing from the baseline are not checked.  When the baseline has no
+entry for the backend, this run is recorded as its baseline, so later runs on
+the same build host type are gated against it (throughput and latency only
+compare on the same hardware); REQUIRE_BASELINE=1 fails the run instead.
+--write-baseline replaces an existing entry.
+
+Usage:
+    python evaluate.py job.txt --data s3://bucket/data-packed/test [--baseline s3://bucket/eval/baseline.json]
+    python evaluate.py --model-dir model --data vdata-packed/test --write-baseline
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tarfile
+import time
+
+import numpy as np
+
+from wafer_preprocess import Preprocessor
+from wafer_store import CLASSES, WaferStore
+
+# (metric, higher is better, tolerance variable, default tolerance)
+GATES = [('accuracy', True, 'ACCURACY_TOLERANCE', 0.01),
+         ('images_per_sec', True, 'THROUGHPUT_TOLERANCE', 0.25),
+         ('latency_ms_p50', False, 'LATENCY_TOLERANCE', 0.25),
+         ('latency_ms_p99', False, 'LATENCY_TOLERANCE', 0.25),
+         ('peak_rss_mb', False, 'MEMORY_TOLERANCE', 0.15)]
+
+
+class TorchScriptModel(object):
+    """model.pt and model.json, written by pytorch_code/classifier/classifier.py; see serve.py."""
+    backend = 'torchscript'
+
+    def __init__(self, model_dir, threads):
+        import torch
+        torch.set_num_threads(threads)
+        self.torch = torch
+        self.module = torch.jit.load(os.path.join(model_dir, 'model.pt'), map_location='cpu').eval()
+        with open(os.path.join(model_dir, 'model.json')) as fin:
+            spec = json.load(fin)
+        self.classes = spec['classes']
+        # as serve.preprocessor: die states at the intensities of wafer_data.wafer_to_image
+        defaults = {'channels': 3, 'resize': 'crop', 'interpolation': 'bilinear'}
+        self.preprocess = Preprocessor(dict(defaults, **spec), wafer_scale=0.5)
+
+    def predict(self, wafers):
+        with self.torch.no_grad():
+            output = self.module(self.torch.from_numpy(self.preprocess(wafers)))
+        return output.argmax(dim=1).tolist()
+
+
+class SymbolModel(object):
+    """
+    model-symbol.json and model-0000.params, exported by notebooks/classify_mxnet.py,
+    with the input described by model-input.json (resnet18_v2 when it is missing).
+    """
+    backend = 'mxnet'
+    classes = CLASSES
+
+    def __init__(self, model_dir, threads):
+        # read by the MXNet engine when it is imported
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        import mxnet as mx
+        self.mx = mx
+        self.net = mx.gluon.SymbolBlock.imports('%s/model-symbol.json' % model_dir, ['data'],
+                                                '%s/model-0000.params' % model_dir)
+        spec = {'channels': 3, 'size': 224, 'resize': 256, 'interpolation': 'bilinear',
+                'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
+        if os.path.exists(os.path.join(model_dir, 'model-input.json')):
+            with open(os.path.join(model_dir, 'model-input.json')) as fin:
+                spec = json.load(fin)
+        # as classify_mxnet.model_fn: die states at the intensities of the exported PNGs
+        self.preprocess = Preprocessor(spec)
+
+    def predict(self, wafers):
+        output = self.net(self.mx.nd.array(self.preprocess(wafers)))
+        return self.mx.nd.argmax(output, axis=1).asnumpy().astype(int).tolist()
+
+
+def load_model(model_dir, threads):
+    if os.path.exists(os.path.join(model_dir, 'model.pt')):
+        return TorchScriptModel(model_dir, threads)
+    if os.path.exists(os.path.join(model_dir, 'model-symbol.json')):
+        return SymbolModel(model_dir, threads)
+    raise Exception('No model.pt or model-symbol.json in {0}'.format(model_dir))
+
+
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def download_model(job_id, work_dir):
+    """Download and unpack the model artifact of a SageMaker training job."""
+    import boto3
+    response = boto3.client('sagemaker').describe_training_job(TrainingJobName=job_id)
+    bucket, key = split_s3_uri(response['ModelArtifacts']['S3ModelArtifacts'])
+    model_dir = os.path.join(work_dir, 'model')
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    archive = os.path.join(work_dir, 'model.tar.gz')
+    print("Downloading s3://{0}/{1}".format(bucket, key))
+    boto3.client('s3').download_file(bucket, key, archive)
+    with tarfile.open(archive) as tar:
+        tar.extractall(model_dir)
+    return model_dir
+
+
+def download_data(uri, work_dir):
+    """A local copy of the wafer store at an s3:// prefix; local paths are returned as they are."""
+    if not uri.startswith('s3://'):
+        return uri
+    import boto3
+    s3 = boto3.client('s3')
+    bucket, prefix = split_s3_uri(uri.rstrip('/'))
+    data_dir = os.path.join(work_dir, 'test')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix + '/'):
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix) + 1:]
+            if name and '/' not in name:
+                print("Downloading s3://{0}/{1}".format(bucket, obj['Key']))
+                s3.download_file(bucket, obj['Key'], os.path.join(data_dir, name))
+    return data_dir
+
+
+def load_baselines(uri):
+    """Baselines per backend from a local path or s3:// URI; empty when there are none yet."""
+    if uri.startswith('s3://'):
+        import boto3
+        from botocore.exceptions import ClientError
+        bucket, key = split_s3_uri(uri)
+        try:
+            return json.loads(boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}
+            raise
+    if not os.path.exists(uri):
+        return {}
+    with open(uri) as fin:
+        return json.load(fin)
+
+
+def save_baselines(uri, baselines):
+    body = json.dumps(baselines, indent=2, sort_keys=True)
+    if uri.startswith('s3://'):
+        import boto3
+        bucket, key = split_s3_uri(uri)
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+        return
+    with open(uri, 'w') as fout:
+        fout.write(body)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux; for RUSAGE_CHILDREN it is the largest child
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+# per-process state of the inference workers
+_worker = {}
+
+
+def _init_worker(model_dir, data_dir, threads):
+    _worker['model'] = load_model(model_dir, threads)
+    _worker['store'] = WaferStore(data_dir)
+
+
+def _predict_range(bounds):
+    start, stop = bounds
+    store = _worker['store']
+    return start, _worker['model'].predict([store.wafer(i) for i in range(start, stop)])
+
+
+def batched_predictions(model_dir, data_dir, count, workers, threads, batch_size):
+    """Predicted class indices of the first `count` wafers, and the wall-clock seconds it took."""
+    predictions = np.zeros(count, dtype=np.int64)
+    chunks = [(start, min(start + batch_size, count)) for start in range(0, count, batch_size)]
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model_dir, data_dir, threads))
+    try:
+        # wait for the workers to load the model before the clock starts
+        pool.map(_predict_range, [(0, 1)] * workers, chunksize=1)
+        tic = time.time()
+        for start, preds in pool.imap_unordered(_predict_range, chunks):
+            predictions[start:start + len(preds)] = preds
+        elapsed = time.time() - tic
+    finally:
+        pool.close()
+        pool.join()
+    return predictions, elapsed
+
+
+def single_image_latencies(model, store, samples, warmup=10, seed=0):
+    idx = np.random.RandomState(seed).permutation(len(store))[:samples]
+    for i in idx[:warmup]:
+        model.predict([store.wafer(int(i))])
+    latencies = []
+    for i in idx:
+        wafer = store.wafer(int(i))
+        tic = time.time()
+        model.predict([wafer])
+        latencies.append(time.time() - tic)
+    return np.array(latencies)
+
+
+def confusion_matrix(labels, predictions, num_classes):
+    matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    np.add.at(matrix, (labels, predictions), 1)
+    return matrix
+
+
+def evaluate(model_dir, data_dir, workers, threads, batch_size, latency_samples, limit=None):
+    store = WaferStore(data_dir)
+    count = len(store) if limit is None else min(limit, len(store))
+    labels = np.asarray(store.labels[:count], dtype=np.int64)
+
+    print("Batched inference on {0} wafers, {1} workers x {2} threads, batches of {3}".format(
+        count, workers, threads, batch_size))
+    predictions, elapsed = batched_predictions(model_dir, data_dir, count, workers, threads, batch_size)
+
+    print("Single-image latency on {0} wafers".format(latency_samples))
+    model = load_model(model_dir, threads)
+    latencies = single_image_latencies(model, store, latency_samples) * 1000
+
+    # the model may order its classes differently from the store
+    to_store = np.array([store.classes.index(c) for c in model.classes])
+    matrix = confusion_matrix(labels, to_store[predictions], len(store.classes))
+    correct = np.diag(matrix)
+    per_class = {}
+    for i, cls in enumerate(store.classes):
+        per_class[cls] = {'support': int(matrix[i].sum()),
+                          'precision': float(correct[i]) / max(int(matrix[:, i].sum()), 1),
+                          'recall': float(correct[i]) / max(int(matrix[i].sum()), 1)}
+    return {'backend': model.backend,
+            'count': count,
+            'classes': store.classes,
+            'confusion_matrix': matrix.tolist(),
+            'per_class': per_class,
+            'accuracy': float(correct.sum()) / max(count, 1),
+            'images_per_sec': count / elapsed,
+            'workers': workers,
+            'threads': threads,
+            'batch_size': batch_size,
+            'latency_samples': len(latencies),
+            'latency_ms_p50': float(np.percentile(latencies, 50)),
+            'latency_ms_p99': float(np.percentile(latencies, 99)),
+            'peak_rss_mb': max(peak_rss_mb(resource.RUSAGE_SELF), peak_rss_mb(resource.RUSAGE_CHILDREN))}
+
+
+def check_baseline(report, baseline):
+    """One entry per gated metric present in the baseline."""
+    checks = []
+    for name, higher_is_better, variable, default in GATES:
+        if baseline.get(name) is None:
+            continue
+        base = float(baseline[name])
+        tolerance = float(os.environ.get(variable, default))
+        if name == 'accuracy':
+            limit = base - tolerance
+        else:
+            limit = base * (1 - tolerance) if higher_is_better else base * (1 + tolerance)
+        passed = report[name] >= limit if higher_is_better else report[name] <= limit
+        checks.append({'metric': name, 'value': report[name], 'baseline': base, 'limit': limit, 'passed': passed})
+    return checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('job_file', nargs='?', help='file with the training job name, as written by trainer.py')
+    parser.add_argument('--model-dir', help='unpacked model artifact; skips the training job lookup')
+    parser.add_argument('--data', default=os.environ.get('TEST_DATA'),
+                        help='test split wafer store, a local path or s3:// prefix (default: $TEST_DATA)')
+    parser.add_argument('--baseline', default=os.environ.get('EVAL_BASELINE', 'baseline.json'),
+                        help='stored baselines, a local path or s3:// URI (default: $EVAL_BASELINE or baseline.json)')
+    parser.add_argument('--output', default='eval_report.json', help='report path (default: eval_report.json)')
+    parser.add_argument('--work-dir', default='eval', help='download directory (default: eval)')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('EVAL_WORKERS', 0)),
+                        help='inference processes (default: $EVAL_WORKERS or one per core)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('EVAL_THREADS', 1)),
+                        help='threads per inference process (default: $EVAL_THREADS or 1)')
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('EVAL_BATCH_SIZE', 64)))
+    parser.add_argument('--latency-samples', type=int, default=200)
+    parser.add_argument('--limit', type=int, help='only evaluate the first LIMIT wafers')
+    parser.add_argument('--write-baseline', action='store_true',
+                        help='store the gated metrics of this run as the baseline instead of checking them')
+    args = parser.parse_args()
+    if not args.data:
+        parser.error('--data or TEST_DATA is required')
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    model_dir = args.model_dir
+    if model_dir is None:
+        if args.job_file is None:
+            parser.error('a job file or --model-dir is required')
+        with open(args.job_file) as fin:
+            job_id = fin.readline().strip()
+        print("Read job id " + job_id)
+        model_dir = download_model(job_id, args.work_dir)
+    data_dir = download_data(args.data, args.work_dir)
+    if not WaferStore.exists(data_dir):
+        sys.exit("No wafer store at {0}.  Write the test split with notebooks/wafer_store.py or "
+                 "notebooks/convert_dataset.py and upload its test folder there.".format(args.data))
+    workers = args.workers or max(1, multiprocessing.cpu_count() // args.threads)
+
+    report = evaluate(model_dir, data_dir, workers, args.threads, args.batch_size, args.latency_samples, args.limit)
+
+    baselines = load_baselines(args.baseline)
+    report['checks'] = []
+    missing = report['backend'] not in baselines
+    if missing and os.environ.get('REQUIRE_BASELINE') == '1':
+        report['baseline_missing'] = True
+        print("No {0} baseline in {1}; record one with --write-baseline".format(report['backend'], args.baseline))
+    elif args.write_baseline or missing:
+        # one baseline per backend, so both trainers' models can be gated from the same file
+        baselines[report['backend']] = dict((name, report[name]) for name, _, _, _ in GATES)
+        save_baselines(args.baseline, baselines)
+        report['baseline_recorded'] = True
+        print("Recorded this run as the {0} baseline in {1}".format(report['backend'], args.baseline))
+    else:
+        report['checks'] = check_baseline(report, baselines[report['backend']])
+    report['passed'] = all(c['passed'] for c in report['checks']) and not report.get('baseline_missing')
+
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    print("Accuracy {accuracy:.4f}, {images_per_sec:.1f} images/s, latency p50 {latency_ms_p50:.2f} ms "
+          "p99 {latency_ms_p99:.2f} ms, peak RSS {peak_rss_mb:.0f} MB".format(**report))
+    for check in report['checks']:
+        print("{0} {metric}: {value:.4f} (baseline {baseline:.4f}, limit {limit:.4f})".format(
+            'PASS' if check['passed'] else 'FAIL', **check))
+    return 0 if report['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Batched preprocessing of wafer maps and images for the serving paths.
+
+A Preprocessor is built once per model from its input spec (model-input.json
+for MXNet, model.json for PyTorch) and turns a whole batch into the float32
+(N, channels, size, size) network input in one pass:
+
+  - normalisation is a lookup table: an 8-bit pixel has 256 possible values
+    and a wafer map three, so (value * scale - mean) / std is computed once
+    per value and channel instead of once per pixel;
+  - resizing and center cropping are computed once per input shape: the
+    pixels to gather for nearest neighbour, or one weight matrix per axis for
+    bilinear and area, applied to the whole group as two matrix products;
+  - inputs of the same shape are processed together, and the result is
+    written into an output buffer kept between calls.
+
+The table is applied before resizing; since the resize weights of an output
+pixel sum to one, this is the same as normalising afterwards.
+
+Inputs are uint8 numpy arrays:
+
+    (H, W)      a wafer map of die states 0/1/2, `wafer_scale` intensity per
+                state (PNG_SCALE / 255, as in the exported PNGs, by default)
+    (H, W, C)   a decoded image; a single channel is repeated and channels
+                beyond the network input are dropped
+
+The spec keys used are channels, size, interpolation (nearest, bilinear or
+area), mean and std (missing or None: no normalisation), and resize:
+
+    'crop'      shorter side scaled to size, then center cropped (fastai)
+    'squish'    both sides scaled to size
+    N           both sides scaled to N, then center cropped to size (gluon
+                Resize and CenterCrop)
+
+This module only depends on numpy, runs on Python 2.7 (the Greengrass
+runtime) and 3, and is shipped with each serving directory (notebooks,
+pytorch_code/classifier, lambda-rpi-inference, test_code); keep the copies
+identical.
+"""
+from __future__ import division
+
+import threading
+
+import numpy as np
+
+from wafer_store import PNG_SCALE
+
+
+class Preprocessor(object):
+    def __init__(self, spec, wafer_scale=PNG_SCALE / 255.):
+        self.channels = spec.get('channels', 3)
+        self.size = spec['size']
+        self.resize = spec.get('resize', 'crop')
+        self.interpolation = spec.get('interpolation', 'bilinear')
+        values = np.arange(256, dtype=np.float64)
+        # (channels, 256) network input for every pixel value and die state
+        self.pixel_lut = self._lut(values / 255, spec.get('mean'), spec.get('std'))
+        self.wafer_lut = self._lut(np.minimum(values, 2) * wafer_scale, spec.get('mean'), spec.get('std'))
+        self._plans = {}
+        self._local = threading.local()
+
+    def _lut(self, intensity, mean, std):
+        mean = np.asarray(mean if mean else [0.], dtype=np.float64).reshape(-1, 1)
+        std = np.asarray(std if std else [1.], dtype=np.float64).reshape(-1, 1)
+        lut = (intensity[None] - mean) / std
+        return np.ascontiguousarray(np.broadcast_to(lut, (self.channels, 256)), dtype=np.float32)
+
+    def __call__(self, arrays, pad_to=0):
+        """
+        The network input for a list of wafer maps and images, in order.
+
+        Rows from len(arrays) up to `pad_to` are zero.  The result is a view of a
+        per-thread buffer that the next call overwrites.
+        """
+        out = self._buffer(max(len(arrays), pad_to))
+        groups = {}
+        for i, arr in enumerate(arrays):
+            groups.setdefault(np.shape(arr), []).append(i)
+        for shape, idx in groups.items():
+            batch = np.stack([np.asarray(arrays[i], dtype=np.uint8) for i in idx])
+            if len(shape) == 2:
+                pixels, lut = batch[..., None], self.wafer_lut
+            else:
+                pixels, lut = batch, self.pixel_lut
+            if idx[-1] - idx[0] == len(idx) - 1:
+                self._resample(pixels, lut, self._plan(shape[0], shape[1]), out[idx[0]:idx[-1] + 1])
+            else:
+                dest = np.empty((len(idx),) + out.shape[1:], dtype=np.float32)
+                out[idx] = self._resample(pixels, lut, self._plan(shape[0], shape[1]), dest)
+        out[len(arrays):] = 0
+        return out
+
+    def _buffer(self, n):
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or buf.shape[0] < n:
+            buf = self._local.buf = np.empty((n, self.channels, self.size, self.size), dtype=np.float32)
+        return buf[:n]
+
+    def _resample(self, pixels, lut, plan, out):
+        # input channel feeding each network channel
+        source = [c if c < pixels.shape[3] else 0 for c in range(self.channels)]
+        rows, cols = plan
+        if self.interpolation == 'nearest':
+            picked = pixels[:, rows[:, None], cols[None, :]]
+            for c, s in enumerate(source):
+                out[:, c] = np.take(lut[c], picked[..., s])
+            return out
+        x = np.stack([np.take(lut[c], pixels[..., s]) for c, s in enumerate(source)], axis=1)
+        # resample the longer input axis first, the cheaper order
+        if x.shape[3] <= x.shape[2]:
+            return np.matmul(np.matmul(rows, x), cols.T, out=out)
+        return np.matmul(rows, np.matmul(x, cols.T), out=out)
+
+    def _plan(self, rows, cols):
+        plan = self._plans.get((rows, cols))
+        if plan is None:
+            if self.resize == 'squish':
+                target = (self.size, self.size)
+            elif self.resize == 'crop':
+                scale = self.size / min(rows, cols)
+                target = (max(self.size, int(round(rows * scale))), max(self.size, int(round(cols * scale))))
+            else:
+                target = (int(self.resize), int(self.resize))
+            axes = [self._axis(length, resized) for length, resized in zip((rows, cols), target)]
+            plan = self._plans[(rows, cols)] = tuple(axes)
+        return plan
+
+    def _axis(self, length, resized):
+        """
+        Sampling of one axis: `length` input pixels scaled to `resized`, then
+        center cropped to size.  The input pixel of each output pixel for nearest
+        neighbour, else the (size, length) weights of the input pixels.
+        """
+        ratio = length / resized
+        dst = np.arange(self.size) + (resized - self.size) // 2
+        if self.interpolation == 'nearest':
+            return np.minimum((dst * ratio).astype(np.int64), length - 1)
+        if self.interpolation == 'area':
+            # each output pixel averages the input pixels it covers
+            start, edges = dst[:, None] * ratio, np.arange(length)[None, :]
+            overlap = np.minimum(start + ratio, edges + 1) - np.maximum(start, edges)
+            return (np.clip(overlap, 0, None) / ratio).astype(np.float32)
+        # bilinear with half-pixel centers, as OpenCV and torch with align_corners=False
+        src = np.clip((dst + 0.5) * ratio - 0.5, 0, length - 1)
+        lo = src.astype(np.int64)
+        weights = np.zeros((self.size, length), dtype=np.float32)
+        np.add.at(weights, (np.arange(self.size), lo), 1 - (src - lo))
+        np.add.at(weights, (np.arange(self.size), np.minimum(lo + 1, length - 1)), src - lo)
+        return weights
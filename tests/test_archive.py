@@ -0,0 +1,96 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""ArchiveFn uploads read back from moto's S3 with the wafer store readers."""
+import base64
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'test_code'))
+sys.path.insert(0, os.path.join(ROOT, 'lambda-cloud'))
+import archive
+import wafer_payload
+from wafer_store import WaferStore, decode_wafermaps
+
+# moto 5 has one mock for every service, older releases one per service
+mock_s3 = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+BUCKET = 'archive'
+HOUR = 1553000400  # 2019-03-19T13:00:00Z
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with mock_s3():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def wafers():
+    rng = np.random.RandomState(0)
+    # odd sizes, so packed wafers end in padding bits
+    return [rng.randint(0, 3, size=shape).astype(np.uint8) for shape in [(26, 26), (5, 7), (45, 48)]]
+
+
+def wafer_event(maps):
+    records = [{'imgid': 'wafer-%d' % i, 'timestamp': HOUR + i} for i in range(len(maps))]
+    data = wafer_payload.encode_images('fab1', 'cam1', records, wafers=maps)
+    return {'data': base64.b64encode(data).decode('ascii')}
+
+
+def download(s3, keys, folder):
+    for key in keys:
+        s3.download_file(BUCKET, key, os.path.join(str(folder), key.rsplit('/', 1)[-1]))
+    return str(folder)
+
+
+def test_shard_reads_back_as_a_wafer_store(s3, tmp_path):
+    maps = wafers()
+    keys = archive.archive(wafer_event(maps), s3, BUCKET)
+
+    prefix = 'fab1/cam1/shards/date=2019-03-19/hour=13/wafer-0/'
+    assert keys == [prefix + 'wafers.bin', prefix + 'index.npy', prefix + 'meta.json']
+    store = WaferStore(download(s3, keys, tmp_path))
+    assert len(store) == len(maps)
+    for i, expected in enumerate(maps):
+        wafer, label = store[i]
+        np.testing.assert_array_equal(wafer, expected)
+        assert label == archive.UNLABELLED
+    with open(os.path.join(str(tmp_path), 'meta.json')) as fin:
+        meta = json.load(fin)
+    assert meta['classes'] == store.classes
+    assert [r['imgid'] for r in meta['images']] == ['wafer-0', 'wafer-1', 'wafer-2']
+
+
+def test_objects_mode_stores_the_wafermap_body(s3):
+    maps = wafers()
+    keys = archive.archive(wafer_event(maps), s3, BUCKET, mode='objects')
+
+    assert keys == ['fab1/cam1/wafer-0.wfm', 'fab1/cam1/wafer-0.json']
+    body = s3.get_object(Bucket=BUCKET, Key=keys[0])['Body'].read()
+    for wafer, expected in zip(decode_wafermaps(body), maps):
+        np.testing.assert_array_equal(wafer, expected)
+    header = json.loads(s3.get_object(Bucket=BUCKET, Key=keys[1])['Body'].read().decode('utf-8'))
+    assert header['encoding'] == 'wafermap'
+
+
+def test_png_messages_are_stored_as_they_are(s3):
+    pngs = [b'\x89PNG first', b'\x89PNG second']
+    records = [{'imgid': 'img-%d' % i, 'timestamp': HOUR} for i in range(2)]
+    batch = {'data': base64.b64encode(wafer_payload.encode_images('fab1', 'cam1', records, pngs=pngs)).decode('ascii')}
+    single = {'fab': 'fab1', 'camera': 'cam1', 'imgid': 'img-2', 'bytes': base64.b64encode(b'\x89PNG third').decode('ascii')}
+
+    keys = archive.archive(batch, s3, BUCKET) + archive.archive(single, s3, BUCKET)
+    assert keys == ['fab1/cam1/img-0.png', 'fab1/cam1/img-1.png', 'fab1/cam1/img-2.png']
+    assert [s3.get_object(Bucket=BUCKET, Key=k)['Body'].read() for k in keys] == pngs + [b'\x89PNG third']
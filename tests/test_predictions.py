@@ -0,0 +1,118 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Batch writes and hourly rollups of PredictionBatchFn, against moto's DynamoDB."""
+import os
+import sys
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda-cloud'))
+import predictions
+
+# moto 5 has one mock for every service, older releases one per service
+mock_dynamodb = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_dynamodb', None) or moto.mock_dynamodb2
+
+HOUR = 1553000400  # 2019-03-19T13:00:00Z
+
+
+@pytest.fixture
+def ddb(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(predictions.time, 'sleep', lambda seconds: None)
+    with mock_dynamodb():
+        client = boto3.client('dynamodb', region_name='us-east-1')
+        # the key schemas of TblClassifications and TblRollups in cfn/persistence.yaml
+        client.create_table(TableName='classifications',
+                            AttributeDefinitions=[{'AttributeName': 'imgid', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'timestamp', 'AttributeType': 'N'}],
+                            KeySchema=[{'AttributeName': 'imgid', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+                            BillingMode='PAY_PER_REQUEST')
+        client.create_table(TableName='rollups',
+                            AttributeDefinitions=[{'AttributeName': 'fab', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'bucket', 'AttributeType': 'S'}],
+                            KeySchema=[{'AttributeName': 'fab', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'bucket', 'KeyType': 'RANGE'}],
+                            BillingMode='PAY_PER_REQUEST')
+        yield client
+
+
+class FlakyClient(object):
+    """Passes calls to `client`, but the first BatchWriteItem reports its last items unprocessed."""
+
+    def __init__(self, client, unprocessed=3):
+        self.client = client
+        self.unprocessed = unprocessed
+        self.batch_sizes = []
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        self.batch_sizes.append(len(requests))
+        if self.unprocessed:
+            n, self.unprocessed = self.unprocessed, 0
+            self.client.batch_write_item(RequestItems={table: requests[:-n]})
+            return {'UnprocessedItems': {table: requests[-n:]}}
+        return self.client.batch_write_item(RequestItems=RequestItems)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def batch(n, camera='cam1', start=0, timestamp=HOUR, prediction=lambda i: 'none' if i % 4 else 'Edge-Ring'):
+    return {'fab': 'fab1', 'camera': camera,
+            'predictions': [{'imgid': 'wafer-%d' % i, 'timestamp': timestamp + i,
+                             'prediction': prediction(i), 'probability': 0.9}
+                            for i in range(start, start + n)]}
+
+
+def rollup(ddb, camera='cam1', hour='2019-03-19T13'):
+    item = ddb.get_item(TableName='rollups', Key={'fab': {'S': 'fab1'}, 'bucket': {'S': hour + '#' + camera}})
+    return dict((k, v.get('N', v.get('S'))) for k, v in item['Item'].items())
+
+
+def test_records_are_written_in_chunks_with_retries(ddb):
+    flaky = FlakyClient(ddb)
+    predictions.store(batch(60), flaky, 'classifications', 'rollups')
+    assert flaky.batch_sizes == [25, 3, 25, 10]
+    assert ddb.scan(TableName='classifications', Select='COUNT')['Count'] == 60
+
+
+def test_duplicate_keys_keep_the_last_record(ddb):
+    event = batch(3)
+    event['predictions'].append(dict(event['predictions'][0], prediction='Scratch'))
+    assert predictions.batch_write(ddb, 'classifications',
+                                   [predictions.to_item(r) for r in predictions.records(event)]) == 3
+    item = ddb.get_item(TableName='classifications',
+                        Key={'imgid': {'S': 'wafer-0'}, 'timestamp': {'N': str(HOUR)}})['Item']
+    assert item['prediction'] == {'S': 'Scratch'}
+
+
+def test_string_and_number_timestamps_are_separate_keys():
+    records = [{'imgid': 'wafer-0', 'timestamp': HOUR}, {'imgid': 'wafer-0', 'timestamp': str(HOUR)}]
+    assert len(set(predictions.item_key(predictions.to_item(r)) for r in records)) == 2
+
+
+def test_unprocessed_items_raise_after_the_last_retry(ddb, monkeypatch):
+    monkeypatch.setattr(predictions, 'MAX_RETRIES', 1)
+    with pytest.raises(Exception, match='3 items left unprocessed'):
+        predictions.batch_write(FlakyClient(ddb), 'classifications',
+                                [predictions.to_item(r) for r in predictions.records(batch(10))])
+
+
+def test_rollups_add_up_per_camera_and_hour(ddb):
+    predictions.store(batch(8), ddb, 'classifications', 'rollups')
+    predictions.store(batch(4, start=8), ddb, 'classifications', 'rollups')
+    predictions.store(batch(2, camera='cam2'), ddb, 'classifications', 'rollups')
+    # an hour later, in milliseconds like the README sample messages
+    predictions.store(batch(1, timestamp=(HOUR + 3600) * 1000), ddb, 'classifications', 'rollups')
+
+    assert rollup(ddb) == {'fab': 'fab1', 'bucket': '2019-03-19T13#cam1', 'camera': 'cam1',
+                           'hour': '2019-03-19T13', 'total': '12', 'defects': '3',
+                           'n_none': '9', 'n_Edge-Ring': '3'}
+    assert rollup(ddb, camera='cam2')['total'] == '2'
+    assert rollup(ddb, hour='2019-03-19T14')['n_Edge-Ring'] == '1'
@@ -0,0 +1,90 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""JSON URL requests of the PyTorch handlers, against a local HTTP server."""
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'pytorch_code', 'classifier'))
+import url_fetch
+
+BODIES = {'/a.png': b'first image', '/b.png': b'second image'}
+
+
+class Handler(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        Handler.hits.append(self.path)
+        body = BODIES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%d"' % len(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.hits = []
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_raw_json_body_with_one_url(server):
+    fetcher = url_fetch.UrlFetcher()
+    # SageMaker passes the body as bytes
+    assert fetcher.fetch_request(json.dumps({'url': server + '/a.png'}).encode('utf-8')) == b'first image'
+
+
+def test_raw_json_body_with_urls_keeps_order(server):
+    fetcher = url_fetch.UrlFetcher(max_workers=2)
+    body = json.dumps({'urls': [server + '/b.png', server + '/a.png', server + '/b.png']})
+    assert fetcher.fetch_request(body) == [b'second image', b'first image', b'second image']
+
+
+def test_parsed_body(server):
+    assert url_fetch.UrlFetcher().fetch_request({'url': server + '/b.png'}) == b'second image'
+
+
+def test_cached_body_skips_the_network(server, tmp_path):
+    fetcher = url_fetch.UrlFetcher(cache_dir=str(tmp_path))
+    request = json.dumps({'url': server + '/a.png'}).encode('utf-8')
+    assert fetcher.fetch_request(request) == b'first image'
+    assert fetcher.fetch_request(request) == b'first image'
+    assert Handler.hits == ['/a.png']
+
+
+def test_stale_body_is_revalidated(server, tmp_path):
+    fetcher = url_fetch.UrlFetcher(cache_dir=str(tmp_path), cache_max_age=0)
+    assert fetcher.fetch(server + '/a.png') == b'first image'
+    # answered with 304, served from the cache
+    assert fetcher.fetch(server + '/a.png') == b'first image'
+    assert Handler.hits == ['/a.png', '/a.png']
+
+
+def test_missing_url_raises(server):
+    with pytest.raises(Exception):
+        url_fetch.UrlFetcher().fetch_request({'url': server + '/missing.png'})
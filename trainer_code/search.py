@@ -0,0 +1,341 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""
+Local hyperparameter search with asynchronous successive halving (ASHA).
+
+trainer.py launches one SageMaker job with fixed hyperparameters.  This runs
+many short trials of the same training code on the local CPUs instead:
+
+    pytorch   pytorch_code/classifier/classifier.py, the trainer of the
+              pipeline, run as a script with --epochs, --lr, ...
+    mxnet     notebooks/classify_mxnet.py, train() with the trial's
+              hyperparameters
+
+Every trial is a fresh process with OMP_NUM_THREADS and MKL_NUM_THREADS set
+to --threads and no GPU, and --workers trials run at once (by default as many
+as fit on the cores).  Its score is the validation accuracy of its last
+epoch, read from the train_profile.jsonl it writes.  With --subset, the
+trials use a stratified fraction of the train and valid wafer stores under
+--data, written once to the work directory.
+
+Successive halving: a new configuration trains for --min-epochs, and the
+best 1/eta of the trials of each rung are trained again with eta times the
+epochs, up to --max-epochs.  Promotions are asynchronous: a free worker
+takes a promotion from the highest rung that has one and otherwise starts a
+new configuration, so no worker waits for a rung to fill.  A promoted trial
+restarts from scratch, since the one-cycle schedule depends on the number of
+epochs.
+
+Written to --output-dir:
+
+    leaderboard.json    every trial: configuration, rung, epochs, accuracy,
+                        minimum class recall, seconds and status
+    best_config.json    the most accurate configuration of the highest rung
+                        reached, with its trainer.py environment (EPOCHS, LR,
+                        BATCH_SIZE, ...) for the pytorch backend
+
+Commit best_config.json next to trainer.py to train the pipeline with it.
+
+Usage:
+    python trainer_code/search.py --data vdata-packed --subset 0.1 --trials 32 --threads 2
+    python trainer_code/search.py --data vdata-packed --subset 0.1 --network wafernet
+    python trainer_code/search.py --backend mxnet --data vdata-packed --network wafernet_small
+    python trainer_code/search.py --data vdata-packed --space '{"lr": ["log", 0.001, 0.01]}'
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'pytorch_code', 'classifier'))
+from wafer_store import WaferStore, WaferStoreWriter
+
+BACKENDS = ['pytorch', 'mxnet']
+# name: ('log', low, high) log-uniform, ('uniform', low, high) or ('choice', values)
+DEFAULT_SPACE = {'lr': ('log', 1e-4, 3e-2),
+                 'batch_size': ('choice', [32, 64, 128]),
+                 'sampling': ('choice', ['uniform', 'sqrt']),
+                 'majority_fraction': ('choice', [0.1, 0.3, 1.0])}
+# classify_mxnet.py names the learning rate differently; the rest match
+MXNET_NAMES = {'lr': 'learning_rate'}
+
+
+def sample_config(space, rng):
+    config = {}
+    for name, dist in sorted(space.items()):
+        if dist[0] == 'log':
+            config[name] = float(math.exp(rng.uniform(math.log(dist[1]), math.log(dist[2]))))
+        elif dist[0] == 'uniform':
+            config[name] = rng.uniform(dist[1], dist[2])
+        elif dist[0] == 'choice':
+            config[name] = rng.choice(dist[1])
+        else:
+            raise ValueError('unknown distribution %s for %s' % (dist[0], name))
+    return config
+
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    """Epochs of each rung: min_epochs, eta times that, ... up to max_epochs."""
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+# ------------------------------------------------------------ #
+# Data                                                         #
+# ------------------------------------------------------------ #
+
+def subset_data(data_dir, work_dir, fraction, seed=0):
+    """Train and valid wafer stores with `fraction` of the wafers of each class."""
+    if fraction >= 1:
+        return data_dir
+    out_dir = os.path.join(work_dir, 'data-{0}-{1}'.format(fraction, seed))
+    if all(WaferStore.exists(os.path.join(out_dir, split)) for split in ('train', 'valid')):
+        return out_dir
+    rng = np.random.RandomState(seed)
+    for split in ('train', 'valid'):
+        path = os.path.join(data_dir, split)
+        if not WaferStore.exists(path):
+            raise ValueError('--subset needs wafer stores in %s/train and %s/valid' % (data_dir, data_dir))
+        store = WaferStore(path)
+        labels = store.labels
+        picked = [rng.permutation(np.flatnonzero(labels == c))[:max(1, int(round(fraction * (labels == c).sum())))]
+                  for c in np.unique(labels)]
+        with WaferStoreWriter(os.path.join(out_dir, split)) as writer:
+            for i in np.sort(np.concatenate(picked)):
+                writer.add(*store[i])
+    return out_dir
+
+
+# ------------------------------------------------------------ #
+# Trials                                                       #
+# ------------------------------------------------------------ #
+
+def child_main(trial_file):
+    """Train one mxnet trial described by `trial_file` in this process."""
+    with open(trial_file) as fin:
+        trial = json.load(fin)
+    sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+    import classify_mxnet
+    channels = {'training': os.path.join(trial['data_dir'], 'train'),
+                'validation': os.path.join(trial['data_dir'], 'valid')}
+    classify_mxnet.train('algo-1', channels, trial['hyperparameters'], ['algo-1'], 0, trial['output_dir'])
+
+
+def trial_command(backend, trial, data_dir, output_dir, args):
+    """Command line running `trial` with its output in `output_dir`."""
+    if backend == 'pytorch':
+        cmd = [sys.executable, os.path.join(ROOT, 'pytorch_code', 'classifier', 'classifier.py'),
+               '--epochs', str(trial['epochs']), '--network', args.network,
+               '--workers', '0', '--num-gpus', '0', '--data-dir', data_dir,
+               '--model-dir', os.path.join(output_dir, 'model'), '--output-data-dir', output_dir]
+        for name, value in sorted(trial['config'].items()):
+            cmd += ['--' + name.replace('_', '-'), str(value)]
+        return cmd
+    hyperparameters = dict((MXNET_NAMES.get(k, k), v) for k, v in trial['config'].items())
+    hyperparameters.update(epochs=trial['epochs'], network=args.network)
+    trial_file = os.path.join(output_dir, 'trial.json')
+    with open(trial_file, 'w') as fout:
+        json.dump({'data_dir': data_dir, 'output_dir': output_dir, 'hyperparameters': hyperparameters}, fout)
+    return [sys.executable, os.path.abspath(__file__), '--child', trial_file]
+
+
+def run_trial(trial, data_dir, args):
+    """Train `trial` in a fresh process and return its result."""
+    output_dir = os.path.join(args.work_dir, 'trial-{0:03d}-rung{1}'.format(trial['config_id'], trial['rung']))
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(os.path.join(output_dir, 'model'))
+    env = dict(os.environ,
+               OMP_NUM_THREADS=str(args.threads),
+               MKL_NUM_THREADS=str(args.threads),
+               CUDA_VISIBLE_DEVICES='',
+               # the SageMaker variables classifier.py reads its defaults from
+               SM_HOSTS='["algo-1"]',
+               SM_CURRENT_HOST='algo-1',
+               SM_MODEL_DIR=os.path.join(output_dir, 'model'),
+               SM_CHANNEL_TRAINING=data_dir,
+               SM_OUTPUT_DATA_DIR=output_dir,
+               SM_NUM_GPUS='0')
+    tic = time.time()
+    with open(os.path.join(output_dir, 'train.log'), 'w') as log:
+        returncode = subprocess.call(trial_command(args.backend, trial, data_dir, output_dir, args),
+                                     env=env, stdout=log, stderr=subprocess.STDOUT)
+    result = dict(trial, seconds=time.time() - tic, log=os.path.join(output_dir, 'train.log'))
+    records = []
+    profile = os.path.join(output_dir, 'train_profile.jsonl')
+    if os.path.exists(profile):
+        with open(profile) as fin:
+            records = [json.loads(line) for line in fin if line.strip()]
+    if returncode != 0 or not records or records[-1].get('valid_accuracy') is None:
+        return dict(result, status='failed', accuracy=None, error='exit code {0}'.format(returncode))
+    return dict(result, status='ok', accuracy=records[-1]['valid_accuracy'],
+                min_recall=records[-1].get('valid_min_recall'))
+
+
+# ------------------------------------------------------------ #
+# Scheduler                                                    #
+# ------------------------------------------------------------ #
+
+class ASHA(object):
+    """
+    Hands out trials: promotions to the next rung first, then new
+    configurations until `num_configs` have been started.
+    """
+
+    def __init__(self, space, rungs, eta, num_configs, seed=0):
+        self.space = space
+        self.rungs = rungs
+        self.eta = eta
+        self.num_configs = num_configs
+        self.configs = []
+        self.results = [[] for _ in rungs]
+        self.promoted = [set() for _ in rungs]
+        self._rng = random.Random(seed)
+
+    def next_trial(self):
+        for rung in reversed(range(len(self.rungs) - 1)):
+            done = sorted((r for r in self.results[rung] if r['status'] == 'ok'),
+                          key=lambda r: -r['accuracy'])
+            for r in done[:len(done) // self.eta]:
+                if r['config_id'] not in self.promoted[rung]:
+                    self.promoted[rung].add(r['config_id'])
+                    return self._trial(r['config_id'], rung + 1)
+        if len(self.configs) < self.num_configs:
+            self.configs.append(sample_config(self.space, self._rng))
+            return self._trial(len(self.configs) - 1, 0)
+        return None
+
+    def _trial(self, config_id, rung):
+        return {'config_id': config_id, 'rung': rung, 'epochs': self.rungs[rung],
+                'config': self.configs[config_id]}
+
+    def report(self, result):
+        self.results[result['rung']].append(result)
+
+    def leaderboard(self):
+        """All results, the highest rung first, then by accuracy."""
+        results = [r for rung in self.results for r in rung]
+        return sorted(results, key=lambda r: (-r['rung'], r['accuracy'] is None, -(r['accuracy'] or 0)))
+
+
+def search(scheduler, data_dir, args):
+    with ThreadPoolExecutor(args.workers) as pool:
+        running = set()
+        while True:
+            while len(running) < args.workers:
+                trial = scheduler.next_trial()
+                if trial is None:
+                    break
+                print("Starting config {config_id} for {epochs} epochs: {config}".format(**trial))
+                running.add(pool.submit(run_trial, trial, data_dir, args))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                scheduler.report(result)
+                print("Config {config_id} rung {rung}: {status}, accuracy {accuracy}, {seconds:.0f} s".format(
+                    **result))
+
+
+def best_config(leaderboard, args):
+    best = next((r for r in leaderboard if r['status'] == 'ok'), None)
+    if best is None:
+        return None
+    config = {'backend': args.backend, 'config_id': best['config_id'], 'epochs': best['epochs'],
+              'accuracy': best['accuracy'], 'subset': args.subset}
+    if args.backend == 'pytorch':
+        config['hyperparameters'] = dict(best['config'], epochs=best['epochs'], network=args.network)
+        # trainer.py reads these in place of the stack parameters
+        environment = dict((k.upper(), v) for k, v in best['config'].items())
+        environment.update(EPOCHS=best['epochs'], NETWORK=args.network)
+        config['environment'] = environment
+    else:
+        config['hyperparameters'] = dict((MXNET_NAMES.get(k, k), v) for k, v in best['config'].items())
+        config['hyperparameters'].update(epochs=best['epochs'], network=args.network)
+    return config
+
+
+def print_table(leaderboard, top=10):
+    print("{0:>6} {1:>4} {2:>6} {3:>8} {4:>10} {5:>7}  {6}".format(
+        'config', 'rung', 'epochs', 'accuracy', 'min_recall', 'seconds', 'hyperparameters'))
+    for r in leaderboard[:top]:
+        print("{0:>6} {1:>4} {2:>6} {3:>8} {4:>10} {5:>7.0f}  {6}".format(
+            r['config_id'], r['rung'], r['epochs'],
+            '%.4f' % r['accuracy'] if r['accuracy'] is not None else r['status'],
+            '%.4f' % r['min_recall'] if r.get('min_recall') is not None else '-',
+            r['seconds'], json.dumps(r['config'], sort_keys=True)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--backend', choices=BACKENDS, default='pytorch')
+    parser.add_argument('--data', required=True,
+                        help='directory with train and valid data, as the training channel')
+    parser.add_argument('--network', default=None,
+                        help='network of every trial (default: resnet18, resnet18_v2 for mxnet)')
+    parser.add_argument('--subset', type=float, default=1.0,
+                        help='fraction of each class of the wafer stores the trials use')
+    parser.add_argument('--trials', type=int, default=27, help='number of configurations sampled')
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3, help='1/eta of each rung is promoted')
+    parser.add_argument('--threads', type=int, default=2, help='OMP/MKL threads of each trial')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='trials run at once (default: cores / threads)')
+    parser.add_argument('--space', default=None,
+                        help='JSON search space, updating the default one (see DEFAULT_SPACE)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default='search-work', help='data subsets and trial outputs')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child_main(args.child)
+    # the trainers' defaults; the native-resolution networks train much faster on a CPU
+    args.network = args.network or ('resnet18' if args.backend == 'pytorch' else 'resnet18_v2')
+    args.workers = args.workers or max(1, multiprocessing.cpu_count() // args.threads)
+    space = dict(DEFAULT_SPACE)
+    if args.space:
+        space.update(json.loads(args.space))
+    rungs = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    print("{0} trials of {1}/{2}, rungs of {3} epochs, {4} workers of {5} threads".format(
+        args.trials, args.backend, args.network, rungs, args.workers, args.threads))
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    data_dir = os.path.abspath(subset_data(args.data, args.work_dir, args.subset, args.seed))
+    args.work_dir = os.path.abspath(args.work_dir)
+    scheduler = ASHA(space, rungs, args.eta, args.trials, args.seed)
+    search(scheduler, data_dir, args)
+
+    leaderboard = scheduler.leaderboard()
+    print_table(leaderboard)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(args.output_dir, 'leaderboard.json'), 'w') as fout:
+        json.dump(leaderboard, fout, indent=2)
+    best = best_config(leaderboard, args)
+    if best is None:
+        sys.exit('No trial finished, see the train.log files in ' + args.work_dir)
+    with open(os.path.join(args.output_dir, 'best_config.json'), 'w') as fout:
+        json.dump(best, fout, indent=2, sort_keys=True)
+    print("Best: config {config_id}, accuracy {accuracy:.4f} in {epochs} epochs".format(**best))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: MIT-0
 from sagemaker import get_execution_role
 from sagemaker.estimator import Estimator
+import json
 import os
 import sys
 
@@ -16,16 +17,32 @@ img_label = os.environ['IMAGE_TAG']
 input_path = os.environ['INPUT_DATA']
 region = os.environ['AWS_DEFAULT_REGION']
 acct = os.environ['AWS_ACCOUNT_ID']
+# hyperparameters tuned with search.py, when its best_config.json is committed next to this script
+config_file = os.environ.get('HYPERPARAMETER_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'best_config.json'))
+if os.path.exists(config_file):
+    with open(config_file) as fin:
+        tuned = json.load(fin).get('environment', {})
+    print("Using hyperparameters from " + config_file + ": " + str(tuned))
+    os.environ.update((k, str(v)) for k, v in tuned.items())
 epochs = int(os.environ['EPOCHS'])
 lr = float(os.environ['LR'])
 batch_size = int(os.environ['BATCH_SIZE'])
+network = os.environ.get('NETWORK', 'resnet18')
+# optional class-aware sampling, see pytorch_code/classifier/class_sampler.py
+sampling = {'sampling': os.environ.get('SAMPLING'),
+            'epoch-fraction': os.environ.get('EPOCH_FRACTION'),
+            'majority-fraction': os.environ.get('MAJORITY_FRACTION'),
+            'target-accuracy': os.environ.get('TARGET_ACCURACY')}
 
 print("Instance type = " + instance_type)
 print("Epochs = " + str(epochs))
 print("LR = " + str(lr))
 print("BS = " + str(batch_size))
+print("Network = " + network)
 
-hyperparameters = {'epochs': epochs, 'lr': lr, 'batch-size': batch_size}
+hyperparameters = {'epochs': epochs, 'lr': lr, 'batch-size': batch_size, 'network': network}
+hyperparameters.update((k, v) for k, v in sampling.items() if v)
+print("Hyperparameters = " + str(hyperparameters))
 
 estimator = Estimator(role=role, 
                       train_instance_count=1,
@@ -33,7 +50,16 @@ estimator = Estimator(role=role,
                       image_name="{0}.dkr.ecr.{1}.amazonaws.com/{2}:{3}".format(acct, region, img_name, img_label),
                       metric_definitions=[
                         {'Name': 'valid:loss', 'Regex': 'METRIC_VAL_LOSS=(.*)'},
-                        {'Name': 'accuracy', 'Regex': 'METRIC_ACCURACY=(.*)'}
+                        {'Name': 'accuracy', 'Regex': 'METRIC_ACCURACY=(.*)'},
+                        {'Name': 'train:data_wait_sec', 'Regex': 'METRIC_DATA_WAIT_SEC=(.*)'},
+                        {'Name': 'train:forward_backward_sec', 'Regex': 'METRIC_FORWARD_BACKWARD_SEC=(.*)'},
+                        {'Name': 'train:optimizer_sec', 'Regex': 'METRIC_OPTIMIZER_SEC=(.*)'},
+                        {'Name': 'train:validation_sec', 'Regex': 'METRIC_VALIDATION_SEC=(.*)'},
+                        {'Name': 'train:images_per_sec', 'Regex': 'METRIC_IMAGES_PER_SEC=(.*)'},
+                        {'Name': 'train:peak_rss_mb', 'Regex': 'METRIC_PEAK_RSS_MB=(.*)'},
+                        {'Name': 'train:images_seen', 'Regex': 'METRIC_IMAGES_SEEN=(.*)'},
+                        {'Name': 'train:time_to_target_sec', 'Regex': 'METRIC_TIME_TO_TARGET_SEC=(.*)'},
+                        {'Name': 'valid:min_recall', 'Regex': 'METRIC_VALID_MIN_RECALL=(.*)'}
                       ],
                       hyperparameters=hyperparameters)
 print("Created estimator, launching job")